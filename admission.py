@@ -0,0 +1,184 @@
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, Optional
+
+from starlette import status
+
+# Paths never shed: probes and scrapes must keep working under load, and
+# long-lived event streams would otherwise hold a slot for their lifetime
+EXEMPT_PREFIXES = ('/health', '/metrics', '/events')
+
+
+@dataclass(frozen=True, slots=True)
+class Budget:
+    """Sustained requests per second, and how many may come at once."""
+    rate: float
+    burst: int
+
+    @property
+    def refill_time(self) -> float:
+        """Seconds an untouched bucket takes to fill up completely."""
+        return self.burst / self.rate
+
+
+def parse_budgets(spec: dict[str, str]) -> dict[str, Budget]:
+    """Budgets from ``{route: "rate:burst"}``; the burst defaults to the rate.
+
+    ``{"game_create": "2:5"}`` lets a user create 5 games at once and 2 a
+    second after that.
+    """
+    budgets = {}
+    for route, value in spec.items():
+        rate, _, burst = value.partition(':')
+        rate = float(rate)
+        budgets[route] = Budget(rate, int(burst) if burst else math.ceil(rate))
+    return budgets
+
+
+class RateLimiter:
+    """Token buckets per route and user.
+
+    A bucket left alone long enough to fill up is the same as no bucket,
+    so buckets idle for the longest refill time of any budget are dropped
+    as others are touched. Memory therefore follows the users active in
+    that window, and ``max_buckets`` caps it outright by dropping the least
+    recently used buckets first.
+    """
+
+    def __init__(self,
+                 budgets: dict[str, Budget],
+                 max_buckets: int = 1_000_000,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        # A rate of 0 lifts the route's limit
+        self._budgets = {route: budget for route, budget in budgets.items()
+                         if budget.rate > 0}
+        self._max_buckets = max_buckets
+        self._clock = clock
+        self._idle_ttl = max((budget.refill_time
+                              for budget in self._budgets.values()),
+                             default=0)
+        # (route, key) -> [tokens, updated], least recently updated first
+        self._buckets: OrderedDict[tuple[str, Hashable],
+                                   list[float]] = OrderedDict()
+        self.admitted = 0
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, route: str, key: Hashable) -> float:
+        """Take a token; 0 if admitted, else seconds until one is free."""
+        budget = self._budgets.get(route)
+        if budget is None:
+            return 0.0
+        now = self._clock()
+        self._evict(now)
+        bucket = self._buckets.get((route, key))
+        if bucket is None:
+            bucket = self._buckets[(route, key)] = [float(budget.burst), now]
+        else:
+            bucket[0] = min(float(budget.burst),
+                            bucket[0] + (now - bucket[1]) * budget.rate)
+            bucket[1] = now
+            self._buckets.move_to_end((route, key))
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.admitted += 1
+            return 0.0
+        self.rejected += 1
+        return (1 - bucket[0]) / budget.rate
+
+    def stats(self) -> dict:
+        return {
+            "buckets": len(self._buckets),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+    def _evict(self, now: float) -> None:
+        buckets = self._buckets
+        while buckets and (len(buckets) >= self._max_buckets or
+                           now - next(iter(buckets.values()))[1]
+                           >= self._idle_ttl):
+            buckets.popitem(last=False)
+
+
+class LoadShedder:
+    """Global admission: caps requests in flight and sheds on pool waits.
+
+    ``pool_wait`` reports how long the longest waiting database checkout
+    has been waiting; above ``max_pool_wait`` the pool is saturated and
+    new requests are turned away instead of joining the queue.
+    """
+
+    def __init__(self,
+                 max_in_flight: int,
+                 pool_wait: Callable[[], float],
+                 max_pool_wait: float) -> None:
+        self._max_in_flight = max_in_flight
+        self._pool_wait = pool_wait
+        self._max_pool_wait = max_pool_wait
+        self.in_flight = 0
+        self.shed_in_flight = 0
+        self.shed_pool_wait = 0
+
+    def admit(self) -> Optional[str]:
+        """None if the request may proceed, else why it is shed."""
+        if self.in_flight >= self._max_in_flight:
+            self.shed_in_flight += 1
+            return 'Too many requests in flight'
+        if self._pool_wait() > self._max_pool_wait:
+            self.shed_pool_wait += 1
+            return 'Database is overloaded'
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self._max_in_flight,
+            "pool_wait_ms": 1000 * self._pool_wait(),
+            "max_pool_wait_ms": 1000 * self._max_pool_wait,
+            "shed_in_flight": self.shed_in_flight,
+            "shed_pool_wait": self.shed_pool_wait,
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware answering 503 to requests ``LoadShedder`` turns away.
+
+    It runs before routing, so a shed request never opens a session.
+    """
+
+    def __init__(self, app, shedder: LoadShedder) -> None:
+        self.app = app
+        self.shedder = shedder
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(
+                EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        reason = self.shedder.admit()
+        if reason is not None:
+            await _reject(send, status.HTTP_503_SERVICE_UNAVAILABLE, reason)
+            return
+        self.shedder.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.shedder.in_flight -= 1
+
+
+async def _reject(send, status_code: int, detail: str) -> None:
+    body = b'{"detail":"' + detail.encode() + b'"}'
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode()),
+                    (b'retry-after', b'1')],
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -16,17 +16,20 @@ if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
 
-env = Env()
-env.read_env('.env')
-
-url = URL.create(
-    drivername='postgresql+asyncpg',
-    username=env.str('POSTGRES_USER'),
-    password=env.str('POSTGRES_PASSWORD'),
-    host=env.str('POSTGRES_HOST'),
-    database=env.str('POSTGRES_DB'),
-    port=5432
-).render_as_string(hide_password=False)
+# Callers such as the benchmark harness can pass the URL in programmatically
+url = config.attributes.get('sqlalchemy.url')
+if url is None:
+    env = Env()
+    env.read_env('.env')
+
+    url = URL.create(
+        drivername='postgresql+asyncpg',
+        username=env.str('POSTGRES_USER'),
+        password=env.str('POSTGRES_PASSWORD'),
+        host=env.str('POSTGRES_HOST'),
+        database=env.str('POSTGRES_DB'),
+        port=env.int('POSTGRES_PORT', 5432)
+    ).render_as_string(hide_password=False)
 
 config.set_main_option(
     'sqlalchemy.url',
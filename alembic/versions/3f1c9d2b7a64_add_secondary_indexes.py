@@ -0,0 +1,66 @@
+"""add secondary indexes
+
+Revision ID: 3f1c9d2b7a64
+Revises: a82531dff50d
+Create Date: 2026-10-18 10:12:41.308115
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9d2b7a64'
+down_revision: Union[str, None] = 'a82531dff50d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Keep the oldest completion of each (user, task) so the pair can be unique
+    op.execute("""
+        DELETE FROM user_tasks AS duplicate
+        USING user_tasks AS original
+        WHERE duplicate.user_id = original.user_id
+          AND duplicate.task_id = original.task_id
+          AND duplicate.id > original.id
+    """)
+
+    # Build without blocking writes on live tables
+    with op.get_context().autocommit_block():
+        op.create_index('ix_games_user_id_id', 'games', ['user_id', 'id'],
+                        postgresql_concurrently=True)
+        op.create_index('ix_games_open_id', 'games', ['id'],
+                        postgresql_where=sa.text('result IS NULL'),
+                        postgresql_concurrently=True)
+        op.create_index('ix_games_open_bet_id', 'games', ['bet', 'id'],
+                        postgresql_where=sa.text('result IS NULL'),
+                        postgresql_concurrently=True)
+        op.create_index('ix_users_referrer_id', 'users', ['referrer_id'],
+                        postgresql_concurrently=True)
+        op.create_index('ix_users_won_games_id', 'users',
+                        [sa.text('won_games DESC'), 'id'],
+                        postgresql_concurrently=True)
+        op.create_index('ix_tasks_open_expired_at', 'tasks', ['expired_at'],
+                        postgresql_where=sa.text('repeat_count > 0'),
+                        postgresql_concurrently=True)
+        op.create_index('uq_user_tasks_user_id_task_id', 'user_tasks',
+                        ['user_id', 'task_id'], unique=True,
+                        postgresql_concurrently=True)
+
+    op.execute('ALTER TABLE user_tasks '
+               'ADD CONSTRAINT uq_user_tasks_user_id_task_id '
+               'UNIQUE USING INDEX uq_user_tasks_user_id_task_id')
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_user_tasks_user_id_task_id', 'user_tasks',
+                       type_='unique')
+    op.drop_index('ix_tasks_open_expired_at', table_name='tasks')
+    op.drop_index('ix_users_won_games_id', table_name='users')
+    op.drop_index('ix_users_referrer_id', table_name='users')
+    op.drop_index('ix_games_open_bet_id', table_name='games')
+    op.drop_index('ix_games_open_id', table_name='games')
+    op.drop_index('ix_games_user_id_id', table_name='games')
@@ -0,0 +1,64 @@
+"""add referral stats
+
+Revision ID: 7b2e4f8a1c35
+Revises: 3f1c9d2b7a64
+Create Date: 2026-10-18 14:03:52.417902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b2e4f8a1c35'
+down_revision: Union[str, None] = '3f1c9d2b7a64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Keep in sync with database.repository.user_repo
+MAX_REFERRAL_DEPTH = 32
+REFERRER_BONUS = 10
+
+
+def upgrade() -> None:
+    # Telegram ids do not fit in INTEGER; match users.id
+    op.alter_column('users', 'referrer_id',
+                    existing_type=sa.INTEGER(),
+                    type_=sa.BIGINT(),
+                    existing_nullable=True)
+
+    op.create_table('referral_stats',
+    sa.Column('user_id', sa.BIGINT(), nullable=False),
+    sa.Column('depth', sa.INTEGER(), nullable=False),
+    sa.Column('referrals', sa.INTEGER(), nullable=False),
+    sa.Column('earnings', sa.REAL(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'depth')
+    )
+
+    # Count every user once for each ancestor above it
+    op.execute(f"""
+        WITH RECURSIVE chain(ancestor, depth) AS (
+            SELECT referrer_id, 1 FROM users WHERE referrer_id IS NOT NULL
+            UNION ALL
+            SELECT users.referrer_id, chain.depth + 1
+            FROM chain JOIN users ON users.id = chain.ancestor
+            WHERE users.referrer_id IS NOT NULL
+              AND chain.depth < {MAX_REFERRAL_DEPTH}
+        )
+        INSERT INTO referral_stats (user_id, depth, referrals, earnings)
+        SELECT ancestor, depth, count(*),
+               CASE WHEN depth = 1 THEN {REFERRER_BONUS} * count(*) ELSE 0 END
+        FROM chain
+        GROUP BY ancestor, depth
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('referral_stats')
+    op.alter_column('users', 'referrer_id',
+                    existing_type=sa.BIGINT(),
+                    type_=sa.INTEGER(),
+                    existing_nullable=True)
@@ -0,0 +1,29 @@
+"""add game claims
+
+Revision ID: b8d4f2a6c913
+Revises: a3c7e9d1f054
+Create Date: 2026-10-19 16:12:47.530917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8d4f2a6c913'
+down_revision: Union[str, None] = 'a3c7e9d1f054'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Nullable without a default, so no partition is rewritten
+    op.add_column('games', sa.Column('claimed_by', sa.BIGINT(), nullable=True))
+    op.add_column('games', sa.Column('claimed_at', sa.TIMESTAMP(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('games', 'claimed_at')
+    op.drop_column('games', 'claimed_by')
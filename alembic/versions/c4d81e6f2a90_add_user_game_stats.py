@@ -0,0 +1,52 @@
+"""add user game stats
+
+Revision ID: c4d81e6f2a90
+Revises: 7b2e4f8a1c35
+Create Date: 2026-10-18 16:27:11.583046
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4d81e6f2a90'
+down_revision: Union[str, None] = '7b2e4f8a1c35'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('user_game_stats',
+    sa.Column('user_id', sa.BIGINT(), nullable=False),
+    sa.Column('games', sa.INTEGER(), nullable=False),
+    sa.Column('wins', sa.INTEGER(), nullable=False),
+    sa.Column('losses', sa.INTEGER(), nullable=False),
+    sa.Column('draws', sa.INTEGER(), nullable=False),
+    sa.Column('wagered', sa.REAL(), nullable=False),
+    sa.Column('profit', sa.REAL(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+    op.execute("""
+        INSERT INTO user_game_stats (user_id, games, wins, losses, draws,
+                                     wagered, profit)
+        SELECT user_id, count(*),
+               count(*) FILTER (WHERE result = 'win'),
+               count(*) FILTER (WHERE result = 'lose'),
+               count(*) FILTER (WHERE result = 'draw'),
+               coalesce(sum(bet), 0),
+               coalesce(sum(CASE result WHEN 'win' THEN bet
+                                        WHEN 'lose' THEN -bet
+                                        ELSE 0 END), 0)
+        FROM games
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('user_game_stats')
@@ -0,0 +1,35 @@
+"""order referrals by id
+
+Revision ID: d2e7a1c5f830
+Revises: b8d4f2a6c913
+Create Date: 2026-10-20 10:41:05.218364
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2e7a1c5f830'
+down_revision: Union[str, None] = 'b8d4f2a6c913'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Build the replacement first, so lookups by referrer always have one
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_referrer_id_id', 'users',
+                        ['referrer_id', 'id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_users_referrer_id', table_name='users',
+                      postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_referrer_id', 'users', ['referrer_id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_users_referrer_id_id', table_name='users',
+                      postgresql_concurrently=True)
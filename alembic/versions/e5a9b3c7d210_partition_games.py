@@ -0,0 +1,123 @@
+"""partition games by month and add games archive
+
+Revision ID: e5a9b3c7d210
+Revises: c4d81e6f2a90
+Create Date: 2026-10-18 18:41:06.219734
+
+"""
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a9b3c7d210'
+down_revision: Union[str, None] = 'c4d81e6f2a90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Keep in sync with database.archival
+MONTHS_AHEAD = 2
+
+
+def _add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def upgrade() -> None:
+    # Keep the id sequence when the old table is dropped
+    op.execute('ALTER SEQUENCE games_id_seq OWNED BY NONE')
+    op.rename_table('games', 'games_unpartitioned')
+    op.execute('ALTER TABLE games_unpartitioned '
+               'RENAME CONSTRAINT games_pkey TO games_unpartitioned_pkey')
+    op.drop_index('ix_games_user_id_id', table_name='games_unpartitioned')
+    op.drop_index('ix_games_open_id', table_name='games_unpartitioned')
+    op.drop_index('ix_games_open_bet_id', table_name='games_unpartitioned')
+
+    op.execute("""
+        CREATE TABLE games (
+            id INTEGER NOT NULL DEFAULT nextval('games_id_seq'),
+            bet REAL NOT NULL,
+            symbol VARCHAR(255) NOT NULL,
+            result VARCHAR(255),
+            user_id BIGINT NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute('ALTER SEQUENCE games_id_seq OWNED BY games.id')
+    # Catches rows outside every monthly partition instead of failing them
+    op.execute('CREATE TABLE games_default PARTITION OF games DEFAULT')
+
+    oldest = op.get_bind().scalar(
+        sa.text('SELECT min(created_at) FROM games_unpartitioned'))
+    current = datetime.now().replace(day=1, hour=0, minute=0, second=0,
+                                     microsecond=0)
+    month = current if oldest is None else min(
+        current, oldest.replace(day=1, hour=0, minute=0, second=0,
+                                microsecond=0))
+    while month <= _add_months(current, MONTHS_AHEAD):
+        op.execute(f"CREATE TABLE games_{month:%Y_%m} PARTITION OF games "
+                   f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+                   f"TO ('{_add_months(month, 1):%Y-%m-%d}')")
+        month = _add_months(month, 1)
+
+    op.create_index('ix_games_user_id_id', 'games', ['user_id', 'id'])
+    op.create_index('ix_games_open_id', 'games', ['id'],
+                    postgresql_where=sa.text('result IS NULL'))
+    op.create_index('ix_games_open_bet_id', 'games', ['bet', 'id'],
+                    postgresql_where=sa.text('result IS NULL'))
+
+    op.execute('INSERT INTO games (id, bet, symbol, result, user_id, '
+               'created_at) SELECT id, bet, symbol, result, user_id, '
+               'created_at FROM games_unpartitioned')
+    op.drop_table('games_unpartitioned')
+
+    op.create_table('games_archive',
+    sa.Column('id', sa.INTEGER(), autoincrement=False, nullable=False),
+    sa.Column('bet', sa.REAL(), nullable=False),
+    sa.Column('symbol', sa.String(length=255), nullable=False),
+    sa.Column('result', sa.String(length=255), nullable=True),
+    sa.Column('user_id', sa.BIGINT(), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    op.execute('ALTER SEQUENCE games_id_seq OWNED BY NONE')
+    op.rename_table('games', 'games_partitioned')
+    op.drop_index('ix_games_user_id_id', table_name='games_partitioned')
+    op.drop_index('ix_games_open_id', table_name='games_partitioned')
+    op.drop_index('ix_games_open_bet_id', table_name='games_partitioned')
+    op.execute('ALTER TABLE games_partitioned '
+               'RENAME CONSTRAINT games_pkey TO games_partitioned_pkey')
+
+    op.create_table('games',
+    sa.Column('id', sa.INTEGER(), server_default=sa.text("nextval('games_id_seq')"), nullable=False),
+    sa.Column('bet', sa.REAL(), nullable=False),
+    sa.Column('symbol', sa.String(length=255), nullable=False),
+    sa.Column('result', sa.String(length=255), nullable=True),
+    sa.Column('user_id', sa.BIGINT(), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER SEQUENCE games_id_seq OWNED BY games.id')
+    op.execute('INSERT INTO games (id, bet, symbol, result, user_id, '
+               'created_at) SELECT id, bet, symbol, result, user_id, '
+               'created_at FROM games_partitioned UNION ALL '
+               'SELECT id, bet, symbol, result, user_id, created_at '
+               'FROM games_archive')
+    op.drop_table('games_archive')
+    op.drop_table('games_partitioned')
+
+    op.create_index('ix_games_user_id_id', 'games', ['user_id', 'id'])
+    op.create_index('ix_games_open_id', 'games', ['id'],
+                    postgresql_where=sa.text('result IS NULL'))
+    op.create_index('ix_games_open_bet_id', 'games', ['bet', 'id'],
+                    postgresql_where=sa.text('result IS NULL'))
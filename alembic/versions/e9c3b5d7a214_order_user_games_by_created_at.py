@@ -0,0 +1,46 @@
+"""order user games by created_at
+
+Revision ID: e9c3b5d7a214
+Revises: d2e7a1c5f830
+Create Date: 2026-10-20 14:06:52.704119
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e9c3b5d7a214'
+down_revision: Union[str, None] = 'd2e7a1c5f830'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _create_partitioned_index(name: str, columns: str) -> None:
+    # A partitioned index cannot be built concurrently. Create it on the
+    # parent only, build each partition's concurrently and attach them; it
+    # becomes valid once every partition has one.
+    op.execute(f'CREATE INDEX IF NOT EXISTS {name} ON ONLY games '
+               f'({columns})')
+    partitions = op.get_bind().scalars(
+        sa.text("SELECT inhrelid::regclass::text FROM pg_inherits "
+                "WHERE inhparent = 'games'::regclass")).all()
+    with op.get_context().autocommit_block():
+        for partition in partitions:
+            index = f"{partition}_{columns.replace(', ', '_')}_idx"
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} '
+                       f'ON {partition} ({columns})')
+            op.execute(f'ALTER INDEX {name} ATTACH PARTITION {index}')
+
+
+def upgrade() -> None:
+    _create_partitioned_index('ix_games_user_id_created_at_id',
+                              'user_id, created_at, id')
+    op.drop_index('ix_games_user_id_id', table_name='games')
+
+
+def downgrade() -> None:
+    _create_partitioned_index('ix_games_user_id_id', 'user_id, id')
+    op.drop_index('ix_games_user_id_created_at_id', table_name='games')
@@ -0,0 +1,43 @@
+"""store money as integer minor units
+
+Revision ID: f1d6c2a8b493
+Revises: e5a9b3c7d210
+Create Date: 2026-10-18 20:12:47.905118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1d6c2a8b493'
+down_revision: Union[str, None] = 'e5a9b3c7d210'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Keep in sync with models.money
+MINOR_UNITS = 100
+
+MONEY_COLUMNS = [
+    ('users', 'balance'),
+    ('games', 'bet'),
+    ('games_archive', 'bet'),
+    ('tasks', 'reward'),
+    ('user_game_stats', 'wagered'),
+    ('user_game_stats', 'profit'),
+    ('referral_stats', 'earnings'),
+]
+
+
+def upgrade() -> None:
+    # Each ALTER rewrites its table under an exclusive lock
+    for table, column in MONEY_COLUMNS:
+        op.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT '
+                   f'USING round({column}::numeric * {MINOR_UNITS})::bigint')
+
+
+def downgrade() -> None:
+    for table, column in MONEY_COLUMNS:
+        op.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE REAL '
+                   f'USING {column}::real / {MINOR_UNITS}')
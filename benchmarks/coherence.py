@@ -0,0 +1,291 @@
+"""Check that writes on one worker reach the others through the change feed.
+
+Starts several API workers (benchmarks.coherence_worker) as separate
+processes against a throwaway PostgreSQL, each with its own cache,
+leaderboard, open games and task board. Writes go to one worker while the
+others are polled until their cached users, top 10, ranks, matchmaking,
+task lists and push events reflect them. It then times a run of balance
+changes from the write to being applied elsewhere, and kills one worker's
+listening connection to check that it reconnects and resyncs what it
+missed. Exits non-zero if any worker stays stale or the p99 propagation
+latency is over budget.
+
+    python -m benchmarks.coherence --workers 3 --writes 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from typing import Optional
+
+import asyncpg
+from sqlalchemy import make_url
+
+from benchmarks.postgres import ROOT, prepare_schema, temporary_postgres
+from database.changes import LISTENER_NAME
+from database.events import user_topic
+
+ROUTES = ('user_register', 'user_task', 'user_balance', 'game_create',
+          'game_match', 'game_finish')
+
+
+class Worker:
+    """A worker process and the pipe it takes commands on."""
+
+    def __init__(self, name: str, url: str, env: dict) -> None:
+        self.name = name
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.coherence_worker", url],
+            cwd=ROOT,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True)
+        if not self._read().get("ready"):
+            raise RuntimeError(f'worker {name} did not start')
+
+    def call(self, **command) -> dict:
+        self.process.stdin.write(json.dumps(command) + '\n')
+        self.process.stdin.flush()
+        return self._read()
+
+    def request(self, method: str, path: str, body=None) -> dict:
+        return self.call(request=[method, path, body])
+
+    def wait(self, path: str, check: str, value, timeout: float) -> dict:
+        return self.call(wait=[path, check, value], timeout=timeout)
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.stdin.write(json.dumps({"exit": True}) + '\n')
+            self.process.stdin.flush()
+            self.process.wait(30)
+
+    def _read(self) -> dict:
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f'worker {self.name} exited with '
+                               f'{self.process.wait()}')
+        return json.loads(line)
+
+
+class Scenario:
+
+    def __init__(self, workers: list[Worker], timeout: float) -> None:
+        self.writer = workers[0]
+        self.readers = workers[1:]
+        self.timeout = timeout
+        self.errors: list[str] = []
+
+    def write(self, method: str, path: str, body=None,
+              expect: int = 200) -> Optional[dict]:
+        response = self.writer.request(method, path, body)
+        if response["status"] != expect:
+            self.errors.append(f'{method} {path} on {self.writer.name} '
+                               f'answered {response["status"]}: '
+                               f'{response["body"]}')
+        return response["body"]
+
+    def expect(self, what: str, path: str, check: str, value,
+               readers: Optional[list[Worker]] = None) -> None:
+        for reader in readers or self.readers:
+            result = reader.wait(path, check, value, self.timeout)
+            if result["ok"]:
+                print(f'  {what} on {reader.name}: '
+                      f'{result["elapsed"] * 1000:.1f} ms')
+            else:
+                self.errors.append(
+                    f'{what}: {reader.name} still answers '
+                    f'{result["status"]} {result["body"][:200]}')
+
+    def warm(self, *paths: str) -> None:
+        for worker in (self.writer, *self.readers):
+            for path in paths:
+                worker.request("GET", path)
+
+
+def _check_coherence(scenario: Scenario) -> None:
+    write, expect, warm = scenario.write, scenario.expect, scenario.warm
+    print('coherence:')
+    for user_id in (1, 2, 3, 4):
+        write("POST", "/user/register", {
+            "user_name": f"user {user_id}",
+            "telegram_id": user_id
+        }, 201)
+    warm("/user/1", "/user/2", "/leaderboard/top_10", "/tasks/",
+         "/user/3/tasks", "/user/4/tasks")
+
+    write("PUT", "/user/balance", {"telegram_id": 1, "reward": 100}, 204)
+    expect('cached balance', "/user/1", "balance", 100)
+
+    write("POST", "/user/register", {
+        "user_name": "user 5",
+        "telegram_id": 5,
+        "referrer_id": 2
+    }, 201)
+    expect('referrer bonus', "/user/2", "balance", 10)
+    expect('rank of a new user', "/user/5/top_place", "status", 200)
+
+    game = write("POST", "/game/create", {
+        "user_id": 2,
+        "bet": 10,
+        "symbol": "rock"
+    }, 201)
+    reader, other = scenario.readers[0], scenario.readers[-1]
+    # Sent together with the new game
+    expect('bet debited', "/user/2", "balance", 0)
+    match = reader.request("POST", "/game/match", {"user_id": 3, "bet": 10})
+    if match["status"] != 200 or match["body"]["id"] != game["id"]:
+        scenario.errors.append(f'{reader.name} did not match the new game: '
+                               f'{match}')
+    finished = reader.request("PUT", f"/game/finish/{game['id']}", {
+        "game_id": game["id"],
+        "enemy_id": 3,
+        "enemy_symbol": "scissors"
+    })
+    if finished["status"] != 200:
+        scenario.errors.append(f'finishing on {reader.name} failed: '
+                               f'{finished}')
+    # The finish was written by a reader, so the writer must catch up too
+    everyone = [scenario.writer, *scenario.readers]
+    expect('winnings paid', "/user/2", "balance", 20, everyone)
+    expect('ranked below the winner', "/user/1/top_place", "body", 2,
+           everyone)
+    expect('winner tops the top 10', "/leaderboard/top_10", "first", 2,
+           everyone)
+    match = other.request("POST", "/game/match", {"user_id": 4, "bet": 10})
+    if match["status"] != 404:
+        scenario.errors.append(f'{other.name} still offers the finished '
+                               f'game: {match}')
+
+    expired_at = (datetime.now() + timedelta(days=1)).isoformat()
+    task = write("POST", "/tasks/", {
+        "name": "coherence",
+        "expired_at": expired_at,
+        "reward": 5,
+        "repeat_count": 1
+    }, 201)
+    expect('new task listed', "/tasks/", "has", task["id"])
+    expect('new task available', "/user/3/tasks", "has", task["id"])
+    finish = reader.request("POST", "/user/finish_task", {
+        "user_id": 3,
+        "task_id": task["id"]
+    })
+    if finish["status"] != 204:
+        scenario.errors.append(f'finishing the task on {reader.name} '
+                               f'failed: {finish}')
+    expect('used up task gone', "/user/4/tasks", "lacks", task["id"],
+           [scenario.writer, *scenario.readers])
+
+    for worker in scenario.readers:
+        worker.call(subscribe=user_topic(1))
+    write("PUT", "/user/balance", {"telegram_id": 1, "reward": 1}, 204)
+    for worker in scenario.readers:
+        event = worker.call(next_event=scenario.timeout)["event"]
+        if event is None or '"balance_changed"' not in event:
+            scenario.errors.append(f'{worker.name} pushed {event} instead '
+                                   'of the balance change')
+        else:
+            print(f'  pushed on {worker.name}: {event}')
+
+
+def _check_latency(scenario: Scenario, writes: int,
+                   max_p99_ms: float) -> None:
+    for worker in scenario.readers:
+        worker.request("GET", "/user/4")
+    for _ in range(writes):
+        scenario.write("PUT", "/user/balance", {
+            "telegram_id": 4,
+            "reward": 1
+        }, 204)
+    scenario.expect('last of the writes', "/user/4", "balance", writes)
+    print('propagation from the write to applied elsewhere:')
+    for worker in scenario.readers:
+        latency = worker.call(stats=True)["latency_ms"]
+        print(f'  {worker.name}: p50 {latency["p50"]:.2f} ms, '
+              f'p99 {latency["p99"]:.2f} ms, max {latency["max"]:.2f} ms '
+              f'over the last {latency["samples"]} changes')
+        if latency["p99"] > max_p99_ms:
+            scenario.errors.append(
+                f'{worker.name} p99 latency {latency["p99"]:.1f} ms, '
+                f'budget {max_p99_ms:.0f} ms')
+
+
+async def _terminate_listener(url: str, pid: int) -> bool:
+    dsn = make_url(url).set(drivername='postgresql').render_as_string(
+        hide_password=False)
+    connection = await asyncpg.connect(dsn)
+    try:
+        return await connection.fetchval(
+            'SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+            'WHERE pid = $1 AND application_name = $2', pid, LISTENER_NAME)
+    finally:
+        await connection.close()
+
+
+def _check_resync(scenario: Scenario, url: str) -> None:
+    print('reconnect:')
+    victim = scenario.readers[0]
+    before = victim.call(stats=True)
+    victim.request("GET", "/user/2")
+    if not asyncio.run(_terminate_listener(url, before["server_pid"])):
+        scenario.errors.append(f'no listener of {victim.name} to terminate')
+        return
+    # Sent while the victim is not listening, so only a resync shows it
+    scenario.write("PUT", "/user/balance", {"telegram_id": 2, "reward": 7},
+                   204)
+    scenario.expect('change missed while disconnected', "/user/2", "balance",
+                    27, [victim])
+    after = victim.call(stats=True)
+    print(f'  {victim.name}: connects {before["connects"]} -> '
+          f'{after["connects"]}, resyncs {before["resyncs"]} -> '
+          f'{after["resyncs"]}')
+    if after["connects"] <= before["connects"] or (after["resyncs"]
+                                                   <= before["resyncs"]):
+        scenario.errors.append(f'{victim.name} did not reconnect and resync')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="reuse an existing PostgreSQL")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--writes", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="seconds a reader may stay stale")
+    parser.add_argument("--max-p99-ms", type=float, default=50)
+    args = parser.parse_args()
+    if args.workers < 2:
+        parser.error('--workers must be at least 2')
+
+    env = {
+        **os.environ,
+        "CHANGE_FEED": "true",
+        "CHANGE_FEED_PING_INTERVAL": "0.5",
+        "CHANGE_FEED_RECONNECT_DELAY": "0.1",
+        # Long enough that only the feed can make a cached user fresh
+        "CACHE_TTL": "3600",
+        "RATE_LIMITS": ",".join(f"{route}=0" for route in ROUTES),
+    }
+    with temporary_postgres(args.url) as url:
+        prepare_schema(url)
+        workers = []
+        try:
+            for index in range(args.workers):
+                workers.append(Worker(chr(ord('A') + index), url, env))
+            scenario = Scenario(workers, args.timeout)
+            _check_coherence(scenario)
+            _check_latency(scenario, args.writes, args.max_p99_ms)
+            _check_resync(scenario, url)
+        finally:
+            for worker in workers:
+                worker.close()
+    for error in scenario.errors:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if scenario.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""One API worker driven by benchmarks.coherence over stdin and stdout.
+
+Builds the app with the change feed on, starts it and then answers one JSON
+command per line with one JSON line:
+
+    {"request": [method, path, body]}   -> {"status": ..., "body": ...}
+    {"wait": [path, check, value], "timeout": seconds}
+                                        -> {"ok": ..., "elapsed": ...}
+    {"subscribe": topic}                -> {"ok": true}
+    {"next_event": seconds}             -> {"event": text or null}
+    {"stats": true}                     -> the change feed's stats
+    {"exit": true}                      -> shuts down
+
+A wait polls GET ``path`` until ``check`` holds for ``value``: "status" is
+the response status, "body" the whole response, "has" and "lacks" look for
+an id in a list and "first" compares the id of its first item. Any other
+check names a field of the response object to compare.
+
+    python -m benchmarks.coherence_worker postgresql+asyncpg://...
+"""
+import asyncio
+import json
+import sys
+import time
+from typing import Optional
+
+import httpx
+
+from database import Database
+from database.events import Subscription
+from main import create_app
+from services import Services
+
+POLL_INTERVAL = 0.001
+
+
+def _holds(response: httpx.Response, check: str, value) -> bool:
+    if check == 'status':
+        return response.status_code == value
+    if response.status_code != 200:
+        return False
+    body = response.json()
+    if check == 'body':
+        return body == value
+    if check == 'first':
+        return bool(body) and body[0]['id'] == value
+    if check in ('has', 'lacks'):
+        found = any(item['id'] == value for item in body)
+        return found if check == 'has' else not found
+    return body.get(check) == value
+
+
+class Worker:
+
+    def __init__(self, url: str) -> None:
+        self.services = Services(database=Database(url))
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=create_app(self.services)),
+            base_url='http://worker')
+        self.subscription: Optional[Subscription] = None
+
+    async def handle(self, command: dict) -> dict:
+        if 'request' in command:
+            method, path, body = command['request']
+            response = await self.client.request(method, path, json=body)
+            return {
+                "status": response.status_code,
+                "body": response.json() if response.content else None,
+            }
+        if 'wait' in command:
+            path, check, value = command['wait']
+            started = time.perf_counter()
+            deadline = started + command.get('timeout', 5)
+            while True:
+                response = await self.client.get(path)
+                if _holds(response, check, value):
+                    return {"ok": True,
+                            "elapsed": time.perf_counter() - started}
+                if time.perf_counter() > deadline:
+                    return {"ok": False, "status": response.status_code,
+                            "body": response.text}
+                await asyncio.sleep(POLL_INTERVAL)
+        if 'subscribe' in command:
+            self.subscription = self.services.events.subscribe(
+                command['subscribe'])
+            return {"ok": True}
+        if 'next_event' in command:
+            try:
+                message = await self.subscription.get(command['next_event'])
+            except TimeoutError:
+                message = None
+            return {"event": None if message is None else message.text}
+        if 'stats' in command:
+            return self.services.changes.stats()
+        raise ValueError(f'unknown command {command}')
+
+
+async def _run(url: str) -> None:
+    worker = Worker(url)
+    # httpx does not run the lifespan, so start and close by hand
+    await worker.services.start()
+    print(json.dumps({"ready": True}), flush=True)
+    try:
+        while True:
+            line = await asyncio.to_thread(sys.stdin.readline)
+            if not line:
+                break
+            command = json.loads(line)
+            if 'exit' in command:
+                break
+            print(json.dumps(await worker.handle(command)), flush=True)
+    finally:
+        await worker.client.aclose()
+        await worker.services.close()
+
+
+def main() -> None:
+    asyncio.run(_run(sys.argv[1]))
+
+
+if __name__ == "__main__":
+    main()
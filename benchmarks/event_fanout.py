@@ -0,0 +1,153 @@
+"""Measure EventHub fan-out to many idle push subscribers in one process.
+
+Each subscriber runs the same consumer loop as a /ws/events connection,
+sending to an in-memory sink instead of a socket. Reports the memory per
+subscriber, CPU spent while everyone is idle, and how long it takes for
+events to reach every subscriber. A share of the subscribers never read,
+and must be dropped once their queue is full instead of holding memory.
+Exits non-zero if any subscriber misses an event or a slow one is kept.
+
+    python -m benchmarks.event_fanout --subscribers 50000 --events 20
+"""
+import argparse
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+
+from database.events import GAMES_TOPIC, EventHub, Subscription, user_topic
+from models.events import BalanceChanged, GameCreated
+
+
+class Tally:
+    count = 0
+
+
+class Sink:
+    """Stands in for a WebSocket; a stalled one never finishes a send."""
+
+    def __init__(self, tally: Tally, stalled: bool = False) -> None:
+        self.received = 0
+        self._tally = tally
+        self._stalled = asyncio.Event() if stalled else None
+
+    async def send_text(self, text: str) -> None:
+        if self._stalled is not None:
+            await self._stalled.wait()
+        self.received += 1
+        self._tally.count += 1
+
+
+async def _consume(subscription: Subscription, sink: Sink) -> None:
+    # Same loop as the /ws/events sender
+    while (message := await subscription.get()) is not None:
+        await sink.send_text(message.text)
+
+
+async def _run(args: argparse.Namespace) -> list[str]:
+    hub = EventHub(max_subscribers=args.subscribers, max_queue=args.max_queue)
+    slow = int(args.subscribers * args.slow_ratio)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    tally = Tally()
+    sinks = []
+    tasks = []
+    for index in range(args.subscribers):
+        subscription = hub.subscribe(GAMES_TOPIC, user_topic(index))
+        sink = Sink(tally, stalled=index < slow)
+        sinks.append(sink)
+        tasks.append(asyncio.create_task(_consume(subscription, sink)))
+    await asyncio.sleep(0)
+    subscribe_time = time.perf_counter() - started
+    per_subscriber = (tracemalloc.get_traced_memory()[0] -
+                      before) / args.subscribers
+    tracemalloc.stop()
+    print(f"{args.subscribers} subscribers in {subscribe_time:.2f}s, "
+          f"{per_subscriber / 1024:.2f} KiB each")
+
+    cpu = time.process_time()
+    await asyncio.sleep(args.idle)
+    idle_cpu = time.process_time() - cpu
+    print(f"{idle_cpu * 1000:.1f} ms CPU over {args.idle:.1f}s idle")
+
+    publish_times = []
+    fanout_times = []
+    # Longest the loop went without serving anything else during fan-out
+    stall = 0.0
+    fast = args.subscribers - slow
+    for index in range(args.events):
+        expected = (index + 1) * fast
+        started = time.perf_counter()
+        hub.publish([GAMES_TOPIC],
+                    GameCreated(index, 100, 1, 'user1', None))
+        publish_times.append(time.perf_counter() - started)
+        tick = time.perf_counter()
+        while tally.count < expected:
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            stall = max(stall, now - tick)
+            tick = now
+        fanout_times.append(time.perf_counter() - started)
+    # A targeted event reaches one subscriber only
+    started = time.perf_counter()
+    hub.publish([user_topic(args.subscribers - 1)],
+                BalanceChanged(args.subscribers - 1, 100))
+    targeted = time.perf_counter() - started
+    while sinks[-1].received < args.events + 1:
+        await asyncio.sleep(0.001)
+
+    publish_times.sort()
+    fanout_times.sort()
+    median = len(fanout_times) // 2
+    print(f"{args.events} broadcasts: publish "
+          f"{publish_times[median] * 1000:.1f} ms p50, all delivered in "
+          f"{fanout_times[median] * 1000:.1f} ms p50 / "
+          f"{fanout_times[-1] * 1000:.1f} ms max "
+          f"({fast / fanout_times[median]:,.0f} deliveries/s), longest "
+          f"loop stall {stall * 1000:.1f} ms; targeted publish "
+          f"{targeted * 1e6:.0f} us")
+    print(hub.stats())
+
+    errors = []
+    missed = [index for index, sink in enumerate(sinks[slow:], slow)
+              if sink.received < args.events]
+    if missed:
+        errors.append(f"{len(missed)} subscribers missed events")
+    if args.events > args.max_queue and hub.lagging != slow:
+        errors.append(f"{hub.lagging} lagging subscribers dropped, "
+                      f"{slow} stalled")
+    if len(hub) != fast:
+        errors.append(f"{len(hub)} subscribers left, expected {fast}")
+
+    hub.close()
+    for task in tasks[:slow]:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if len(hub):
+        errors.append(f"{len(hub)} subscribers left after close")
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=20_000)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--max-queue", type=int, default=10)
+    parser.add_argument("--slow-ratio", type=float, default=0.01,
+                        help="share of subscribers that never read")
+    parser.add_argument("--idle", type=float, default=2.0,
+                        help="seconds to sit idle before publishing")
+    args = parser.parse_args()
+
+    errors = asyncio.run(_run(args))
+    for error in errors:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
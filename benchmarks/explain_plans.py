@@ -0,0 +1,249 @@
+"""Query plan regression check for the repository layer.
+
+Seeds a throwaway PostgreSQL, runs the hot repository calls while capturing
+the SQL they send, and EXPLAINs every statement. Exits non-zero if any of
+them plans a sequential scan over users, games or user_tasks, if a call
+given a game's creation time reads more than one games partition, or if a
+recent page of a user's games reads more than the latest partitions.
+
+    python -m benchmarks.explain_plans --scale 100k
+"""
+import argparse
+import asyncio
+import json
+import sys
+from typing import Awaitable, Callable
+
+from sqlalchemy import event, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from benchmarks.postgres import prepare_schema, temporary_postgres
+from benchmarks.seed import SCALES, seed
+from database.archival import PARTITION_MONTHS_AHEAD
+from database.repository.game_repo import GameRepository
+from database.repository.leaderboard_repo import LeaderboardRepository
+from database.repository.task_repo import TaskRepository
+from database.repository.user_repo import RECENT_GAMES, UserRepository
+from database.tables import Game, Task, User
+
+GUARDED_TABLES = ('users', 'games', 'user_tasks')
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+# Unbounded listings read every matching row, so hashing the joined table is
+# the cheaper plan; the paginated variants are checked instead
+_ALLOWED_SEQ_SCANS = {
+    "GameRepository.get_all_games": {'users'},
+}
+# The most games partitions these may read. Given the creation time, a
+# game is found in the partition holding it. A recent page reads the months
+# it spans, the ones created ahead of time and the default partition.
+_RECENT_PARTITIONS = 2 + PARTITION_MONTHS_AHEAD + 1
+_MAX_PARTITIONS = {
+    "GameRepository.finish_game (by key)": 1,
+    "GameRepository.delete_game_by_id (by key)": 1,
+    "UserRepository.get_user_games_page (recent)": _RECENT_PARTITIONS,
+    "UserRepository.get_user_game_history (recent)": _RECENT_PARTITIONS,
+}
+# Scanning a partition this small is cheaper than an index lookup, and the
+# empty partitions kept ahead of time are always scanned
+_SMALL_TABLE_ROWS = 1000
+
+
+async def _sample(session: AsyncSession) -> dict:
+    busy_user = await session.scalar(
+        select(Game.user_id).group_by(Game.user_id).order_by(
+            text('count(*) DESC')).limit(1))
+    open_game = (await session.execute(
+        select(Game.id, Game.bet,
+               Game.created_at).where(Game.result == None).limit(1))).one()
+    recent_game = (await session.execute(
+        select(Game.id, Game.user_id, Game.created_at).where(
+            Game.created_at >= func.now() - RECENT_GAMES).order_by(
+                Game.created_at).limit(1))).one()
+    return {
+        "user": busy_user,
+        "recent_game": recent_game,
+        "top_user": await session.scalar(
+            select(User.id).order_by(User.won_games.desc()).limit(1)),
+        "referrer": await session.scalar(
+            select(User.referrer_id).where(User.referrer_id != None).limit(1)),
+        "open_game": open_game.id,
+        "open_bet": open_game.bet,
+        "open_created_at": open_game.created_at,
+        "settled_game": await session.scalar(
+            select(Game.id).where(Game.result != None).limit(1)),
+        "task": await session.scalar(
+            select(Task.id).where(Task.repeat_count > 0,
+                                  Task.expired_at > text('now()')).limit(1)),
+        "middle_id": await session.scalar(
+            select(User.id).order_by(User.id).offset(1000).limit(1)),
+    }
+
+
+def _cases(ids: dict) -> dict[str, Callable[[AsyncSession], Awaitable]]:
+    user, top_user = ids["user"], ids["top_user"]
+    return {
+        "UserRepository.get_user_by_id":
+            lambda s: UserRepository(s).get_user_by_id(user),
+        "UserRepository.get_users_page":
+            lambda s: UserRepository(s).get_users_page(ids["middle_id"]),
+        "UserRepository.get_user_friends":
+            lambda s: UserRepository(s).get_user_friends(ids["referrer"]),
+        "UserRepository.get_referral_tree":
+            lambda s: UserRepository(s).get_referral_tree(ids["referrer"], 3),
+        "UserRepository.get_referral_stats":
+            lambda s: UserRepository(s).get_referral_stats(ids["referrer"]),
+        "UserRepository.get_user_games":
+            lambda s: UserRepository(s).get_user_games(user),
+        "UserRepository.get_user_games_page":
+            lambda s: UserRepository(s).get_user_games_page(user, None, 20),
+        "UserRepository.get_user_games_page (recent)":
+            lambda s: UserRepository(s).get_user_games_page(
+                ids["recent_game"].user_id, ids["recent_game"].id, 20,
+                ids["recent_game"].created_at),
+        "UserRepository.get_user_game_history":
+            lambda s: UserRepository(s).get_user_game_history(user, None, 20),
+        "UserRepository.get_user_game_history (recent)":
+            lambda s: UserRepository(s).get_user_game_history(
+                ids["recent_game"].user_id, None, 1),
+        "UserRepository.get_user_game_stats":
+            lambda s: UserRepository(s).get_user_game_stats(user),
+        "UserRepository.get_user_tasks":
+            lambda s: UserRepository(s).get_user_tasks(user),
+        "UserRepository.finish_task":
+            lambda s: UserRepository(s).finish_task(top_user, ids["task"]),
+        "UserRepository.update_user_balance":
+            lambda s: UserRepository(s).update_user_balance(user, 1),
+        "GameRepository.get_all_games":
+            lambda s: GameRepository(s).get_all_games(),
+        "GameRepository.get_games_page":
+            lambda s: GameRepository(s).get_games_page(None, 50),
+        "GameRepository.match_game":
+            lambda s: GameRepository(s).match_game(user, ids["open_bet"]),
+        "GameRepository.create_game":
+            lambda s: GameRepository(s).create_game(user, 0, "rock"),
+        "GameRepository.finish_game":
+            lambda s: GameRepository(s).finish_game(ids["open_game"],
+                                                    top_user, "rock"),
+        "GameRepository.finish_game (already finished)":
+            lambda s: GameRepository(s).finish_game(ids["settled_game"],
+                                                    top_user, "rock"),
+        "GameRepository.finish_game (by key)":
+            lambda s: GameRepository(s).finish_game(
+                ids["open_game"], top_user, "rock", ids["open_created_at"]),
+        "GameRepository.delete_game_by_id":
+            lambda s: GameRepository(s).delete_game_by_id(ids["open_game"]),
+        "GameRepository.delete_game_by_id (by key)":
+            lambda s: GameRepository(s).delete_game_by_id(
+                ids["open_game"], ids["open_created_at"]),
+        "LeaderboardRepository.get_leaderboard_top_10":
+            lambda s: LeaderboardRepository(s).get_leaderboard_top_10(),
+        "LeaderboardRepository.get_user_place":
+            lambda s: LeaderboardRepository(s).get_user_place(top_user),
+        "TaskRepository.get_tasks_page":
+            lambda s: TaskRepository(s).get_tasks_page(None, 50),
+    }
+
+
+def _seq_scans(plan: dict) -> list[str]:
+    found = []
+    relation = plan.get("Relation Name", "")
+    if plan["Node Type"] == "Seq Scan" and any(
+            relation == table or relation.startswith(f"{table}_")
+            for table in GUARDED_TABLES):
+        found.append(relation)
+    for child in plan.get("Plans", ()):
+        found.extend(_seq_scans(child))
+    return found
+
+
+def _games_partitions(plan: dict) -> set[str]:
+    relation = plan.get("Relation Name", "")
+    found = {relation} if relation.startswith("games_") else set()
+    for child in plan.get("Plans", ()):
+        found |= _games_partitions(child)
+    return found
+
+
+def _indexes(plan: dict) -> set[str]:
+    found = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", ()):
+        found |= _indexes(child)
+    return found
+
+
+async def _run(url: str, scale_name: str) -> list[str]:
+    engine = create_async_engine(url)
+    await seed(engine, SCALES[scale_name])
+
+    captured: list[tuple[str, tuple]] = []
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(_EXPLAINABLE):
+            captured.append((statement, tuple(parameters or ())))
+
+    async with AsyncSession(engine) as session:
+        ids = await _sample(session)
+        small = set((await session.scalars(
+            text("SELECT relname FROM pg_class "
+                 "WHERE relkind = 'r' AND reltuples < :rows"),
+            {'rows': _SMALL_TABLE_ROWS})).all())
+
+    errors = []
+    for name, call in _cases(ids).items():
+        async with engine.connect() as connection:
+            transaction = await connection.begin()
+            # Repository commits become savepoints; everything is rolled back
+            async with AsyncSession(
+                    bind=connection,
+                    join_transaction_mode='create_savepoint') as session:
+                captured.clear()
+                await call(session)
+            statements = list(captured)
+            raw = await connection.get_raw_connection()
+            for statement, parameters in statements:
+                explained = await raw.driver_connection.fetchval(
+                    f'EXPLAIN (FORMAT JSON) {statement}', *parameters)
+                # SQLAlchemy registers a json codec, plain asyncpg does not
+                if isinstance(explained, str):
+                    explained = json.loads(explained)
+                plan = explained[0]["Plan"]
+                scans = [
+                    scan for scan in _seq_scans(plan)
+                    if scan not in _ALLOWED_SEQ_SCANS.get(name, ())
+                    and scan not in small
+                ]
+                partitions = _games_partitions(plan) - {"games_archive"}
+                unpruned = len(partitions) > _MAX_PARTITIONS.get(
+                    name, len(partitions))
+                status = "FAIL" if scans or unpruned else "ok"
+                if scans:
+                    detail = f"seq scan on {', '.join(scans)}"
+                elif unpruned:
+                    detail = f"reads {len(partitions)} games partitions"
+                else:
+                    detail = ", ".join(sorted(_indexes(plan))) or "no index"
+                print(f"{status:4} {name}: {detail}")
+                if scans or unpruned:
+                    errors.append(f"{name}: {detail}\n    {statement}")
+            await transaction.rollback()
+    await engine.dispose()
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="reuse an existing PostgreSQL")
+    parser.add_argument("--scale", choices=SCALES, default="100k")
+    args = parser.parse_args()
+
+    with temporary_postgres(args.url) as url:
+        prepare_schema(url)
+        errors = asyncio.run(_run(url, args.scale))
+    for error in errors:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
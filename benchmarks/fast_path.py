@@ -0,0 +1,180 @@
+"""Compare the hot user reads on the ORM path and on the asyncpg fast path.
+
+Seeds users into a throwaway PostgreSQL and requests GET /user/{id} and
+GET /user/{id}/top_place in process, once through an app with
+FAST_PATH_ROUTES unset and once with both routes on the fast path. The
+cache is off (CACHE_TTL=0) so every user read reaches the database; the
+place is measured both from the in-memory ranking and, with the ranking
+marked unloaded, from SQL. Requests alternate between the two apps in
+rounds so both see the same conditions. Reports per-request latency
+percentiles. Exits non-zero if the two paths answer differently or the
+fast path is not faster by --min-speedup where it reaches the database.
+
+    python -m benchmarks.fast_path --users 10000 --requests 5000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Callable
+
+import httpx
+from sqlalchemy import insert
+
+from benchmarks.postgres import prepare_schema, temporary_postgres
+from database import Database
+from database.tables import User
+from main import create_app
+from services import FAST_PATH_ROUTES, Services
+
+ROUND = 100
+
+
+class App:
+
+    def __init__(self, name: str, url: str, fast_routes: str) -> None:
+        self.name = name
+        os.environ['FAST_PATH_ROUTES'] = fast_routes
+        self.services = Services(database=Database(url))
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=create_app(self.services)),
+            base_url='http://bench')
+
+    async def get(self, path: str) -> httpx.Response:
+        return await self.client.get(path)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+        await self.services.close()
+
+
+async def _seed(url: str, users: int) -> None:
+    database = Database(url)
+    async with database.get_session() as session:
+        for start in range(1, users + 1, 5000):
+            await session.execute(insert(User), [{
+                "id": user_id,
+                "name": f"user {user_id}",
+                "balance": random.randrange(100_000),
+                "won_games": random.randrange(1000)
+            } for user_id in range(start, min(start + 5000, users + 1))])
+        await session.commit()
+    await database.dispose()
+
+
+async def _measure(apps: list[App], path: Callable[[int], str],
+                   args: argparse.Namespace) -> dict[str, list[float]]:
+    timings: dict[str, list[float]] = {app.name: [] for app in apps}
+    for app in apps:
+        for _ in range(ROUND):
+            await app.get(path(random.randint(1, args.users)))
+    for _ in range(0, args.requests, ROUND):
+        for app in apps:
+            samples = timings[app.name]
+            for _ in range(ROUND):
+                request = path(random.randint(1, args.users))
+                started = time.perf_counter()
+                response = await app.get(request)
+                samples.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{app.name} answered '
+                                       f'{response.status_code} to {request}')
+    return timings
+
+
+async def _compare(apps: list[App], path: Callable[[int], str],
+                   samples: int) -> list[str]:
+    errors = []
+    for user_id in random.sample(range(1, samples * 10), samples):
+        answers = [await app.get(path(user_id)) for app in apps]
+        if len({(a.status_code, a.content) for a in answers}) > 1:
+            errors.append(f'{path(user_id)}: ' + ', '.join(
+                f'{app.name} {answer.status_code} {answer.text}'
+                for app, answer in zip(apps, answers)))
+    return errors
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _report(case: str, timings: dict[str, list[float]]) -> float:
+    print(case)
+    p50s = {}
+    for name, samples in timings.items():
+        p50s[name] = statistics.median(samples)
+        print(f"  {name:5} p50 {p50s[name] * 1000:7.3f} ms  "
+              f"p99 {_percentile(samples, 0.99) * 1000:7.3f} ms  "
+              f"mean {statistics.fmean(samples) * 1000:7.3f} ms")
+    speedup = p50s['orm'] / p50s['fast']
+    print(f"  fast path p50 {speedup:.2f}x faster")
+    return speedup
+
+
+async def _run(url: str, args: argparse.Namespace) -> list[str]:
+    await _seed(url, args.users)
+    os.environ['CACHE_TTL'] = '0'
+    apps = [App('orm', url, ''), App('fast', url, ','.join(FAST_PATH_ROUTES))]
+    errors = []
+    try:
+        for app in apps:
+            await app.services.start()
+
+        def user(user_id: int) -> str:
+            return f'/user/{user_id}'
+
+        def place(user_id: int) -> str:
+            return f'/user/{user_id}/top_place'
+
+        # Includes ids past the last user, which must 404 on both paths
+        errors += await _compare(apps, user, args.check)
+        errors += await _compare(apps, place, args.check)
+        speedup = _report('GET /user/{id} (database)', await _measure(
+            apps, user, args))
+        if speedup < args.min_speedup:
+            errors.append(f'/user/{{id}} fast path only {speedup:.2f}x '
+                          f'faster, expected {args.min_speedup}x')
+        _report('GET /user/{id}/top_place (ranking)', await _measure(
+            apps, place, args))
+
+        for app in apps:
+            # Both paths fall back to SQL while the ranking is not loaded
+            app.services.leaderboard.loaded = False
+        errors += await _compare(apps, place, args.check)
+        speedup = _report('GET /user/{id}/top_place (database)',
+                          await _measure(apps, place, args))
+        if speedup < args.min_speedup:
+            errors.append(f'/user/{{id}}/top_place fast path only '
+                          f'{speedup:.2f}x faster, expected '
+                          f'{args.min_speedup}x')
+    finally:
+        for app in apps:
+            await app.close()
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="reuse an existing PostgreSQL")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=5000,
+                        help="timed requests per case and path")
+    parser.add_argument("--check", type=int, default=200,
+                        help="users whose answers are compared")
+    parser.add_argument("--min-speedup", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with temporary_postgres(args.url) as url:
+        prepare_schema(url)
+        errors = asyncio.run(_run(url, args))
+    for error in errors[:20]:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Check InvoiceLinks against a local fake Telegram Bot API server.
+
+Fires many concurrent invoice requests over a few distinct prices and
+verifies that each price costs one outbound call, that no more than the
+configured number of calls run at once, and that HTTP connections are
+reused. Exits non-zero if any check fails.
+
+    python -m benchmarks.payment_check --requests 2000 --prices 5
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from aiohttp import web
+
+from payments import InvoiceLinks
+
+TOKEN = '123456:fake'
+
+
+class FakeBotApi:
+    """Answers createInvoiceLink like the Bot API, after ``delay`` seconds."""
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.peers: set = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.peers.add(request.transport.get_extra_info('peername'))
+        try:
+            form = await request.post()
+            await asyncio.sleep(self.delay)
+            return web.json_response({
+                "ok": True,
+                "result": f"https://t.me/$fake_{form['payload']}_{self.calls}"
+            })
+        finally:
+            self.in_flight -= 1
+
+
+async def _run(args: argparse.Namespace) -> list[str]:
+    fake = FakeBotApi(args.delay)
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    invoices = InvoiceLinks(TOKEN,
+                            api_url=f'http://127.0.0.1:{port}',
+                            max_concurrency=args.concurrency)
+    prices = random.sample(range(1, 10_000), args.prices)
+    # A second wave of one-off prices exercises the concurrency bound
+    one_off = range(10_000, 10_000 + args.requests // 10)
+    started = time.perf_counter()
+    try:
+        links = await asyncio.gather(*(
+            invoices.get_link(random.choice(prices))
+            for _ in range(args.requests)))
+        await asyncio.gather(*(invoices.get_link(price) for price in one_off))
+    finally:
+        elapsed = time.perf_counter() - started
+        await invoices.close()
+        await runner.cleanup()
+
+    distinct = len(prices) + len(one_off)
+    print(f"{args.requests + len(one_off)} requests in {elapsed:.2f}s, "
+          f"{fake.calls} Bot API calls, {fake.max_in_flight} at most in "
+          f"flight, {len(fake.peers)} connections")
+
+    errors = []
+    if len(set(links)) > args.prices:
+        errors.append(f"{len(set(links))} links for {args.prices} prices")
+    if fake.calls > distinct:
+        errors.append(f"{fake.calls} calls for {distinct} distinct prices")
+    if fake.max_in_flight > args.concurrency:
+        errors.append(f"{fake.max_in_flight} calls in flight, limit "
+                      f"{args.concurrency}")
+    if len(fake.peers) > args.concurrency:
+        errors.append(f"{len(fake.peers)} connections, limit "
+                      f"{args.concurrency}")
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--prices", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=0.01,
+                        help="fake Bot API latency in seconds")
+    args = parser.parse_args()
+
+    errors = asyncio.run(_run(args))
+    for error in errors:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _pg_bin(name: str) -> str:
+    bin_dir = os.environ.get('PG_BIN')
+    path = os.path.join(bin_dir, name) if bin_dir else shutil.which(name)
+    if path is None:
+        raise RuntimeError(f'{name} not found; put the PostgreSQL binaries '
+                           'on PATH or point PG_BIN at their directory')
+    return path
+
+
+@contextmanager
+def temporary_postgres(url: Optional[str] = None,
+                       fsync: bool = False) -> Iterator[str]:
+    """Yield an asyncpg URL for a throwaway PostgreSQL cluster.
+
+    ``url`` (or ``BENCH_DATABASE_URL``) reuses an existing server instead.
+    The cluster listens on a unix socket only and runs without fsync unless
+    ``fsync`` is set, for measuring what commits cost.
+    """
+    url = url or os.environ.get('BENCH_DATABASE_URL')
+    if url:
+        yield url
+        return
+
+    with tempfile.TemporaryDirectory(prefix='api_lab_pg_') as root:
+        data = os.path.join(root, 'data')
+        subprocess.run([
+            _pg_bin('initdb'), '-D', data, '-U', 'postgres', '-A', 'trust',
+            '-E', 'UTF8', '--no-sync'
+        ],
+                       check=True,
+                       stdout=subprocess.DEVNULL)
+        subprocess.run([
+            _pg_bin('pg_ctl'), '-D', data, '-l',
+            os.path.join(root, 'postgres.log'), '-w', '-o',
+            f"{'' if fsync else '-F '}-k {root} -c listen_addresses='' "
+            "-c max_connections=300",
+            'start'
+        ],
+                       check=True,
+                       stdout=subprocess.DEVNULL)
+        try:
+            yield f'postgresql+asyncpg://postgres@/postgres?host={root}'
+        finally:
+            subprocess.run(
+                [_pg_bin('pg_ctl'), '-D', data, '-m', 'immediate', 'stop'],
+                stdout=subprocess.DEVNULL)
+
+
+def prepare_schema(url: str) -> None:
+    """Recreate the public schema and migrate it to the latest revision."""
+    asyncio.run(_drop_schema(url))
+    config = Config(os.path.join(ROOT, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(ROOT, 'alembic'))
+    config.attributes['sqlalchemy.url'] = url
+    command.upgrade(config, 'head')
+
+
+async def _drop_schema(url: str) -> None:
+    engine = create_async_engine(url)
+    async with engine.begin() as connection:
+        await connection.execute(text('DROP SCHEMA public CASCADE'))
+        await connection.execute(text('CREATE SCHEMA public'))
+    await engine.dispose()
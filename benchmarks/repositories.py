@@ -0,0 +1,359 @@
+"""Micro-benchmarks for every repository method.
+
+Seeds a throwaway PostgreSQL at the chosen scale and calls each repository
+method repeatedly, every call inside a transaction that is rolled back
+afterwards so writes do not drift the dataset. Reports latency percentiles,
+SQL statements sent and ORM rows hydrated per call, and writes the results
+as JSON so runs can be compared across commits.
+
+    python -m benchmarks.repositories --scale 10k --output before.json
+    python -m benchmarks.repositories --scale 10k --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Optional
+
+from sqlalchemy import event, exists, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from benchmarks.postgres import ROOT, prepare_schema, temporary_postgres
+from benchmarks.seed import SCALES, seed
+from database.matchmaking import OpenGameBook
+from database.ranking import Leaderboard
+from database.repository.game_repo import GameRepository
+from database.repository.leaderboard_repo import LeaderboardRepository
+from database.repository.task_repo import TaskRepository
+from database.repository.user_repo import UserRepository
+from database.tables import Base, Game, Task, User, UserTask
+
+NEW_USER_ID = 10**12
+# Emitted by the harness's savepoint wrapping, not by the repositories
+_HARNESS_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO')
+
+
+@dataclass
+class Case:
+    name: str
+    call: Callable[[AsyncSession], Awaitable[Any]]
+    # Reads whose cost grows with the table run fewer iterations
+    bulk: bool = False
+
+
+async def _drain(stream) -> int:
+    rows = 0
+    async for partition in stream:
+        rows += len(partition)
+    return rows
+
+
+async def _sample(session: AsyncSession) -> dict:
+    busy_user = await session.scalar(
+        select(Game.user_id).group_by(Game.user_id).order_by(
+            text('count(*) DESC')).limit(1))
+    open_game = (await session.execute(
+        select(Game.id, Game.bet).where(Game.result == None).limit(1))).one()
+    completed = exists().where(UserTask.task_id == Task.id,
+                               UserTask.user_id == busy_user)
+    spare_task = await session.scalar(
+        insert(Task).values(name='benchmark spare',
+                            expired_at=datetime.now() + timedelta(days=1),
+                            reward=1,
+                            repeat_count=1).returning(Task.id))
+    await session.commit()
+    return {
+        "user":
+            busy_user,
+        "top_user":
+            await session.scalar(
+                select(User.id).order_by(User.won_games.desc()).limit(1)),
+        "referrer":
+            await session.scalar(
+                select(User.referrer_id).where(
+                    User.referrer_id != None).limit(1)),
+        "open_game":
+            open_game.id,
+        "open_bet":
+            open_game.bet,
+        "open_task":
+            await session.scalar(
+                select(Task.id).where(Task.repeat_count > 0,
+                                      Task.expired_at > text('now()'),
+                                      ~completed).limit(1)),
+        "spare_task":
+            spare_task,
+        "middle_id":
+            await session.scalar(
+                select(User.id).order_by(User.id).offset(1000).limit(1)),
+    }
+
+
+def _cases(ids: dict, leaderboard: Leaderboard,
+           open_games: OpenGameBook) -> list[Case]:
+    user, top_user = ids["user"], ids["top_user"]
+    expires = datetime.now() + timedelta(days=1)
+
+    def users(s):
+        return UserRepository(s)
+
+    def games(s):
+        return GameRepository(s)
+
+    def tasks(s):
+        return TaskRepository(s)
+
+    def ranks(s, ranking=None):
+        return LeaderboardRepository(s, leaderboard=ranking)
+
+    return [
+        Case("UserRepository.create_user",
+             lambda s: users(s).create_user("bench", NEW_USER_ID,
+                                            ids["referrer"])),
+        Case("UserRepository.get_all_users",
+             lambda s: users(s).get_all_users(), bulk=True),
+        Case("UserRepository.get_users_page",
+             lambda s: users(s).get_users_page(ids["middle_id"])),
+        Case("UserRepository.stream_users",
+             lambda s: _drain(users(s).stream_users()), bulk=True),
+        Case("UserRepository.get_user_by_id",
+             lambda s: users(s).get_user_by_id(user)),
+        Case("UserRepository.get_user_friends",
+             lambda s: users(s).get_user_friends(ids["referrer"])),
+        Case("UserRepository.get_referral_tree",
+             lambda s: users(s).get_referral_tree(ids["referrer"], 3)),
+        Case("UserRepository.get_referral_stats",
+             lambda s: users(s).get_referral_stats(ids["referrer"])),
+        Case("UserRepository.get_user_games",
+             lambda s: users(s).get_user_games(user)),
+        Case("UserRepository.get_user_games_page",
+             lambda s: users(s).get_user_games_page(user, None, 20)),
+        Case("UserRepository.stream_user_games",
+             lambda s: _drain(users(s).stream_user_games(user))),
+        Case("UserRepository.get_user_game_history",
+             lambda s: users(s).get_user_game_history(user, None, 20)),
+        Case("UserRepository.get_user_game_stats",
+             lambda s: users(s).get_user_game_stats(user)),
+        Case("UserRepository.get_user_tasks",
+             lambda s: users(s).get_user_tasks(user)),
+        Case("UserRepository.finish_task",
+             lambda s: users(s).finish_task(user, ids["open_task"])),
+        Case("UserRepository.update_user_balance",
+             lambda s: users(s).update_user_balance(user, 1)),
+        Case("GameRepository.get_all_games",
+             lambda s: games(s).get_all_games(), bulk=True),
+        Case("GameRepository.get_games_page",
+             lambda s: games(s).get_games_page(None, 50)),
+        Case("GameRepository.stream_games",
+             lambda s: _drain(games(s).stream_games()), bulk=True),
+        Case("GameRepository.load_open_games",
+             lambda s: GameRepository(s, open_games=OpenGameBook()).
+             load_open_games(), bulk=True),
+        Case("GameRepository.match_game",
+             lambda s: games(s).match_game(user, ids["open_bet"])),
+        Case("GameRepository.match_game (book)",
+             lambda s: _match_from_book(s, open_games, user, ids["open_bet"])),
+        Case("GameRepository.create_game",
+             lambda s: games(s).create_game(user, 0, "rock")),
+        Case("GameRepository.finish_game",
+             lambda s: games(s).finish_game(ids["open_game"], top_user,
+                                            "rock")),
+        Case("GameRepository.delete_game_by_id",
+             lambda s: games(s).delete_game_by_id(ids["open_game"])),
+        Case("TaskRepository.get_all_tasks",
+             lambda s: tasks(s).get_all_tasks()),
+        Case("TaskRepository.get_tasks_page",
+             lambda s: tasks(s).get_tasks_page(None, 50)),
+        Case("TaskRepository.stream_tasks",
+             lambda s: _drain(tasks(s).stream_tasks())),
+        Case("TaskRepository.create_task",
+             lambda s: tasks(s).create_task("bench", expires, 1, 1)),
+        Case("TaskRepository.delete_task",
+             lambda s: tasks(s).delete_task(ids["spare_task"])),
+        Case("LeaderboardRepository.load_ranking",
+             lambda s: LeaderboardRepository(s, leaderboard=Leaderboard()).
+             load_ranking(), bulk=True),
+        Case("LeaderboardRepository.get_leaderboard_top_10",
+             lambda s: ranks(s).get_leaderboard_top_10()),
+        Case("LeaderboardRepository.get_leaderboard_top_10 (ranking)",
+             lambda s: ranks(s, leaderboard).get_leaderboard_top_10()),
+        Case("LeaderboardRepository.get_user_place",
+             lambda s: ranks(s).get_user_place(user)),
+        Case("LeaderboardRepository.get_user_place (ranking)",
+             lambda s: ranks(s, leaderboard).get_user_place(user)),
+        Case("LeaderboardRepository.get_users_around (ranking)",
+             lambda s: ranks(s, leaderboard).get_users_around(user)),
+        Case("LeaderboardRepository.get_user_percentile",
+             lambda s: ranks(s).get_user_percentile(user)),
+        Case("LeaderboardRepository.get_user_percentile (ranking)",
+             lambda s: ranks(s, leaderboard).get_user_percentile(user)),
+        Case("LeaderboardRepository.cross_check (ranking)",
+             lambda s: ranks(s, leaderboard).cross_check([user, top_user])),
+    ]
+
+
+async def _match_from_book(session: AsyncSession, open_games: OpenGameBook,
+                           user_id: int, bet: int):
+    game = await GameRepository(session,
+                                open_games=open_games).match_game(
+                                    user_id, bet)
+    # Put the claimed game back so every iteration finds one
+    if game is not None:
+        open_games.release(game["id"])
+    return game
+
+
+class _Counters:
+    """Per-call statement and hydration counts from engine/ORM events."""
+
+    def __init__(self, engine) -> None:
+        self.statements = 0
+        self.rows_hydrated = 0
+        event.listen(engine.sync_engine, 'before_cursor_execute',
+                     self._on_statement)
+        event.listen(Base, 'load', self._on_load, propagate=True)
+
+    def _on_statement(self, conn, cursor, statement, *args) -> None:
+        if not statement.startswith(_HARNESS_STATEMENTS):
+            self.statements += 1
+
+    def _on_load(self, *args) -> None:
+        self.rows_hydrated += 1
+
+    def reset(self) -> None:
+        self.statements = 0
+        self.rows_hydrated = 0
+
+    def close(self, engine) -> None:
+        event.remove(engine.sync_engine, 'before_cursor_execute',
+                     self._on_statement)
+        event.remove(Base, 'load', self._on_load)
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+async def _measure(engine, counters: _Counters, case: Case,
+                   iterations: int) -> dict:
+    timings = []
+    statements = rows = 0
+    for _ in range(iterations):
+        async with engine.connect() as connection:
+            transaction = await connection.begin()
+            # Repository commits become savepoints of the outer transaction
+            async with AsyncSession(
+                    bind=connection,
+                    join_transaction_mode='create_savepoint') as session:
+                counters.reset()
+                started = time.perf_counter()
+                await case.call(session)
+                timings.append(time.perf_counter() - started)
+                statements += counters.statements
+                rows += counters.rows_hydrated
+            await transaction.rollback()
+    return {
+        "iterations": iterations,
+        "p50_ms": round(_percentile(timings, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(timings, 0.95) * 1000, 3),
+        "p99_ms": round(_percentile(timings, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(timings) * 1000, 3),
+        "statements": statements / iterations,
+        "rows_hydrated": rows / iterations,
+    }
+
+
+async def _run(url: str, args: argparse.Namespace) -> dict:
+    engine = create_async_engine(url)
+    await seed(engine, SCALES[args.scale])
+
+    leaderboard, open_games = Leaderboard(), OpenGameBook()
+    async with AsyncSession(engine) as session:
+        ids = await _sample(session)
+        await LeaderboardRepository(session, leaderboard).load_ranking()
+        await GameRepository(session, open_games=open_games).load_open_games()
+
+    counters = _Counters(engine)
+    results = {}
+    try:
+        for case in _cases(ids, leaderboard, open_games):
+            if args.only and args.only not in case.name:
+                continue
+            iterations = (max(3, args.iterations // 10)
+                          if case.bulk else args.iterations)
+            # One untimed call warms the connection's statement cache
+            await _measure(engine, counters, case, 1)
+            results[case.name] = await _measure(engine, counters, case,
+                                                iterations)
+            _print_row(case.name, results[case.name])
+    finally:
+        counters.close(engine)
+        await engine.dispose()
+    return results
+
+
+def _print_row(name: str, result: dict,
+               previous: Optional[dict] = None) -> None:
+    line = (f"{name:58} p50 {result['p50_ms']:9.3f}ms "
+            f"p95 {result['p95_ms']:9.3f}ms p99 {result['p99_ms']:9.3f}ms "
+            f"sql {result['statements']:5.1f} rows {result['rows_hydrated']:9.1f}")
+    if previous is not None and previous.get("p50_ms"):
+        change = result["p50_ms"] / previous["p50_ms"] - 1
+        line += f"  p50 {change:+.0%}"
+    print(line)
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT,
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="reuse an existing PostgreSQL")
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--only", help="run the cases whose name contains this")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    args = parser.parse_args()
+
+    with temporary_postgres(args.url) as url:
+        prepare_schema(url)
+        results = asyncio.run(_run(url, args))
+
+    report = {
+        "commit": _commit(),
+        "scale": args.scale,
+        "iterations": args.iterations,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            before = json.load(file)
+        print(f"\ncompared with {before.get('commit')} "
+              f"({before.get('scale')})")
+        for name, result in results.items():
+            _print_row(name, result, before["results"].get(name))
+
+
+if __name__ == "__main__":
+    main()
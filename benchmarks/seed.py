@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from database.repository.game_repo import GameRepository
+from database.repository.user_repo import UserRepository
+
+
+@dataclass
+class Scale:
+    users: int
+    games: int
+    tasks: int
+    user_tasks: int
+    # Share of games still waiting for an opponent
+    open_ratio: float = 0.01
+
+
+SCALES = {
+    '10k': Scale(users=10_000, games=10_000, tasks=200, user_tasks=10_000),
+    '100k': Scale(users=100_000, games=300_000, tasks=1_000,
+                  user_tasks=200_000),
+    '1m': Scale(users=1_000_000, games=1_000_000, tasks=2_000,
+                user_tasks=1_000_000),
+}
+
+# Referrals point at the first users so referral trees have some depth
+_REFERRERS = 1_000
+
+
+async def seed(engine: AsyncEngine, scale: Scale) -> None:
+    """Fill an empty schema with synthetic rows generated server-side."""
+    statements = [
+        text("""
+            INSERT INTO users (id, name, balance, referrer_id, won_games,
+                               created_at)
+            SELECT g, 'user' || g, floor(random() * 100000)::bigint,
+                   CASE WHEN g > :referrers AND random() < 0.3
+                        THEN 1 + floor(random() * :referrers)::int END,
+                   floor(power(random(), 3) * 500)::int,
+                   now() - random() * interval '365 days'
+            FROM generate_series(1, :users) AS g
+        """),
+        text("""
+            INSERT INTO games (bet, symbol, result, user_id, created_at)
+            SELECT 100 + floor(random() * 9900)::bigint,
+                   (ARRAY['rock', 'paper', 'scissors'])[1 + floor(random() * 3)::int],
+                   CASE WHEN random() < :open_ratio THEN NULL
+                        ELSE (ARRAY['win', 'lose', 'draw'])[1 + floor(random() * 3)::int] END,
+                   1 + floor(random() * :users)::bigint,
+                   now() - random() * interval '365 days'
+            FROM generate_series(1, :games)
+        """),
+        text("""
+            INSERT INTO tasks (name, expired_at, reward, repeat_count)
+            SELECT 'task' || g, now() + (random() - 0.2) * interval '60 days',
+                   floor(random() * 5000)::bigint,
+                   floor(random() * 1000)::int
+            FROM generate_series(1, :tasks) AS g
+        """),
+        text("""
+            INSERT INTO user_tasks (user_id, task_id)
+            SELECT 1 + floor(random() * :users)::bigint,
+                   1 + floor(random() * :tasks)::int
+            FROM generate_series(1, :user_tasks)
+            ON CONFLICT DO NOTHING
+        """),
+    ]
+    params = {
+        'users': scale.users,
+        'games': scale.games,
+        'tasks': scale.tasks,
+        'user_tasks': scale.user_tasks,
+        'open_ratio': scale.open_ratio,
+        'referrers': min(_REFERRERS, scale.users),
+    }
+    # Monthly partitions for the year of generated games
+    now = datetime.now()
+    async with AsyncSession(engine) as session:
+        await GameRepository(session).create_partitions(
+            now - timedelta(days=365), now)
+    async with engine.begin() as connection:
+        # Same rows on every run so results are comparable across commits
+        await connection.execute(text('SELECT setseed(0.42)'))
+        for statement in statements:
+            await connection.execute(
+                statement, {
+                    key: value
+                    for key, value in params.items()
+                    if f':{key}' in statement.text
+                })
+    async with AsyncSession(engine) as session:
+        await UserRepository(session).rebuild_referral_stats()
+        await GameRepository(session).rebuild_game_stats()
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        await connection.execute(text('VACUUM ANALYZE'))
@@ -0,0 +1,216 @@
+"""Compare settling games one transaction each against group commit.
+
+Opens the same number of games twice and has many concurrent clients
+finish each game several times over. The first run settles through
+GameRepository.finish_game, a transaction per call as without
+SETTLEMENT_BATCHING. The second run queues the calls on a SettlementQueue,
+which settles them in batches. Reports throughput and call latency for
+both. Exits non-zero if a game is settled twice, a finish other than the
+first one queued for its game wins, or balances do not add up.
+
+Commits are only expensive with fsync on, which the throwaway cluster
+started here has; a server given with --url is used as configured.
+
+    python -m benchmarks.settlement_batching --games 5000 --clients 200
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import delete, func, insert, select
+
+from benchmarks.postgres import prepare_schema, temporary_postgres
+from database import Database
+from database.repository.game_repo import GameRepository
+from database.settlement import SettlementQueue
+from database.tables import Game, User, UserGameStats
+from models.money import MINOR_UNITS
+
+SYMBOLS = ("rock", "paper", "scissors")
+PLAYER_BALANCE = 1000 * MINOR_UNITS
+HOUSE_BALANCE = 1_000_000 * MINOR_UNITS
+BET = 10 * MINOR_UNITS
+
+Finish = Callable[[int, int, str], Awaitable[Optional[str]]]
+
+
+async def _reset(database: Database, args: argparse.Namespace) -> list[int]:
+    """Fresh players and open games; returns the game ids."""
+    players = range(1, args.players + 1)
+    house = range(10_001, 10_001 + args.house)
+    async with database.get_session() as session:
+        await session.execute(delete(Game))
+        await session.execute(delete(UserGameStats))
+        await session.execute(delete(User))
+        await session.execute(
+            insert(User), [{
+                "id": user_id,
+                "name": f"player{user_id}",
+                "balance": PLAYER_BALANCE,
+                "won_games": 0
+            } for user_id in players] + [{
+                "id": user_id,
+                "name": f"house{user_id}",
+                "balance": HOUSE_BALANCE,
+                "won_games": 0
+            } for user_id in house])
+        # Bets are not debited here; see _check_balances
+        game_ids = (await session.scalars(
+            insert(Game).returning(Game.id), [{
+                "user_id": players[index % len(players)],
+                "bet": BET,
+                "symbol": random.choice(SYMBOLS)
+            } for index in range(args.games)])).all()
+        await session.commit()
+    return list(game_ids)
+
+
+async def _drive(finish: Finish, game_ids: list[int],
+                 args: argparse.Namespace,
+                 in_order: bool) -> tuple[float, list[float], list[str]]:
+    """Finish every game ``args.duplicates`` times from ``args.clients``
+    concurrent clients; returns the elapsed time, call latencies and
+    errors. With ``in_order`` the first call made for a game must be the
+    one that settles it."""
+    house = range(10_001, 10_001 + args.house)
+    calls = [(game_id, random.choice(house), random.choice(SYMBOLS))
+             for game_id in game_ids for _ in range(args.duplicates)]
+    random.shuffle(calls)
+    pending = iter(enumerate(calls))
+    latencies = []
+    # Per game: (call position, result) of every finish that settled it
+    winners: dict[int, list[tuple[int, str]]] = defaultdict(list)
+    first_call: dict[int, int] = {}
+    errors = []
+
+    async def client() -> None:
+        for position, (game_id, enemy_id, symbol) in pending:
+            first_call.setdefault(game_id, position)
+            started = time.perf_counter()
+            result = await finish(game_id, enemy_id, symbol)
+            latencies.append(time.perf_counter() - started)
+            if result in ("win", "lose", "draw"):
+                winners[game_id].append((position, result))
+            elif result != "Game already finished":
+                errors.append(f"game {game_id}: unexpected {result!r}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.clients)))
+    elapsed = time.perf_counter() - started
+
+    for game_id in game_ids:
+        settled = winners.get(game_id, [])
+        if len(settled) != 1:
+            errors.append(f"game {game_id} settled {len(settled)} times")
+        elif in_order and settled[0][0] != first_call[game_id]:
+            errors.append(f"game {game_id} settled by call "
+                          f"{settled[0][0]}, not the first one queued "
+                          f"({first_call[game_id]})")
+    return elapsed, latencies, errors
+
+
+async def _check_balances(database: Database,
+                          args: argparse.Namespace) -> list[str]:
+    async with database.get_session() as session:
+        total = await session.scalar(select(func.sum(User.balance)))
+        settled = await session.scalar(
+            select(func.sum(Game.bet)).where(Game.result != None))
+    # Bets were taken up front, so however a game ends settling it pays
+    # out one bet more than it charges
+    expected = (args.players * PLAYER_BALANCE + args.house * HOUSE_BALANCE +
+                (settled or 0))
+    if total != expected:
+        return [f"balances add up to {total}, expected {expected}"]
+    return []
+
+
+def _report(name: str, elapsed: float, latencies: list[float],
+            settles: int) -> dict:
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+    result = {
+        "throughput": len(latencies) / elapsed,
+        "p50": statistics.median(ordered),
+        "p99": p99,
+    }
+    print(f"{name}: {len(latencies)} finishes ({settles} games) in "
+          f"{elapsed:.2f}s, {result['throughput']:.0f}/s, "
+          f"p50 {result['p50'] * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+    return result
+
+
+async def _run(args: argparse.Namespace, url: str) -> list[str]:
+    database = Database(url)
+    errors = []
+
+    async def finish_one(game_id: int, enemy_id: int,
+                         symbol: str) -> Optional[str]:
+        async with database.get_session() as session:
+            return await GameRepository(session).finish_game(
+                game_id, enemy_id, symbol)
+
+    game_ids = await _reset(database, args)
+    # Concurrent transactions settle in whatever order they take the lock
+    elapsed, latencies, run_errors = await _drive(finish_one, game_ids, args,
+                                                  in_order=False)
+    per_request = _report("per request", elapsed, latencies, len(game_ids))
+    errors += run_errors + await _check_balances(database, args)
+
+    async def settle(settlements):
+        async with database.get_session() as session:
+            return await GameRepository(session).finish_games(settlements)
+
+    queue = SettlementQueue(settle,
+                            max_batch=args.max_batch,
+                            max_linger=args.max_linger_ms / 1000)
+    queue.start()
+    game_ids = await _reset(database, args)
+    elapsed, latencies, run_errors = await _drive(queue.finish, game_ids,
+                                                  args, in_order=True)
+    await queue.close()
+    batched = _report("group commit", elapsed, latencies, len(game_ids))
+    stats = queue.stats()
+    print(f"  {stats['batches']} batches, {stats['average_batch']:.1f} "
+          f"finishes on average, largest {stats['largest_batch']}")
+    errors += run_errors + await _check_balances(database, args)
+
+    speedup = batched["throughput"] / per_request["throughput"]
+    print(f"group commit: {speedup:.1f}x the throughput, p99 "
+          f"{batched['p99'] * 1000:.1f} ms against "
+          f"{per_request['p99'] * 1000:.1f} ms")
+    if speedup < args.min_speedup:
+        errors.append(f"group commit reached {speedup:.2f}x the "
+                      f"throughput, expected at least {args.min_speedup}x")
+    await database.engine.dispose()
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="reuse an existing PostgreSQL")
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--house", type=int, default=10)
+    parser.add_argument("--games", type=int, default=5000)
+    parser.add_argument("--duplicates", type=int, default=2,
+                        help="finish calls per game")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--max-batch", type=int, default=500)
+    parser.add_argument("--max-linger-ms", type=float, default=2)
+    parser.add_argument("--min-speedup", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with temporary_postgres(args.url, fsync=True) as url:
+        prepare_schema(url)
+        errors = asyncio.run(_run(args, url))
+    for error in errors[:20]:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
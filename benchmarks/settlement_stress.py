@@ -0,0 +1,153 @@
+"""Concurrency stress check for game settlement.
+
+Fires many parallel create_game and duplicated finish_game calls at a
+throwaway PostgreSQL and verifies that no balance is lost, overdrawn or
+paid out twice. Exits non-zero if any invariant is violated.
+
+    python -m benchmarks.settlement_stress --players 50 --bets 5000
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import defaultdict
+
+from sqlalchemy import func, insert, select
+
+from benchmarks.postgres import prepare_schema, temporary_postgres
+from database import Database
+from database.repository.game_repo import GameRepository
+from database.tables import Game, User
+from models.money import MINOR_UNITS
+
+SYMBOLS = ("rock", "paper", "scissors")
+# Minor units; bets with cents would drift if money were a float
+PLAYER_BALANCE = 1000 * MINOR_UNITS
+HOUSE_BALANCE = 1_000_000 * MINOR_UNITS
+
+
+async def _run(args: argparse.Namespace, url: str) -> list[str]:
+    database = Database(url)
+
+    players = list(range(1, args.players + 1))
+    house = list(range(10_001, 10_001 + args.house))
+    async with database.get_session() as session:
+        await session.execute(
+            insert(User), [{
+                "id": user_id,
+                "name": f"player{user_id}",
+                "balance": PLAYER_BALANCE,
+                "won_games": 0
+            } for user_id in players] + [{
+                "id": user_id,
+                "name": f"house{user_id}",
+                "balance": HOUSE_BALANCE,
+                "won_games": 0
+            } for user_id in house])
+        await session.commit()
+
+    limit = asyncio.Semaphore(args.concurrency)
+    created: dict[int, tuple[int, int]] = {}
+    settled: dict[int, list[tuple[int, str]]] = defaultdict(list)
+    rejected = 0
+    finishes: list[asyncio.Task] = []
+
+    async def finish(game_id: int, enemy_id: int) -> None:
+        async with limit, database.get_session() as session:
+            result = await GameRepository(session).finish_game(
+                game_id, enemy_id, random.choice(SYMBOLS))
+        if result in ("win", "lose", "draw"):
+            settled[game_id].append((enemy_id, result))
+        elif result != "Game already finished":
+            raise AssertionError(f"game {game_id}: unexpected {result!r}")
+
+    async def bet() -> None:
+        nonlocal rejected
+        user_id = random.choice(players)
+        amount = random.randint(1, 60 * MINOR_UNITS)
+        async with limit, database.get_session() as session:
+            game = await GameRepository(session).create_game(
+                user_id, amount, random.choice(SYMBOLS))
+        if game is None:
+            rejected += 1
+            return
+        created[game.id] = (user_id, amount)
+        if random.random() < args.settle_ratio:
+            # Race several settlements of the same game against each other
+            finishes.extend(
+                asyncio.create_task(finish(game.id, random.choice(house)))
+                for _ in range(args.duplicates))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(bet() for _ in range(args.bets)))
+    await asyncio.gather(*finishes)
+    elapsed = time.perf_counter() - started
+
+    errors = []
+    expected = {user_id: PLAYER_BALANCE for user_id in players}
+    expected.update({user_id: HOUSE_BALANCE for user_id in house})
+    expected_wins = defaultdict(int)
+    for game_id, (user_id, amount) in created.items():
+        expected[user_id] -= amount
+        outcomes = settled.get(game_id, [])
+        if len(outcomes) > 1:
+            errors.append(f"game {game_id} settled {len(outcomes)} times")
+        for enemy_id, result in outcomes[:1]:
+            if result == "draw":
+                expected[user_id] += amount
+            elif result == "win":
+                expected[user_id] += 2 * amount
+                expected[enemy_id] -= amount
+                expected_wins[user_id] += 1
+            else:
+                expected[enemy_id] += amount
+                expected_wins[enemy_id] += 1
+
+    async with database.get_session() as session:
+        users = (await session.execute(
+            select(User.id, User.balance, User.won_games))).all()
+        open_games = await session.scalar(
+            select(func.count()).where(Game.result == None))
+    for user_id, balance, won_games in users:
+        if balance != expected[user_id]:
+            errors.append(f"user {user_id}: balance {balance}, "
+                          f"expected {expected[user_id]}")
+        if won_games != expected_wins[user_id]:
+            errors.append(f"user {user_id}: won_games {won_games}, "
+                          f"expected {expected_wins[user_id]}")
+        if user_id in players and balance < 0:
+            errors.append(f"user {user_id} overdrawn: {balance}")
+    if open_games != len(created) - len(settled):
+        errors.append(f"{open_games} open games, "
+                      f"expected {len(created) - len(settled)}")
+
+    calls = args.bets + len(finishes)
+    print(f"{len(created)} games created, {rejected} bets rejected, "
+          f"{len(settled)} games settled by {len(finishes)} finish calls")
+    print(f"{calls} calls in {elapsed:.2f}s ({calls / elapsed:.0f}/s)")
+    await database.engine.dispose()
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="reuse an existing PostgreSQL")
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--house", type=int, default=10)
+    parser.add_argument("--bets", type=int, default=5000)
+    parser.add_argument("--duplicates", type=int, default=3)
+    parser.add_argument("--settle-ratio", type=float, default=0.8)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    with temporary_postgres(args.url) as url:
+        prepare_schema(url)
+        errors = asyncio.run(_run(args, url))
+    for error in errors[:20]:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Measure how long a fresh worker takes to import, start and answer.
+
+Each run starts a new interpreter (benchmarks.startup_worker) that imports
+main, builds the app with create_app, runs its lifespan startup against a
+seeded throwaway PostgreSQL and sends it a first request over ASGI, timing
+every phase. The wall time from spawning the process to that first response
+is what an autoscaled replica adds to a spike. Exits non-zero if the median
+import or first response exceeds its budget, or if aiogram is loaded before
+/payment is used.
+
+    python -m benchmarks.startup --runs 5 --scale 10k
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from benchmarks.postgres import ROOT, prepare_schema, temporary_postgres
+from benchmarks.seed import SCALES, seed
+from benchmarks.startup_worker import FIRST_PATH
+
+PHASES = ("import", "create_app", "startup", "first_response")
+
+
+def _spawn(url: str) -> dict:
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.startup_worker", url],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        text=True)
+    line = process.stdout.readline()
+    wall = time.perf_counter() - started
+    process.stdout.read()
+    if process.wait() != 0 or not line:
+        raise RuntimeError(f"worker exited with {process.returncode}")
+    result = json.loads(line)
+    result["wall"] = wall
+    return result
+
+
+async def _seed(url: str, scale: str) -> None:
+    engine = create_async_engine(url)
+    await seed(engine, SCALES[scale])
+    await engine.dispose()
+
+
+def _run(args: argparse.Namespace, url: str) -> list[str]:
+    results = [_spawn(url) for _ in range(args.runs)]
+    for index, result in enumerate(results, 1):
+        timings = result["timings"]
+        phases = ", ".join(f"{phase} {timings[phase] * 1000:.0f} ms"
+                           for phase in PHASES)
+        print(f"run {index}: {phases}; {result['wall'] * 1000:.0f} ms from "
+              f"spawn to first response ({result['status']})")
+
+    median = {
+        phase: statistics.median(result["timings"][phase]
+                                 for result in results) for phase in PHASES
+    }
+    wall = statistics.median(result["wall"] for result in results)
+    print("median: " + ", ".join(f"{phase} {median[phase] * 1000:.0f} ms"
+                                 for phase in PHASES) +
+          f"; {wall * 1000:.0f} ms from spawn to first response")
+
+    errors = []
+    if median["import"] * 1000 > args.max_import_ms:
+        errors.append(f"import took {median['import'] * 1000:.0f} ms, "
+                      f"budget {args.max_import_ms:.0f} ms")
+    if wall * 1000 > args.max_first_response_ms:
+        errors.append(f"first response after {wall * 1000:.0f} ms, "
+                      f"budget {args.max_first_response_ms:.0f} ms")
+    if any(result["aiogram"] for result in results):
+        errors.append("aiogram was imported before any payment")
+    statuses = {result["status"] for result in results}
+    if statuses != {200}:
+        errors.append(f"first request to {FIRST_PATH} answered {statuses}")
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="reuse an existing PostgreSQL")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", choices=SCALES, default="10k",
+                        help="data loaded into the in-memory indexes")
+    parser.add_argument("--max-import-ms", type=float, default=2000)
+    parser.add_argument("--max-first-response-ms", type=float, default=5000)
+    args = parser.parse_args()
+
+    with temporary_postgres(args.url) as url:
+        prepare_schema(url)
+        asyncio.run(_seed(url, args.scale))
+        errors = _run(args, url)
+    for error in errors:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""One cold start, as run by benchmarks.startup in a fresh interpreter.
+
+Imports main, builds the app, runs its lifespan startup and sends a first
+request over ASGI, then prints the phase timings as one JSON line. Only the
+standard library is imported before main, so nothing is preloaded for it.
+
+    python -m benchmarks.startup_worker postgresql+asyncpg://...
+"""
+import asyncio
+import json
+import sys
+import time
+
+FIRST_PATH = "/user/1"
+
+
+async def _lifespan(app, received: asyncio.Queue,
+                    sent: asyncio.Queue) -> None:
+    scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}
+    await app(scope, received.get, sent.put)
+
+
+async def _get(app, path: str) -> int:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]["status"]
+
+
+async def _run(url: str) -> None:
+    timings = {}
+    started = time.perf_counter()
+    import main
+    from database import Database
+    from services import Services
+    timings["import"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    app = main.create_app(Services(database=Database(url)))
+    timings["create_app"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    received, sent = asyncio.Queue(), asyncio.Queue()
+    lifespan = asyncio.create_task(_lifespan(app, received, sent))
+    await received.put({"type": "lifespan.startup"})
+    message = await sent.get()
+    if message["type"] != "lifespan.startup.complete":
+        raise RuntimeError(f"startup failed: {message}")
+    timings["startup"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    status = await _get(app, FIRST_PATH)
+    timings["first_response"] = time.perf_counter() - started
+    # Reported before shutting down so the parent can stop its clock
+    result = {
+        "timings": timings,
+        "status": status,
+        "aiogram": "aiogram" in sys.modules,
+    }
+    print(json.dumps(result), flush=True)
+
+    await received.put({"type": "lifespan.shutdown"})
+    await sent.get()
+    await lifespan
+
+
+def main() -> None:
+    asyncio.run(_run(sys.argv[1]))
+
+
+if __name__ == "__main__":
+    main()
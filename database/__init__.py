@@ -1 +1 @@
-from .database import Database
+from .database import Database, DatabaseSettings
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import AsyncContextManager, Callable, Optional
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.partitions import add_months, month_start
+from database.repository.game_repo import GameRepository
+
+logger = logging.getLogger(__name__)
+
+# Monthly games partitions are created this many months in advance
+PARTITION_MONTHS_AHEAD = 2
+
+SessionFactory = Callable[[], AsyncContextManager[AsyncSession]]
+
+
+class GameArchiver:
+    """Background maintenance of the partitioned games table.
+
+    Every ``interval`` seconds it creates the coming months' partitions,
+    moves games settled and created more than ``retention`` ago to
+    games_archive, and drops the old partitions that leaves empty. Games
+    move in batches of ``batch_size``, each in its own short transaction
+    with ``batch_pause`` seconds between them, so row locks are held
+    briefly. Partition DDL gives up quickly when the table is busy and is
+    retried on the next run. Without a ``retention`` nothing is archived.
+    """
+
+    def __init__(self,
+                 session_factory: SessionFactory,
+                 retention: Optional[timedelta] = None,
+                 interval: float = 3600,
+                 batch_size: int = 1000,
+                 batch_pause: float = 0.1) -> None:
+        self._session_factory = session_factory
+        self._retention = retention
+        self._interval = interval
+        self._batch_size = batch_size
+        self._batch_pause = batch_pause
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.runs = 0
+        self.archived = 0
+        self.failures = 0
+        self.created_partitions: list[str] = []
+        self.dropped_partitions: list[str] = []
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop after the current batch rather than in the middle of it."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def run_once(self, now: Optional[datetime] = None) -> int:
+        """One maintenance pass; returns the number of games archived."""
+        now = datetime.now() if now is None else now
+        try:
+            async with self._session_factory() as session:
+                self.created_partitions += await GameRepository(
+                    session).create_partitions(
+                        now,
+                        add_months(month_start(now), PARTITION_MONTHS_AHEAD))
+        except DBAPIError:
+            # Usually the lock timeout; rows land in games_default meanwhile
+            # and move to their partition once it is created
+            logger.warning('Could not create games partitions', exc_info=True)
+        if self._retention is None:
+            return 0
+
+        cutoff = now - self._retention
+        archived = 0
+        after_id = None
+        while not self._closing:
+            async with self._session_factory() as session:
+                ids = await GameRepository(session).archive_games(
+                    cutoff, after_id, self._batch_size)
+            archived += len(ids)
+            self.archived += len(ids)
+            if len(ids) < self._batch_size:
+                break
+            after_id = ids[-1]
+            await asyncio.sleep(self._batch_pause)
+
+        try:
+            async with self._session_factory() as session:
+                self.dropped_partitions += await GameRepository(
+                    session).drop_archived_partitions(cutoff)
+        except DBAPIError:
+            logger.warning('Could not drop archived games partitions',
+                           exc_info=True)
+        return archived
+
+    def stats(self) -> dict:
+        return {
+            "retention_days": None if self._retention is None else
+                              self._retention / timedelta(days=1),
+            "runs": self.runs,
+            "archived": self.archived,
+            "failures": self.failures,
+            "created_partitions": self.created_partitions,
+            "dropped_partitions": self.dropped_partitions,
+        }
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                archived = await self.run_once()
+                self.runs += 1
+                if archived:
+                    logger.info('Archived %d games', archived)
+            except Exception:
+                self.failures += 1
+                logger.exception('Games maintenance failed')
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
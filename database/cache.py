@@ -0,0 +1,186 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+TASKS_KEY = 'tasks:all'
+TOP_10_KEY = 'leaderboard:top_10'
+
+MISSING = object()
+
+
+def user_key(user_id: int) -> str:
+    return f'user:{user_id}'
+
+
+def user_tasks_key(user_id: int) -> str:
+    """Key of the ids of the tasks a user has finished."""
+    return f'user:{user_id}:tasks'
+
+
+def user_keys(user_ids: Iterable[int], leaderboard=None) -> list[str]:
+    """Cache keys to drop after the given users' rows changed.
+
+    The top 10 is only dropped when one of the users is in it, which needs
+    a loaded ranking; without one it is always dropped. Call this after the
+    ranking itself has been updated.
+    """
+    user_ids = set(user_ids)
+    keys = [user_key(user_id) for user_id in user_ids]
+    if leaderboard is None or not leaderboard.loaded or any(
+            user_id in user_ids for user_id, _ in leaderboard.top(10)):
+        keys.append(TOP_10_KEY)
+    return keys
+
+
+class CacheBackend(ABC):
+    """Storage for cached values.
+
+    Values are plain dicts and lists of column values, so a networked store
+    such as Redis can implement this by serializing them.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Any:
+        """Return the value or ``MISSING``."""
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, *keys: str) -> None:
+        ...
+
+    @abstractmethod
+    async def clear(self) -> None:
+        ...
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU with per-entry expiry."""
+
+    def __init__(self, maxsize: int = 100_000) -> None:
+        self._maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+
+
+class ReadThroughCache:
+    """Read-through cache with single-flight loads.
+
+    Concurrent misses for one key share a single loader call, so an expired
+    hot key triggers one query rather than a stampede. A load that races
+    with an invalidation of its key is returned but not stored. If the
+    request running the load is cancelled, the others waiting for it are
+    not: one of them runs the load again.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float = 30.0) -> None:
+        self._backend = backend
+        self._ttl = ttl
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._stale: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    async def get_or_load(self,
+                          key: str,
+                          loader: Callable[[], Awaitable[Any]],
+                          ttl: Optional[float] = None) -> Any:
+        value = await self._backend.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        while (inflight := self._inflight.get(key)) is not None:
+            # Waits for the load however it ends, and only raises if this
+            # request is cancelled itself
+            await asyncio.wait([inflight])
+            if not inflight.cancelled():
+                return inflight.result()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            self.loads += 1
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as error:
+            future.set_exception(error)
+            # Nobody may be waiting; mark the exception as retrieved
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+            stale = key in self._stale
+            self._stale.discard(key)
+        if not stale:
+            await self._backend.set(key, value,
+                                    self._ttl if ttl is None else ttl)
+        future.set_result(value)
+        return value
+
+    async def invalidate(self, *keys: str) -> None:
+        self.invalidations += len(keys)
+        for key in keys:
+            if key in self._inflight:
+                self._stale.add(key)
+        await self._backend.delete(*keys)
+
+    async def clear(self) -> None:
+        self._stale.update(self._inflight)
+        await self._backend.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "evictions": getattr(self._backend, 'evictions', 0),
+            "size": len(self._backend) if hasattr(self._backend,
+                                                  '__len__') else None,
+        }
+
+
+def snapshot(instance) -> dict:
+    """Column values of an ORM instance, safe to share between sessions."""
+    return {
+        column.key: getattr(instance, column.key)
+        for column in instance.__table__.columns
+    }
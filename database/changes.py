@@ -0,0 +1,387 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Iterable, Iterator, Optional
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.cache import (TASKS_KEY, ReadThroughCache, user_keys,
+                            user_tasks_key)
+from database.events import EventHub
+from database.matchmaking import OpenGame, OpenGameBook
+from database.ranking import Leaderboard
+from database.task_board import TaskBoard
+from models.events import encode_event
+from models.rows import TaskRow
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'api_changes'
+# application_name of the listening connections, to find them in
+# pg_stat_activity
+LISTENER_NAME = 'api_lab change listener'
+# NOTIFY rejects payloads of 8000 bytes or more
+MAX_PAYLOAD = 7900
+# Propagation latencies kept for the percentiles in stats()
+LATENCY_SAMPLES = 1000
+
+_NOTIFY = text('SELECT pg_notify(:channel, payload) '
+               'FROM unnest(CAST(:payloads AS text[])) '
+               'WITH ORDINALITY AS payloads (payload, position) '
+               'ORDER BY position')
+# Queued in place of a notification to reload everything
+_RESYNC = object()
+
+Resync = Callable[[], Awaitable[None]]
+
+
+class Change:
+    """What one transaction changed in the state workers keep in memory.
+
+    Repositories fill it in before committing and hand it to
+    ``ChangeFeed.publish``, which sends it with the commit.
+    """
+
+    __slots__ = ('ops', )
+
+    def __init__(self) -> None:
+        self.ops: list[list] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.ops)
+
+    def user(self, user_id: int, won_games: Optional[int] = None) -> None:
+        """The user's row changed, and their won games if given."""
+        self.ops.append(['user', user_id, won_games])
+
+    def user_tasks(self, user_id: int) -> None:
+        """The user finished a task."""
+        self.ops.append(['user_tasks', user_id])
+
+    def game_opened(self, game: OpenGame) -> None:
+        self.ops.append([
+            'game_opened', game.id, game.user_id, game.bet,
+            _isoformat(game.created_at)
+        ])
+
+    def game_closed(self, game_id: int) -> None:
+        self.ops.append(['game_closed', game_id])
+
+    def task_saved(self, task: TaskRow) -> None:
+        self.ops.append([
+            'task_saved', task.id, task.name,
+            _isoformat(task.expired_at), task.reward, task.repeat_count,
+            _isoformat(task.created_at)
+        ])
+
+    def task_taken(self, task_id: int, repeat_count: int) -> None:
+        """A repeat of the task was taken, leaving ``repeat_count``."""
+        self.ops.append(['task_taken', task_id, repeat_count])
+
+    def task_removed(self, task_id: int) -> None:
+        self.ops.append(['task_removed', task_id])
+
+    def event(self, topics: Iterable[str], event) -> None:
+        """Push ``event`` to the other workers' subscribers of ``topics``."""
+        # Encoded only if the change is published
+        self.ops.append(['event', list(topics), event])
+
+    def encoded(self) -> Iterator[str]:
+        """Each change as JSON."""
+        for op in self.ops:
+            if op[0] == 'event':
+                name, data = encode_event(op[2])
+                yield json.dumps(['event', op[1], name, data.decode()],
+                                 separators=(',', ':'))
+            else:
+                yield json.dumps(op, separators=(',', ':'))
+
+
+class ChangeFeed:
+    """Keeps the in-memory state of several workers in step through
+    PostgreSQL LISTEN/NOTIFY.
+
+    A repository publishes its ``Change`` inside the transaction that made
+    it, so other workers get it when that transaction commits and never if
+    it rolls back. Every worker listens on a dedicated asyncpg connection
+    and applies the changes of the others, in commit order, to its
+    leaderboard, open games, task board and cache, and relays their push
+    events to its own subscribers.
+
+    Notifications sent while a listener is disconnected are lost, so after
+    each (re)connect ``resync`` is called to clear the cache and reload the
+    indexes, and changes arriving meanwhile are applied after it. Until it
+    reconnects the worker serves what it has, with cached rows at most the
+    cache TTL old. A dead connection is noticed within ``ping_interval``.
+    """
+
+    def __init__(self,
+                 dsn: str,
+                 resync: Resync,
+                 leaderboard: Optional[Leaderboard] = None,
+                 open_games: Optional[OpenGameBook] = None,
+                 task_board: Optional[TaskBoard] = None,
+                 cache: Optional[ReadThroughCache] = None,
+                 events: Optional[EventHub] = None,
+                 channel: str = CHANNEL,
+                 connect_timeout: float = 10,
+                 reconnect_delay: float = 1.0,
+                 ping_interval: float = 10.0) -> None:
+        # Tells this worker's own notifications apart
+        self.origin = uuid.uuid4().hex[:12]
+        self._dsn = dsn
+        self._resync = resync
+        self._leaderboard = leaderboard
+        self._open_games = open_games
+        self._task_board = task_board
+        self._cache = cache
+        self._events = events
+        self._channel = channel
+        self._connect_timeout = connect_timeout
+        self._reconnect_delay = reconnect_delay
+        self._ping_interval = ping_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._synced = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._connection: Optional[asyncpg.Connection] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._applier: Optional[asyncio.Task] = None
+        self._closing = False
+        self._latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.published = 0
+        self.received = 0
+        self.applied = 0
+        self.resyncs = 0
+        self.connects = 0
+        self.failures = 0
+
+    async def publish(self, session: AsyncSession, change: Change) -> None:
+        """Send ``change`` when the session's transaction commits."""
+        if not change:
+            return
+        payloads = self._payloads(change)
+        await session.execute(_NOTIFY, {
+            "channel": self._channel,
+            "payloads": payloads
+        })
+        self.published += len(payloads)
+
+    async def start(self) -> None:
+        """Start listening and wait for the first sync.
+
+        That sync loads the indexes. If the database cannot be reached they
+        are loaded without listening, and synced again once it can.
+        """
+        if self._listener is None:
+            self._applier = asyncio.create_task(self._apply_changes())
+            self._listener = asyncio.create_task(self._listen())
+        await self._synced.wait()
+
+    async def close(self) -> None:
+        self._closing = True
+        self._wakeup.set()
+        if self._listener is not None:
+            await self._listener
+            self._listener = None
+        if self._applier is not None:
+            self._applier.cancel()
+            try:
+                await self._applier
+            except asyncio.CancelledError:
+                pass
+            self._applier = None
+
+    def stats(self) -> dict:
+        connection = self._connection
+        return {
+            "origin": self.origin,
+            "connected": connection is not None,
+            "server_pid": None
+            if connection is None else connection.get_server_pid(),
+            "published": self.published,
+            "received": self.received,
+            "applied": self.applied,
+            "pending": self._queue.qsize(),
+            "resyncs": self.resyncs,
+            "connects": self.connects,
+            "failures": self.failures,
+            "latency_ms": _percentiles(self._latencies),
+        }
+
+    def _payloads(self, change: Change) -> list[str]:
+        head = f'{{"origin":"{self.origin}","sent_at":{time.time()!r},"ops":['
+        payloads = []
+        ops: list[str] = []
+        size = len(head) + 2
+        for encoded in change.encoded():
+            if ops and size + len(encoded) + 1 > MAX_PAYLOAD:
+                payloads.append(head + ','.join(ops) + ']}')
+                ops = []
+                size = len(head) + 2
+            ops.append(encoded)
+            size += len(encoded) + 1
+        payloads.append(head + ','.join(ops) + ']}')
+        return payloads
+
+    async def _listen(self) -> None:
+        fell_back = False
+        while not self._closing:
+            try:
+                await self._listen_once()
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError,
+                    asyncpg.InterfaceError) as error:
+                self.failures += 1
+                logger.warning('Change listener disconnected: %r', error)
+            except Exception:
+                self.failures += 1
+                logger.exception('Change listener failed')
+            if not self._synced.is_set() and not fell_back:
+                # Load the indexes anyway rather than hold up startup
+                fell_back = True
+                self._queue.put_nowait(_RESYNC)
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           self._reconnect_delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _listen_once(self) -> None:
+        connection = await asyncpg.connect(
+            self._dsn,
+            timeout=self._connect_timeout,
+            server_settings={'application_name': LISTENER_NAME})
+
+        def on_termination(connection) -> None:
+            self._wakeup.set()
+
+        connection.add_termination_listener(on_termination)
+        try:
+            await connection.add_listener(self._channel, self._on_notify)
+            self._connection = connection
+            self.connects += 1
+            # Whatever was sent before LISTEN is missed, so reload
+            self._queue.put_nowait(_RESYNC)
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           self._ping_interval)
+                except asyncio.TimeoutError:
+                    pass
+                if self._closing:
+                    break
+                self._wakeup.clear()
+                if connection.is_closed():
+                    raise ConnectionError('Listening connection was closed')
+                # A dead peer is only noticed once something is sent
+                await connection.fetchval('SELECT 1',
+                                          timeout=self._ping_interval)
+        finally:
+            self._connection = None
+            connection.remove_termination_listener(on_termination)
+            connection.terminate()
+
+    def _on_notify(self, connection, pid: int, channel: str,
+                   payload: str) -> None:
+        self.received += 1
+        self._queue.put_nowait(payload)
+
+    async def _apply_changes(self) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                if item is _RESYNC:
+                    await self._resync()
+                    self.resyncs += 1
+                    self._synced.set()
+                else:
+                    await self._apply(json.loads(item))
+            except Exception:
+                self.failures += 1
+                logger.exception('Failed to apply a change')
+
+    async def _apply(self, message: dict) -> None:
+        if message['origin'] == self.origin:
+            # The writer applied it already
+            return
+        user_ids = set()
+        keys = set()
+        events = []
+        for kind, *args in message['ops']:
+            if kind == 'user':
+                user_id, won_games = args
+                user_ids.add(user_id)
+                if won_games is not None and self._leaderboard is not None:
+                    self._leaderboard.update(user_id, won_games)
+            elif kind == 'user_tasks':
+                keys.add(user_tasks_key(args[0]))
+            elif kind == 'game_opened':
+                game_id, user_id, bet, created_at = args
+                if self._open_games is not None and (game_id
+                                                     not in self._open_games):
+                    self._open_games.add(
+                        OpenGame(game_id, user_id, bet,
+                                 _fromisoformat(created_at)))
+            elif kind == 'game_closed':
+                if self._open_games is not None:
+                    self._open_games.remove(args[0])
+            elif kind == 'task_saved':
+                task_id, name, expired_at, reward, repeat_count, created_at = (
+                    args)
+                keys.add(TASKS_KEY)
+                if self._task_board is not None:
+                    self._task_board.add(
+                        TaskRow(task_id, name, _fromisoformat(expired_at),
+                                reward, repeat_count,
+                                _fromisoformat(created_at)))
+            elif kind == 'task_taken':
+                keys.add(TASKS_KEY)
+                if self._task_board is not None:
+                    self._task_board.set_repeat_count(*args)
+            elif kind == 'task_removed':
+                keys.add(TASKS_KEY)
+                if self._task_board is not None:
+                    self._task_board.remove(args[0])
+            elif kind == 'event':
+                events.append(args)
+        if user_ids:
+            # After the ranking is updated, see user_keys
+            keys.update(user_keys(user_ids, self._leaderboard))
+        if keys and self._cache is not None:
+            await self._cache.invalidate(*keys)
+        # Pushed last, so a client refetching on an event reads fresh rows
+        if self._events is not None:
+            for topics, name, data in events:
+                self._events.publish_encoded(topics, name, data.encode())
+        self.applied += 1
+        self._latencies.append(time.time() - message['sent_at'])
+
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return None if value is None else value.isoformat()
+
+
+def _fromisoformat(value: Optional[str]) -> Optional[datetime]:
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def _percentiles(samples: Iterable[float]) -> Optional[dict]:
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+
+    def at(share: float) -> float:
+        return 1000 * ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+    return {
+        "samples": len(ordered),
+        "p50": at(0.5),
+        "p99": at(0.99),
+        "max": 1000 * ordered[-1],
+    }
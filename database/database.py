@@ -1,37 +1,270 @@
+import asyncio
+import itertools
+import time
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional
 
 from environs import Env
-from sqlalchemy import URL
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy import URL, AsyncAdaptedQueuePool, event, make_url, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
 
-from database.repository.user_repo import UserRepository
+
+@dataclass
+class DatabaseSettings:
+    echo: bool = False
+    pool_size: int = 10
+    max_overflow: int = 10
+    pool_recycle: int = 1800
+    pool_pre_ping: bool = True
+    pool_timeout: float = 30
+    connect_timeout: float = 10
+    command_timeout: Optional[float] = None
+    statement_cache_size: int = 100
+    warmup_connections: Optional[int] = None
+
+    @classmethod
+    def from_env(cls, env: Env) -> 'DatabaseSettings':
+        return cls(
+            echo=env.bool('DB_ECHO', cls.echo),
+            pool_size=env.int('DB_POOL_SIZE', cls.pool_size),
+            max_overflow=env.int('DB_MAX_OVERFLOW', cls.max_overflow),
+            pool_recycle=env.int('DB_POOL_RECYCLE', cls.pool_recycle),
+            pool_pre_ping=env.bool('DB_POOL_PRE_PING', cls.pool_pre_ping),
+            pool_timeout=env.float('DB_POOL_TIMEOUT', cls.pool_timeout),
+            connect_timeout=env.float('DB_CONNECT_TIMEOUT',
+                                      cls.connect_timeout),
+            command_timeout=env.float('DB_COMMAND_TIMEOUT',
+                                      cls.command_timeout),
+            # Set to 0 behind pgbouncer in transaction pooling mode
+            statement_cache_size=env.int('DB_STATEMENT_CACHE_SIZE',
+                                         cls.statement_cache_size),
+            warmup_connections=env.int('DB_WARMUP_CONNECTIONS',
+                                       cls.warmup_connections),
+        )
+
+
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that reports how long each checkout waited."""
+
+    on_wait: Optional[Callable[[float], None]] = None
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Checkouts in progress by ticket, oldest first, with their start
+        self._waiting: dict[int, float] = {}
+        self._tickets = itertools.count()
+
+    def oldest_wait(self) -> float:
+        """Seconds the longest running checkout has been waiting, or 0."""
+        if not self._waiting:
+            return 0.0
+        return time.perf_counter() - next(iter(self._waiting.values()))
+
+    def _do_get(self):
+        ticket = next(self._tickets)
+        started = self._waiting[ticket] = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            del self._waiting[ticket]
+            if self.on_wait is not None:
+                self.on_wait(time.perf_counter() - started)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.on_wait = self.on_wait
+        return pool
+
+
+class PoolStats:
+    """Checkout counters and wait times for one engine's pool."""
+
+    def __init__(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+
+        pool = engine.sync_engine.pool
+        pool.on_wait = self.record_wait
+        event.listen(pool, 'connect', self._on_connect)
+        event.listen(pool, 'checkout', self._on_checkout)
+        event.listen(pool, 'checkin', self._on_checkin)
+        event.listen(pool, 'invalidate', self._on_invalidate)
+
+    def record_wait(self, seconds: float) -> None:
+        self.waits += 1
+        self.wait_total += seconds
+        self.wait_last = seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def wait_age(self) -> float:
+        """How long the oldest checkout still waiting has been waiting.
+
+        Unlike the counters of finished waits this rises while the pool is
+        saturated, and drops back as soon as nothing is waiting.
+        """
+        return self._engine.sync_engine.pool.oldest_wait()
+
+    def snapshot(self) -> dict:
+        pool = self._engine.sync_engine.pool
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "connects": self.connects,
+            "checkouts": self.checkouts,
+            "checkins": self.checkins,
+            "invalidations": self.invalidations,
+            "wait_avg_ms": 1000 * self.wait_total / self.waits if self.waits else 0.0,
+            "wait_max_ms": 1000 * self.wait_max,
+            "wait_last_ms": 1000 * self.wait_last,
+            "waiting_ms": 1000 * pool.oldest_wait(),
+        }
+
+    def _on_connect(self, *args) -> None:
+        self.connects += 1
+
+    def _on_checkout(self, *args) -> None:
+        self.checkouts += 1
+
+    def _on_checkin(self, *args) -> None:
+        self.checkins += 1
+
+    def _on_invalidate(self, *args) -> None:
+        self.invalidations += 1
 
 
 class Database:
-    def __init__(self):
+    def __init__(self,
+                 url: Optional[str] = None,
+                 settings: Optional[DatabaseSettings] = None,
+                 replica_url: Optional[str] = None):
         env = Env()
         env.read_env('.env')
+        if url is None:
+            url = self._url_from_env(env, env.str('POSTGRES_HOST'))
+            replica_host = env.str('POSTGRES_REPLICA_HOST', None)
+            if replica_url is None and replica_host:
+                replica_url = self._url_from_env(env, replica_host)
+        self._url = url
+        self._settings = settings or DatabaseSettings.from_env(env)
+
+        self._engine = self._create_engine(self._url)
+        self._async_session_local = async_sessionmaker(
+            bind=self._engine,
+            class_=AsyncSession,
+            expire_on_commit=False
+        )
+        self._pool_stats = PoolStats(self._engine)
+
+        self._replica_engine: Optional[AsyncEngine] = None
+        self._replica_session_local = self._async_session_local
+        self._replica_pool_stats: Optional[PoolStats] = None
+        if replica_url is not None:
+            self._replica_engine = self._create_engine(replica_url)
+            self._replica_session_local = async_sessionmaker(
+                bind=self._replica_engine,
+                class_=AsyncSession,
+                expire_on_commit=False
+            )
+            self._replica_pool_stats = PoolStats(self._replica_engine)
 
-        self._url = URL.create(
+    @staticmethod
+    def _url_from_env(env: Env, host: str) -> str:
+        return URL.create(
             drivername='postgresql+asyncpg',
             username=env.str('POSTGRES_USER'),
             password=env.str('POSTGRES_PASSWORD'),
-            host=env.str('POSTGRES_HOST'),
+            host=host,
             database=env.str('POSTGRES_DB'),
-            port=5432
+            port=env.int('POSTGRES_PORT', 5432)
         ).render_as_string(hide_password=False)
 
-        self._engine = create_async_engine(
-            self._url,
-            echo=True
-        )
-        self._async_session_local = async_sessionmaker(
-            bind=self._engine,
-            class_=AsyncSession,
-            expire_on_commit=False
+    def _create_engine(self, url: str) -> AsyncEngine:
+        settings = self._settings
+        connect_args = {
+            'timeout': settings.connect_timeout,
+            'prepared_statement_cache_size': settings.statement_cache_size,
+        }
+        if settings.command_timeout is not None:
+            connect_args['command_timeout'] = settings.command_timeout
+        return create_async_engine(
+            url,
+            echo=settings.echo,
+            pool_size=settings.pool_size,
+            max_overflow=settings.max_overflow,
+            pool_recycle=settings.pool_recycle,
+            pool_pre_ping=settings.pool_pre_ping,
+            pool_timeout=settings.pool_timeout,
+            poolclass=_TimedQueuePool,
+            connect_args=connect_args
         )
 
+    @property
+    def engine(self) -> AsyncEngine:
+        return self._engine
+
+    @property
+    def engines(self) -> list[AsyncEngine]:
+        """The primary engine followed by the replica engine, if any."""
+        return list(filter(None, (self._engine, self._replica_engine)))
+
+    @property
+    def dsn(self) -> str:
+        """URL of the primary for connecting with asyncpg directly."""
+        url = make_url(self._url).set(drivername='postgresql')
+        return url.render_as_string(hide_password=False)
+
+    @property
+    def settings(self) -> DatabaseSettings:
+        return self._settings
+
     @asynccontextmanager
     async def get_session(self):
         async with self._async_session_local() as session:
             yield session
+
+    @asynccontextmanager
+    async def get_read_session(self):
+        """Session for read-only queries, served by the replica if configured."""
+        if self._replica_engine is None:
+            async with self.get_session() as session:
+                yield session
+            return
+        async with self._replica_session_local() as session:
+            yield session
+
+    async def warmup(self) -> None:
+        """Open pooled connections up front so first requests skip connecting."""
+        count = self._settings.warmup_connections
+        if count is None:
+            count = self._settings.pool_size
+        for engine in self.engines:
+            await asyncio.gather(*(self._ping(engine) for _ in range(count)))
+
+    async def dispose(self) -> None:
+        await self._engine.dispose()
+        if self._replica_engine is not None:
+            await self._replica_engine.dispose()
+
+    def pool_wait(self) -> float:
+        """Seconds the oldest pending primary checkout has been waiting."""
+        return self._pool_stats.wait_age()
+
+    def pool_stats(self) -> dict:
+        stats = {"primary": self._pool_stats.snapshot()}
+        if self._replica_pool_stats is not None:
+            stats["replica"] = self._replica_pool_stats.snapshot()
+        return stats
+
+    @staticmethod
+    async def _ping(engine: AsyncEngine) -> None:
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
@@ -0,0 +1,212 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from models.events import encode_event
+
+GAMES_TOPIC = 'games'
+# Subscribers served per event loop turn; a broadcast to many connections
+# is spread over several turns so requests keep being served meanwhile
+FANOUT_CHUNK = 200
+
+
+def user_topic(user_id: int) -> str:
+    """Topic of the events that concern one user."""
+    return f'user:{user_id}'
+
+
+@dataclass(slots=True, frozen=True)
+class Message:
+    """One event, framed once for every subscriber."""
+    # WebSocket text frame: {"event": ..., "data": ...}
+    text: str
+    # Server-sent event
+    sse: bytes
+
+
+def _message(name: str, data: bytes) -> Message:
+    return Message(
+        text=f'{{"event":"{name}","data":{data.decode()}}}',
+        sse=b'event: ' + name.encode() + b'\ndata: ' + data + b'\n\n')
+
+
+class Subscription:
+    """A connection's bounded queue of pending messages.
+
+    A subscriber that falls ``max_queue`` messages behind is closed rather
+    than buffered without limit; its client should reconnect and refetch
+    the state it missed over REST.
+    """
+
+    __slots__ = ('topics', '_hub', '_queue', '_max_queue', '_ready',
+                 'closed', 'lagging')
+
+    def __init__(self, hub: 'EventHub', topics: tuple[str, ...],
+                 max_queue: int) -> None:
+        self.topics = topics
+        self._hub = hub
+        self._queue: deque[Message] = deque()
+        self._max_queue = max_queue
+        self._ready = asyncio.Event()
+        self.closed = False
+        self.lagging = False
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Message]:
+        """The next message, or None once closed.
+
+        Raises ``TimeoutError`` if nothing arrives within ``timeout``.
+        """
+        async with asyncio.timeout(timeout):
+            while not self._queue and not self.closed:
+                self._ready.clear()
+                await self._ready.wait()
+        if self.closed:
+            return None
+        return self._queue.popleft()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._ready.set()
+        self._hub._unsubscribe(self)
+
+    def _push(self, message: Message) -> bool:
+        """Queue ``message``; False if that closed a lagging subscriber."""
+        if len(self._queue) >= self._max_queue:
+            self.lagging = True
+            self.close()
+            return False
+        self._queue.append(message)
+        self._ready.set()
+        return True
+
+
+class EventHub:
+    """In-process pub/sub between repository writes and push connections.
+
+    Repositories publish after their transaction commits. Each event is
+    encoded once however many connections receive it, and publishing never
+    waits on a connection: events are queued and handed out
+    ``FANOUT_CHUNK`` subscribers at a time, in publishing order. Writes made
+    by other workers only arrive when a ``ChangeFeed`` relays them.
+    """
+
+    def __init__(self,
+                 max_subscribers: int = 50_000,
+                 max_queue: int = 100) -> None:
+        self._max_subscribers = max_subscribers
+        self._max_queue = max_queue
+        self._topics: dict[str, set[Subscription]] = {}
+        self._subscribers = 0
+        # (subscribers, message, index of the next one to serve)
+        self._pending: deque[tuple[tuple[Subscription, ...], Message,
+                                   int]] = deque()
+        self._scheduled = False
+        self.published = 0
+        self.delivered = 0
+        self.lagging = 0
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return self._subscribers
+
+    @property
+    def accepting(self) -> bool:
+        return self._subscribers < self._max_subscribers
+
+    def subscribe(self, *topics: str) -> Optional[Subscription]:
+        """Subscribe to ``topics``; None when the hub is at capacity."""
+        if not self.accepting:
+            self.rejected += 1
+            return None
+        subscription = Subscription(self, topics, self._max_queue)
+        for topic in topics:
+            self._topics.setdefault(topic, set()).add(subscription)
+        self._subscribers += 1
+        return subscription
+
+    def publish(self, topics: Iterable[str], event) -> None:
+        targets = self._targets(topics)
+        if targets:
+            self._enqueue(targets, _message(*encode_event(event)))
+
+    def publish_encoded(self, topics: Iterable[str], name: str,
+                        data: bytes) -> None:
+        """Publish an event already encoded with ``encode_event``, such as
+        one relayed from another worker."""
+        targets = self._targets(topics)
+        if targets:
+            self._enqueue(targets, _message(name, data))
+
+    def close(self) -> None:
+        """Close every subscription, ending their connections."""
+        self._pending.clear()
+        for subscription in set().union(*self._topics.values()):
+            subscription.close()
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": self._subscribers,
+            "max_subscribers": self._max_subscribers,
+            "topics": len(self._topics),
+            "published": self.published,
+            "delivered": self.delivered,
+            "lagging": self.lagging,
+            "rejected": self.rejected,
+        }
+
+    def _targets(self, topics: Iterable[str]) -> tuple[Subscription, ...]:
+        subscribers = [self._topics[topic] for topic in topics
+                       if topic in self._topics]
+        if not subscribers:
+            return ()
+        # A subscriber of several of the topics gets the event once
+        if len(subscribers) == 1:
+            return tuple(subscribers[0])
+        return tuple(set().union(*subscribers))
+
+    def _enqueue(self, targets: tuple[Subscription, ...],
+                 message: Message) -> None:
+        self._pending.append((targets, message, 0))
+        self.published += 1
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._fan_out)
+
+    def _fan_out(self) -> None:
+        budget = FANOUT_CHUNK
+        while self._pending and budget > 0:
+            targets, message, start = self._pending[0]
+            end = min(start + budget, len(targets))
+            for index in range(start, end):
+                subscription = targets[index]
+                if subscription.closed:
+                    continue
+                if subscription._push(message):
+                    self.delivered += 1
+                else:
+                    self.lagging += 1
+            budget -= end - start
+            if end < len(targets):
+                self._pending[0] = (targets, message, end)
+            else:
+                self._pending.popleft()
+        if self._pending:
+            asyncio.get_running_loop().call_soon(self._fan_out)
+        else:
+            self._scheduled = False
+
+    def _unsubscribe(self, subscription: Subscription) -> None:
+        for topic in subscription.topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[topic]
+        self._subscribers -= 1
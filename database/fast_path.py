@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from typing import Optional
+
+import asyncpg
+
+from database.cache import ReadThroughCache, user_key
+from database.ranking import Leaderboard
+from database.tables import User
+from database.write_behind import BalanceAccumulator
+from models.rows import UserRow, field_names
+
+logger = logging.getLogger(__name__)
+
+# All of the user's columns, so cached rows look the same as the ORM's
+# snapshots and either path can read what the other stored
+_USER_COLUMNS = [column.name for column in User.__table__.columns]
+_USER_FIELDS = field_names(UserRow)
+
+STATEMENTS = {
+    'user':
+    f'SELECT {", ".join(_USER_COLUMNS)} FROM users WHERE id = $1',
+    # One round trip instead of the ORM path's two
+    'user_place':
+    'SELECT 1 + (SELECT count(*) FROM users AS above '
+    'WHERE above.won_games > users.won_games) '
+    'FROM users WHERE id = $1',
+}
+
+
+async def _prepare(connection: asyncpg.Connection) -> None:
+    # asyncpg keeps a server-side prepared statement per query text on each
+    # connection, reused across checkouts and re-prepared if a migration
+    # changes the table. Running each query once when the connection opens
+    # puts it there before the first request needs it.
+    for query in STATEMENTS.values():
+        await connection.fetch(query, 0)
+
+
+async def _keep(connection: asyncpg.Connection) -> None:
+    # Only prepared SELECTs run outside a transaction, which leave nothing
+    # to reset; asyncpg would otherwise send RESET ALL and more on every
+    # release
+    pass
+
+
+class FastReads:
+    """The hottest single-row reads on raw asyncpg.
+
+    A pool of its own, on the primary, whose connections prepare every
+    query in ``STATEMENTS`` when they connect. A lookup is then one
+    checkout and one round trip, with no session, transaction, statement
+    compilation or ORM instances; rows come back as asyncpg records and
+    become ``UserRow``s. The cache, ranking and pending write-behind
+    balances are used exactly as the repositories use them.
+
+    Prepared statements outlive transactions, so this does not work behind
+    pgbouncer in transaction pooling mode.
+    """
+
+    def __init__(self,
+                 dsn: str,
+                 leaderboard: Optional[Leaderboard] = None,
+                 cache: Optional[ReadThroughCache] = None,
+                 balances: Optional[BalanceAccumulator] = None,
+                 pool_size: int = 10,
+                 connect_timeout: float = 10,
+                 command_timeout: Optional[float] = None,
+                 recycle: float = 1800) -> None:
+        self._dsn = dsn
+        self._leaderboard = leaderboard
+        self._cache = cache
+        self._balances = balances
+        self._pool_size = pool_size
+        self._connect_timeout = connect_timeout
+        self._command_timeout = command_timeout
+        self._recycle = recycle
+        self._pool: Optional[asyncpg.Pool] = None
+        self.queries = 0
+
+    async def start(self) -> None:
+        """Create the pool and open its connections.
+
+        Connections that cannot be opened now are opened on first use.
+        """
+        if self._pool is None:
+            # Connects nothing yet, so it cannot fail on an unreachable
+            # database
+            self._pool = await asyncpg.create_pool(
+                self._dsn,
+                min_size=0,
+                max_size=self._pool_size,
+                max_inactive_connection_lifetime=self._recycle,
+                init=_prepare,
+                reset=_keep,
+                timeout=self._connect_timeout,
+                command_timeout=self._command_timeout)
+        connections = await asyncio.gather(
+            *(self._pool.acquire() for _ in range(self._pool_size)),
+            return_exceptions=True)
+        for connection in connections:
+            if isinstance(connection, Exception):
+                logger.warning('Failed to open a fast path connection: %r',
+                               connection)
+            else:
+                await self._pool.release(connection)
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def get_user(self, user_id: int) -> Optional[UserRow]:
+        """What ``UserRepository.get_user_by_id`` returns, as a row."""
+        if self._cache is None:
+            row = await self._fetch_user(user_id)
+        else:
+            row = await self._cache.get_or_load(
+                user_key(user_id), lambda: self._fetch_user(user_id))
+        if row is None:
+            return None
+        user = UserRow(*(row[name] for name in _USER_FIELDS))
+        if self._balances is not None:
+            user.balance += self._balances.pending(user_id)
+        return user
+
+    async def get_user_place(self, user_id: int) -> Optional[int]:
+        """What ``LeaderboardRepository.get_user_place`` returns."""
+        leaderboard = self._leaderboard
+        if leaderboard is not None and leaderboard.loaded and (
+                user_id in leaderboard):
+            return leaderboard.place(user_id)
+        return await self._fetchval('user_place', user_id)
+
+    def stats(self) -> dict:
+        pool = self._pool
+        return {
+            "size": 0 if pool is None else pool.get_size(),
+            "idle": 0 if pool is None else pool.get_idle_size(),
+            "max_size": self._pool_size,
+            "queries": self.queries,
+        }
+
+    async def _fetch_user(self, user_id: int) -> Optional[dict]:
+        record = await self._fetchrow('user', user_id)
+        return None if record is None else dict(record)
+
+    async def _fetchrow(self, name: str, *args) -> Optional[asyncpg.Record]:
+        self.queries += 1
+        async with self._pool.acquire() as connection:
+            return await connection.fetchrow(STATEMENTS[name], *args)
+
+    async def _fetchval(self, name: str, *args):
+        self.queries += 1
+        async with self._pool.acquire() as connection:
+            return await connection.fetchval(STATEMENTS[name], *args)
@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from typing import AsyncContextManager, Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.cache import MISSING, MemoryCache
+from database.repository.idempotency_repo import IdempotencyRepository
+
+logger = logging.getLogger(__name__)
+
+SessionFactory = Callable[[], AsyncContextManager[AsyncSession]]
+
+
+@dataclass(frozen=True, slots=True)
+class StoredResponse:
+    """A response recorded under an idempotency key.
+
+    Without a status code it is a claim: the first request with the key is
+    still being handled.
+    """
+    fingerprint: bytes
+    status_code: Optional[int] = None
+    headers: tuple[tuple[bytes, bytes], ...] = ()
+    body: bytes = b''
+
+    @property
+    def pending(self) -> bool:
+        return self.status_code is None
+
+
+class KeyReused(Exception):
+    """The key was first used with a different request."""
+
+
+class KeyInProgress(Exception):
+    """Another worker is still handling the first request with the key."""
+
+
+class IdempotencyStore(ABC):
+    """Claims and recorded responses by key, with expiry."""
+
+    @abstractmethod
+    async def claim(self, key: str, fingerprint: bytes,
+                    lease: float) -> Optional[StoredResponse]:
+        """Claim ``key`` for ``lease`` seconds.
+
+        Return None if claimed, else what is stored under the key.
+        """
+
+    @abstractmethod
+    async def complete(self, key: str, response: StoredResponse,
+                       ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def release(self, key: str) -> None:
+        """Drop a claim without recording a response."""
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """In-process store; each worker process has its own keys.
+
+    Recorded responses are kept in a bounded LRU. Claims are kept apart
+    from it, so a burst of new keys cannot evict a claim and let a repeat
+    of its request run while the first is still in flight. A claim only
+    lasts while its request runs, so there are at most as many as
+    requests in flight.
+    """
+
+    def __init__(self, maxsize: int = 100_000) -> None:
+        self._entries = MemoryCache(maxsize)
+        # key -> (claim, lease expiry)
+        self._claims: dict[str, tuple[StoredResponse, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._claims)
+
+    @property
+    def evictions(self) -> int:
+        return self._entries.evictions
+
+    async def claim(self, key: str, fingerprint: bytes,
+                    lease: float) -> Optional[StoredResponse]:
+        claimed = self._claims.get(key)
+        if claimed is not None and claimed[1] > time.monotonic():
+            return claimed[0]
+        stored = await self._entries.get(key)
+        if stored is not MISSING:
+            return stored
+        self._claims[key] = (StoredResponse(fingerprint),
+                             time.monotonic() + lease)
+        return None
+
+    async def complete(self, key: str, response: StoredResponse,
+                       ttl: float) -> None:
+        self._claims.pop(key, None)
+        await self._entries.set(key, response, ttl)
+
+    async def release(self, key: str) -> None:
+        self._claims.pop(key, None)
+
+
+class TableIdempotencyStore(IdempotencyStore):
+    """The idempotency_keys table, shared by every worker and restart.
+
+    Expired records are reclaimed in place, and deleted ``purge_batch`` at
+    a time at most every ``purge_interval`` seconds as keys are claimed.
+    """
+
+    def __init__(self,
+                 session_factory: SessionFactory,
+                 purge_interval: float = 60,
+                 purge_batch: int = 1000) -> None:
+        self._session_factory = session_factory
+        self._purge_interval = purge_interval
+        self._purge_batch = purge_batch
+        self._purged_at = time.monotonic()
+        self.purged = 0
+
+    async def claim(self, key: str, fingerprint: bytes,
+                    lease: float) -> Optional[StoredResponse]:
+        async with self._session_factory() as session:
+            repo = IdempotencyRepository(session)
+            if time.monotonic() - self._purged_at >= self._purge_interval:
+                self._purged_at = time.monotonic()
+                self.purged += await repo.purge_expired(self._purge_batch)
+            row = await repo.claim(key, fingerprint, lease)
+        if row is None:
+            return None
+        return StoredResponse(
+            fingerprint=row.fingerprint,
+            status_code=row.status_code,
+            headers=tuple((name.encode('latin-1'), value.encode('latin-1'))
+                          for name, value in row.headers or ()),
+            body=row.body or b'')
+
+    async def complete(self, key: str, response: StoredResponse,
+                       ttl: float) -> None:
+        headers = [[name.decode('latin-1'),
+                    value.decode('latin-1')]
+                   for name, value in response.headers]
+        async with self._session_factory() as session:
+            await IdempotencyRepository(session).complete(
+                key, response.status_code, headers, response.body, ttl)
+
+    async def release(self, key: str) -> None:
+        async with self._session_factory() as session:
+            await IdempotencyRepository(session).release(key)
+
+
+def storable(status_code: int) -> bool:
+    """Whether a response is final; ones asking to retry are not kept."""
+    return status_code < 500 and status_code != 429
+
+
+class Idempotency:
+    """Runs each keyed request once and answers its repeats from the store.
+
+    Concurrent requests with one key in this process share a single
+    execution, like ``ReadThroughCache`` loads. A repeat on another worker
+    while the first is running raises ``KeyInProgress``; a key reused with
+    a different request body raises ``KeyReused``. Responses that ask the
+    client to retry, and failed executions, release the key instead of
+    being recorded. A claim lapses after ``lease`` seconds in case its
+    worker dies, a recorded response after ``ttl``.
+    """
+
+    def __init__(self,
+                 store: IdempotencyStore,
+                 ttl: float = 86400,
+                 lease: float = 60) -> None:
+        self._store = store
+        self._ttl = ttl
+        self._lease = lease
+        self._inflight: dict[str, tuple[bytes, asyncio.Future]] = {}
+        self.executions = 0
+        self.replays = 0
+        self.coalesced = 0
+        self.conflicts = 0
+
+    async def run(
+        self, key: str, fingerprint: bytes,
+        execute: Callable[[], Awaitable[StoredResponse]]
+    ) -> tuple[StoredResponse, bool]:
+        """The response for ``key``, and whether it was replayed."""
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._check(inflight[0], fingerprint)
+            self.coalesced += 1
+            return await asyncio.shield(inflight[1]), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (fingerprint, future)
+        try:
+            stored = await self._store.claim(key, fingerprint, self._lease)
+            if stored is not None:
+                self._check(stored.fingerprint, fingerprint)
+                if stored.pending:
+                    self.conflicts += 1
+                    raise KeyInProgress(key)
+                self.replays += 1
+                replayed = True
+                response = stored
+            else:
+                replayed = False
+                response = await self._execute(key, fingerprint, execute)
+        except BaseException as error:
+            future.set_exception(error)
+            # Nobody may be waiting; mark the exception as retrieved
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        future.set_result(response)
+        return response, replayed
+
+    def stats(self) -> dict:
+        return {
+            "executions": self.executions,
+            "replays": self.replays,
+            "coalesced": self.coalesced,
+            "conflicts": self.conflicts,
+            "in_flight": len(self._inflight),
+            "size": len(self._store) if hasattr(self._store,
+                                                '__len__') else None,
+        }
+
+    async def _execute(
+            self, key: str, fingerprint: bytes,
+            execute: Callable[[], Awaitable[StoredResponse]]
+    ) -> StoredResponse:
+        self.executions += 1
+        try:
+            response = replace(await execute(), fingerprint=fingerprint)
+        except BaseException:
+            await asyncio.shield(self._store.release(key))
+            raise
+        # The work is done either way; a claim left behind makes repeats
+        # conflict until its lease ends rather than run again
+        try:
+            if storable(response.status_code):
+                await self._store.complete(key, response, self._ttl)
+            else:
+                await self._store.release(key)
+        except Exception:
+            logger.exception('Failed to record response for %r', key)
+        return response
+
+    def _check(self, stored: bytes, fingerprint: bytes) -> None:
+        if stored != fingerprint:
+            self.conflicts += 1
+            raise KeyReused()
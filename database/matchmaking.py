@@ -0,0 +1,115 @@
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional
+
+# Seconds a matched game stays reserved for the player it was matched to
+CLAIM_TTL = 30.0
+
+
+@dataclass(slots=True)
+class OpenGame:
+    id: int
+    user_id: int
+    bet: int
+    created_at: Optional[datetime] = None
+
+
+class OpenGameBook:
+    """Open games indexed by bet size for instant matchmaking.
+
+    Games are kept per bet level in creation order, so a match takes the
+    oldest compatible game. Symbols are never stored, so the book cannot
+    leak a creator's move to an opponent. A claimed game leaves the book
+    until it is finished, deleted, or its claim expires.
+
+    The book only suggests candidates: it is one worker's view, so
+    GameRepository.match_game claims the game in the database as well.
+    """
+
+    def __init__(self, claim_ttl: float = CLAIM_TTL) -> None:
+        self._claim_ttl = claim_ttl
+        self._games: dict[int, OpenGame] = {}
+        self._levels: dict[int, OrderedDict[int, None]] = {}
+        self._bets: list[int] = []
+        self._claims: dict[int, tuple[OpenGame, float]] = {}
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+    def __contains__(self, game_id: int) -> bool:
+        return game_id in self._games or game_id in self._claims
+
+    def load(self, games: Iterable[OpenGame]) -> None:
+        self._games.clear()
+        self._levels.clear()
+        self._bets.clear()
+        self._claims.clear()
+        for game in sorted(games, key=lambda game: game.id):
+            self.add(game)
+        self.loaded = True
+
+    def add(self, game: OpenGame) -> None:
+        self._games[game.id] = game
+        level = self._levels.get(game.bet)
+        if level is None:
+            level = self._levels[game.bet] = OrderedDict()
+            insort(self._bets, game.bet)
+        level[game.id] = None
+
+    def remove(self, game_id: int) -> Optional[OpenGame]:
+        claim = self._claims.pop(game_id, None)
+        if claim is not None:
+            return claim[0]
+        game = self._games.pop(game_id, None)
+        if game is not None:
+            self._unlink(game)
+        return game
+
+    def claim(self,
+              user_id: int,
+              bet: int,
+              tolerance: int = 0) -> Optional[OpenGame]:
+        """Take the best open game within ``tolerance`` of ``bet``.
+
+        Exact bet matches win, then the nearest level, then the oldest game.
+        The player's own games are skipped.
+        """
+        self._release_expired()
+        low = bisect_left(self._bets, bet - tolerance)
+        high = bisect_right(self._bets, bet + tolerance)
+        for level_bet in sorted(self._bets[low:high],
+                                key=lambda level_bet: abs(level_bet - bet)):
+            for game_id in self._levels[level_bet]:
+                game = self._games[game_id]
+                if game.user_id != user_id:
+                    self._games.pop(game_id)
+                    self._unlink(game)
+                    self._claims[game_id] = (game,
+                                             time.monotonic() + self._claim_ttl)
+                    return game
+        return None
+
+    def release(self, game_id: int) -> None:
+        """Return a claimed game to the book."""
+        claim = self._claims.pop(game_id, None)
+        if claim is not None:
+            self.add(claim[0])
+
+    def _release_expired(self) -> None:
+        now = time.monotonic()
+        for game_id in [
+                game_id for game_id, (_, deadline) in self._claims.items()
+                if deadline <= now
+        ]:
+            self.release(game_id)
+
+    def _unlink(self, game: OpenGame) -> None:
+        level = self._levels[game.bet]
+        del level[game.id]
+        if not level:
+            del self._levels[game.bet]
+            del self._bets[bisect_left(self._bets, game.bet)]
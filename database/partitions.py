@@ -0,0 +1,116 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Monthly range partitions are named <table>_YYYY_MM
+_MONTH_SUFFIX = re.compile(r'_(\d{4})_(\d{2})$')
+# Partition DDL locks the parent table; give up rather than queue behind
+# long queries while every other query queues behind the DDL
+LOCK_TIMEOUT = '200ms'
+
+
+def month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f'{table}_{month:%Y_%m}'
+
+
+def default_partition_name(table: str) -> str:
+    return f'{table}_default'
+
+
+async def monthly_partitions(session: AsyncSession,
+                             table: str) -> dict[str, datetime]:
+    """Monthly partitions of ``table``, with the month each one holds."""
+    query = text('SELECT child.relname FROM pg_inherits '
+                 'JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid '
+                 'WHERE pg_inherits.inhparent = CAST(:table AS regclass)')
+    months = {}
+    for name in (await session.scalars(query, {'table': table})).all():
+        match = _MONTH_SUFFIX.search(name)
+        if match is not None:
+            months[name] = datetime(int(match[1]), int(match[2]), 1)
+    return months
+
+
+def _month_bounds(month: datetime) -> tuple[str, str]:
+    return f'{month:%Y-%m-%d}', f'{add_months(month, 1):%Y-%m-%d}'
+
+
+async def create_partitions(session: AsyncSession, table: str, key: str,
+                            first: datetime, last: datetime) -> list[str]:
+    """Create the missing monthly partitions from ``first`` to ``last``.
+
+    ``table`` is partitioned by range of ``key``. Rows of a month that went
+    to the default partition while the month had none are moved into the
+    month's new partition, which could not be created otherwise.
+    """
+    existing = await monthly_partitions(session, table)
+    await session.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+    default = default_partition_name(table)
+    has_default = await session.scalar(
+        text('SELECT to_regclass(:name) IS NOT NULL'), {'name': default})
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = partition_name(table, month)
+        start, end = _month_bounds(month)
+        if name not in existing:
+            if has_default and await session.scalar(
+                    text(f'SELECT EXISTS (SELECT FROM {default} '
+                         f"WHERE {key} >= '{start}' AND {key} < '{end}')")):
+                await _attach_from_default(session, table, key, name, month)
+            else:
+                await session.execute(
+                    text(f'CREATE TABLE IF NOT EXISTS {name} '
+                         f'PARTITION OF {table} '
+                         f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+async def _attach_from_default(session: AsyncSession, table: str, key: str,
+                               name: str, month: datetime) -> None:
+    default = default_partition_name(table)
+    start, end = _month_bounds(month)
+    # Keeps further rows of the month out of the default partition until
+    # the new one is attached
+    await session.execute(
+        text(f'LOCK TABLE {default} IN SHARE ROW EXCLUSIVE MODE'))
+    await session.execute(
+        text(f'CREATE TABLE {name} '
+             f'(LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    await session.execute(
+        text(f'WITH moved AS (DELETE FROM {default} '
+             f"WHERE {key} >= '{start}' AND {key} < '{end}' RETURNING *) "
+             f'INSERT INTO {name} SELECT * FROM moved'))
+    # Builds the table's indexes on the partition and checks that the
+    # default partition holds nothing of the month any more
+    await session.execute(
+        text(f'ALTER TABLE {table} ATTACH PARTITION {name} '
+             f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+
+
+async def drop_empty_partitions(session: AsyncSession, table: str,
+                                before: datetime) -> list[str]:
+    """Drop the monthly partitions that end by ``before`` and hold no rows."""
+    await session.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+    dropped = []
+    for name, month in sorted((await monthly_partitions(session,
+                                                        table)).items()):
+        if add_months(month, 1) > before:
+            continue
+        if await session.scalar(text(f'SELECT NOT EXISTS (SELECT FROM {name})')):
+            await session.execute(text(f'DROP TABLE IF EXISTS {name}'))
+            dropped.append(name)
+    return dropped
@@ -0,0 +1,215 @@
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from math import inf
+from typing import Any, Iterable, Iterator, Optional
+
+
+class RankedList:
+    """Sorted list of keys kept in bounded buckets.
+
+    A Fenwick tree over the bucket lengths gives O(log n) rank and
+    positional lookups; inserts and removals only touch one bucket.
+    """
+
+    _LOAD = 512
+
+    def __init__(self, keys: Iterable[Any] = ()) -> None:
+        self._buckets: list[list[Any]] = []
+        self._maxes: list[Any] = []
+        self._tree: list[int] = []
+        self._len = 0
+        self.reset(keys)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Any]:
+        for bucket in self._buckets:
+            yield from bucket
+
+    def reset(self, keys: Iterable[Any]) -> None:
+        ordered = sorted(keys)
+        self._buckets = [ordered[i:i + self._LOAD]
+                         for i in range(0, len(ordered), self._LOAD)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._len = len(ordered)
+        self._rebuild_tree()
+
+    def add(self, key: Any) -> None:
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._rebuild_tree()
+            return
+
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            pos -= 1
+            self._buckets[pos].append(key)
+        else:
+            insort(self._buckets[pos], key)
+        bucket = self._buckets[pos]
+        self._maxes[pos] = bucket[-1]
+        self._len += 1
+
+        if len(bucket) > 2 * self._LOAD:
+            self._buckets[pos:pos + 1] = [bucket[:self._LOAD],
+                                          bucket[self._LOAD:]]
+            self._maxes[pos:pos + 1] = [bucket[self._LOAD - 1], bucket[-1]]
+            self._rebuild_tree()
+        else:
+            self._tree_add(pos, 1)
+
+    def remove(self, key: Any) -> None:
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            raise KeyError(key)
+        bucket = self._buckets[pos]
+        idx = bisect_left(bucket, key)
+        if idx == len(bucket) or bucket[idx] != key:
+            raise KeyError(key)
+
+        del bucket[idx]
+        self._len -= 1
+        if bucket:
+            self._maxes[pos] = bucket[-1]
+            self._tree_add(pos, -1)
+        else:
+            del self._buckets[pos]
+            del self._maxes[pos]
+            self._rebuild_tree()
+
+    def bisect_left(self, key: Any) -> int:
+        """Number of keys strictly less than ``key``."""
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return self._len
+        return self._prefix(pos) + bisect_left(self._buckets[pos], key)
+
+    def bisect_right(self, key: Any) -> int:
+        """Number of keys less than or equal to ``key``."""
+        pos = bisect_right(self._maxes, key)
+        if pos == len(self._maxes):
+            return self._len
+        return self._prefix(pos) + bisect_right(self._buckets[pos], key)
+
+    def islice(self, start: int, stop: int) -> list[Any]:
+        start = max(start, 0)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+        pos, offset = self._locate(start)
+        items: list[Any] = []
+        for bucket in islice(self._buckets, pos, None):
+            items.extend(bucket[offset:offset + stop - start - len(items)])
+            offset = 0
+            if len(items) >= stop - start:
+                break
+        return items
+
+    def _locate(self, index: int) -> tuple[int, int]:
+        # Fenwick descent: find the bucket holding the key at ``index``.
+        pos = 0
+        remaining = index
+        step = 1 << (len(self._tree).bit_length() - 1) if self._tree else 0
+        while step:
+            nxt = pos + step
+            if nxt <= len(self._tree) and self._tree[nxt - 1] <= remaining:
+                pos = nxt
+                remaining -= self._tree[nxt - 1]
+            step >>= 1
+        return pos, remaining
+
+    def _prefix(self, pos: int) -> int:
+        total = 0
+        while pos > 0:
+            total += self._tree[pos - 1]
+            pos &= pos - 1
+        return total
+
+    def _tree_add(self, pos: int, delta: int) -> None:
+        pos += 1
+        while pos <= len(self._tree):
+            self._tree[pos - 1] += delta
+            pos += pos & -pos
+
+    def _rebuild_tree(self) -> None:
+        tree = [len(bucket) for bucket in self._buckets]
+        for i in range(1, len(tree) + 1):
+            parent = i + (i & -i)
+            if parent <= len(tree):
+                tree[parent - 1] += tree[i - 1]
+        self._tree = tree
+
+
+class Leaderboard:
+    """In-memory ranking of users by ``won_games``.
+
+    Users are ordered by (won_games desc, id asc), which is the order of
+    the top-N listing. Places follow the SQL definition: one plus the
+    number of users with strictly more won games, so ties share a place.
+    """
+
+    def __init__(self) -> None:
+        self._scores: dict[int, int] = {}
+        self._ranks = RankedList()
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._scores
+
+    def load(self, rows: Iterable[tuple[int, int]]) -> None:
+        self._scores = {user_id: won_games or 0 for user_id, won_games in rows}
+        self._ranks.reset((-won_games, user_id)
+                          for user_id, won_games in self._scores.items())
+        self.loaded = True
+
+    def update(self, user_id: int, won_games: int) -> None:
+        old = self._scores.get(user_id)
+        if old == won_games:
+            return
+        if old is not None:
+            self._ranks.remove((-old, user_id))
+        self._scores[user_id] = won_games
+        self._ranks.add((-won_games, user_id))
+
+    def discard(self, user_id: int) -> None:
+        old = self._scores.pop(user_id, None)
+        if old is not None:
+            self._ranks.remove((-old, user_id))
+
+    def won_games(self, user_id: int) -> Optional[int]:
+        return self._scores.get(user_id)
+
+    def place(self, user_id: int) -> Optional[int]:
+        won_games = self._scores.get(user_id)
+        if won_games is None:
+            return None
+        return self._ranks.bisect_left((-won_games, )) + 1
+
+    def top(self, limit: int) -> list[tuple[int, int]]:
+        return [(user_id, -neg_won)
+                for neg_won, user_id in self._ranks.islice(0, limit)]
+
+    def around(self, user_id: int,
+               radius: int) -> Optional[list[tuple[int, int, int]]]:
+        """(place, user_id, won_games) for ``radius`` users either side."""
+        won_games = self._scores.get(user_id)
+        if won_games is None:
+            return None
+        index = self._ranks.bisect_left((-won_games, user_id))
+        window = self._ranks.islice(index - radius, index + radius + 1)
+        return [(self._ranks.bisect_left((neg_won, )) + 1, uid, -neg_won)
+                for neg_won, uid in window]
+
+    def percentile(self, user_id: int) -> Optional[float]:
+        """Share of users, in percent, with fewer won games than the user."""
+        won_games = self._scores.get(user_id)
+        if won_games is None:
+            return None
+        at_least = self._ranks.bisect_right((-won_games, inf))
+        return 100 * (len(self._ranks) - at_least) / len(self._ranks)
@@ -0,0 +1,37 @@
+from typing import Any, Optional
+
+from sqlalchemy import ARRAY, bindparam, column, func
+from sqlalchemy.types import TypeEngine
+
+MAX_BATCH_SIZE = 10_000
+
+# Per-item outcomes reported by the batch methods
+OK = 'ok'
+NOT_FOUND = 'not_found'
+ALREADY_FINISHED = 'already_finished'
+# The game is claimed by another player; see GameRepository.match_game
+CLAIMED = 'claimed'
+FAILED = 'failed'
+
+
+def unnest_table(name: str, **columns: tuple[TypeEngine, list]):
+    """Derived table ``name`` over parallel arrays, one bind per column.
+
+    Unlike a VALUES list this sends a fixed number of parameters however
+    many rows there are, so it is not limited by the protocol's bind limit.
+    """
+    arrays = [
+        bindparam(f'{name}_{key}', values, type_=ARRAY(type_))
+        for key, (type_, values) in columns.items()
+    ]
+    derived = func.unnest(*arrays).table_valued(
+        *(column(key, type_) for key, (type_, _) in columns.items()))
+    return derived.render_derived(name=name)
+
+
+def item_result(status: str, detail: Optional[str] = None,
+                **values: Any) -> dict[str, Any]:
+    result = {"status": status, **values}
+    if detail is not None:
+        result["detail"] = detail
+    return result
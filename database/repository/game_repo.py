@@ -1,102 +1,502 @@
-from typing import Optional, List, Dict, Any
-from sqlalchemy import select, insert, delete
+from datetime import datetime, timedelta
+from typing import (AsyncIterator, Iterator, Optional, List, Any,
+                    Sequence)
+from sqlalchemy import (BIGINT, select, delete, update, case, literal, or_,
+                        and_, func)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.tables import Game, User
+from database.cache import ReadThroughCache, user_keys
+from database.changes import Change, ChangeFeed
+from database.events import GAMES_TOPIC, EventHub, user_topic
+from database.matchmaking import CLAIM_TTL, OpenGame, OpenGameBook
+from database.partitions import create_partitions, drop_empty_partitions
+from database.ranking import Leaderboard
+from database.repository.batch import (ALREADY_FINISHED, CLAIMED, FAILED,
+                                       NOT_FOUND, OK, item_result)
+from database.repository.pagination import (DEFAULT_PAGE_SIZE,
+                                            STREAM_CHUNK_SIZE, keyset_page)
+from database.repository.projection import project, stream_rows, to_rows
+from database.tables import Game, GameArchive, User, UserGameStats
+from models.events import (BalanceChanged, GameCreated, GameDeleted,
+                           GameFinished)
+from models.rows import OpenGameRow
 
 
-def _get_winner(user_symbol: str, enemy_symbol: str) -> Optional[str]:
-    """Return 'user' if user wins, 'enemy' if enemy wins, or 'draw' if it's a tie."""
-    if user_symbol == enemy_symbol:
-        return "draw"
-    if (user_symbol == "rock" and enemy_symbol == "scissors") or \
-       (user_symbol == "scissors" and enemy_symbol == "paper") or \
-       (user_symbol == "paper" and enemy_symbol == "rock"):
-        return "user"  # user wins
-    return "enemy"  # enemy wins
+_CLAIM_TTL = timedelta(seconds=CLAIM_TTL)
+
+# (user symbol, enemy symbol) pairs in which the game creator wins
+_WINNING_PAIRS = {("rock", "scissors"), ("scissors", "paper"),
+                  ("paper", "rock")}
+
+
+def _game_result(enemy_symbol: str):
+    """SQL expression for the game result from the creator's point of view."""
+    winning = [user for user, enemy in _WINNING_PAIRS if enemy == enemy_symbol]
+    return case((Game.symbol == enemy_symbol, "draw"),
+                (Game.symbol.in_(winning), "win"),
+                else_="lose")
+
+
+def _profit(result, bet):
+    """The creator's net winnings from a game with ``result`` and ``bet``."""
+    return case((result == "win", bet), (result == "lose", -bet), else_=0)
+
+
+def _outcome_values(result, bet, sign: int = 1) -> dict[str, Any]:
+    """UserGameStats changes for settling (or, with -1, removing) a game."""
+    return {
+        "wins": UserGameStats.wins + sign * case((result == "win", 1), else_=0),
+        "losses":
+            UserGameStats.losses + sign * case((result == "lose", 1), else_=0),
+        "draws":
+            UserGameStats.draws + sign * case((result == "draw", 1), else_=0),
+        "profit": UserGameStats.profit + sign * _profit(result, bet),
+    }
+
+
+def _game_key(game_id: int, created_at: Optional[datetime] = None) -> list:
+    """Conditions for one game; with its creation time only the partition
+    holding it is read."""
+    conditions = [Game.id == game_id]
+    if created_at is not None:
+        conditions.append(Game.created_at == created_at)
+    return conditions
+
+
+def _settle_query(game_id: int,
+                  enemy_id: int,
+                  enemy_symbol: str,
+                  created_at: Optional[datetime] = None):
+    # Settle the game only while it is open and not claimed by another
+    # player, then pay out both players from the settled row in the same
+    # statement
+    settled = (update(Game).where(
+        *_game_key(game_id, created_at), Game.result == None,
+        or_(Game.claimed_by == None, Game.claimed_by == enemy_id,
+            Game.claimed_at < func.now() - _CLAIM_TTL)).values(
+                                      result=_game_result(enemy_symbol)).
+               returning(Game.id, Game.user_id, Game.bet,
+                         Game.result).cte('settled'))
+    is_user = User.id == settled.c.user_id
+    user_delta = case((settled.c.result == "draw", settled.c.bet),
+                      (settled.c.result == "win", 2 * settled.c.bet),
+                      else_=0)
+    enemy_delta = case((settled.c.result == "win", -settled.c.bet),
+                       (settled.c.result == "lose", settled.c.bet),
+                       else_=0)
+    won = or_(and_(is_user, settled.c.result == "win"),
+              and_(~is_user, settled.c.result == "lose"))
+    stats = update(UserGameStats).where(
+        UserGameStats.user_id == settled.c.user_id).values(
+            **_outcome_values(settled.c.result, settled.c.bet)).cte('stats')
+    return (update(User).where(
+        User.id.in_([settled.c.user_id, enemy_id])).values(
+            balance=User.balance +
+            case((is_user, user_delta), else_=enemy_delta),
+            won_games=User.won_games + case((won, 1), else_=0)).returning(
+                User.id, User.won_games, User.balance,
+                settled.c.id.label('game_id'),
+                settled.c.user_id.label('creator_id'),
+                literal(enemy_id, BIGINT).label('enemy_id'),
+                settled.c.result).add_cte(stats))
 
 
 class GameRepository:
 
-    def __init__(self, session: AsyncSession) -> None:
+    def __init__(self,
+                 session: AsyncSession,
+                 leaderboard: Optional[Leaderboard] = None,
+                 open_games: Optional[OpenGameBook] = None,
+                 cache: Optional[ReadThroughCache] = None,
+                 events: Optional[EventHub] = None,
+                 changes: Optional[ChangeFeed] = None) -> None:
         self._session: AsyncSession = session
+        self._leaderboard = leaderboard
+        self._open_games = open_games
+        self._cache = cache
+        self._events = events
+        self._changes = changes
 
-    async def get_all_games(self) -> list[dict[str, Any]]:
-        query = select(Game, User.name).join(
-            User, Game.user_id == User.id).where(Game.result == None)
+    async def get_all_games(self) -> List[OpenGameRow]:
+        result = await self._session.execute(self._open_games_query())
+        return to_rows(OpenGameRow, result)
+
+    async def get_games_page(
+            self,
+            after_id: Optional[int] = None,
+            limit: int = DEFAULT_PAGE_SIZE) -> List[OpenGameRow]:
+        query = keyset_page(self._open_games_query(), Game.id, after_id, limit)
         result = await self._session.execute(query)
+        return to_rows(OpenGameRow, result)
+
+    def stream_games(
+        self,
+        chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> AsyncIterator[List[OpenGameRow]]:
+        query = self._open_games_query().order_by(Game.id)
+        return stream_rows(self._session, query, OpenGameRow, chunk_size)
+
+    async def load_open_games(self) -> None:
+        query = select(Game.id, Game.user_id, Game.bet,
+                       Game.created_at).where(Game.result == None)
+        result = await self._session.execute(query)
+        self._open_games.load(OpenGame(*row) for row in result.all())
+
+    async def match_game(self,
+                         user_id: int,
+                         bet: int,
+                         tolerance: int = 0) -> Optional[dict[str, Any]]:
+        """Claim the best open game within ``tolerance`` of ``bet``.
 
-        # Each item in `games` is a tuple (Game instance, user_name)
-        games = result.all()
+        The claim is made in the database, so concurrent requests on any
+        worker never get the same game until the claim is ``CLAIM_TTL``
+        old. The open games book only suggests which game to try.
+        """
+        if self._open_games is None or not self._open_games.loaded:
+            return await self._claim_game(user_id, bet, tolerance)
 
-        # Format the results to include user_name with each game
-        return [{
-            "id": game.id,
-            "bet": round(game.bet, 2),
-            "symbol": game.symbol,
-            "result": game.result,
-            "user_id": game.user_id,
-            "user_name": user_name
-        } for game, user_name in games]
+        stale = False
+        while (game := self._open_games.claim(user_id, bet,
+                                              tolerance)) is not None:
+            matched = await self._claim_game(user_id, bet, tolerance, game)
+            if matched is not None:
+                return matched
+            # Settled, deleted or claimed elsewhere since the book saw it
+            self._open_games.remove(game.id)
+            stale = True
+        if stale:
+            # The book was behind the table, so it may miss games as well
+            return await self._claim_game(user_id, bet, tolerance)
+        return None
 
-    async def create_game(self, user_id: int, bet: float,
+    async def _claim_game(
+            self,
+            user_id: int,
+            bet: int,
+            tolerance: int,
+            game: Optional[OpenGame] = None) -> Optional[dict[str, Any]]:
+        """Claim ``game``, or else the best match, if still claimable."""
+        candidate = select(Game.id, Game.created_at).where(
+            Game.result == None, Game.user_id != user_id,
+            or_(Game.claimed_by == None,
+                Game.claimed_at < func.now() - _CLAIM_TTL))
+        if game is None:
+            candidate = candidate.where(
+                Game.bet.between(bet - tolerance, bet + tolerance)).order_by(
+                    func.abs(Game.bet - bet), Game.id)
+        else:
+            candidate = candidate.where(*_game_key(game.id, game.created_at))
+        # Racing claims skip the row rather than wait for it and then find
+        # it taken
+        candidate = candidate.limit(1).with_for_update(
+            skip_locked=True).cte('candidate')
+        claimed = update(Game).where(
+            Game.id == candidate.c.id,
+            Game.created_at == candidate.c.created_at).values(
+                claimed_by=user_id, claimed_at=func.now()).returning(
+                    Game.id, Game.bet, Game.user_id,
+                    Game.created_at).cte('claimed')
+        query = select(claimed.c.id, claimed.c.bet, claimed.c.user_id,
+                       User.name.label('user_name'),
+                       claimed.c.created_at).join(
+                           User, User.id == claimed.c.user_id)
+        row = (await self._session.execute(query)).one_or_none()
+        await self._session.commit()
+        return None if row is None else dict(row._mapping)
+
+    @staticmethod
+    def _open_games_query():
+        return project(OpenGameRow,
+                       Game,
+                       user_name=User.name).join(
+                           User, Game.user_id == User.id).where(
+                               Game.result == None)
+
+    async def create_game(self, user_id: int, bet: int,
                           symbol: str) -> Game | None:
-        correct_bet = round(bet, 2)
-        new_game = Game(user_id=user_id, bet=correct_bet, symbol=symbol)
-        # check if user has enough balance
-        user = await self._session.get(User, user_id)
-        if user.balance < bet:
-            print('Not enough balance')
+        # Debit the bet only if the balance covers it and create the game
+        # from the debited row, all in one statement
+        debit = (update(User).where(User.id == user_id,
+                                    User.balance >= bet).values(
+                                        balance=User.balance -
+                                        bet).returning(
+                                            User.id, User.name,
+                                            User.balance).cte('debit'))
+        stats = insert(UserGameStats).from_select(
+            ['user_id', 'games', 'wins', 'losses', 'draws', 'wagered',
+             'profit'],
+            select(debit.c.id, literal(1), literal(0), literal(0), literal(0),
+                   literal(bet, UserGameStats.wagered.type),
+                   literal(0, UserGameStats.profit.type)))
+        stats = stats.on_conflict_do_update(
+            index_elements=[UserGameStats.user_id],
+            set_={
+                "games": UserGameStats.games + 1,
+                "wagered": UserGameStats.wagered + stats.excluded.wagered,
+            }).cte('stats')
+        query = insert(Game).from_select(
+            ['user_id', 'bet', 'symbol'],
+            select(debit.c.id, literal(bet, Game.bet.type),
+                   literal(symbol, Game.symbol.type))).returning(
+                       *Game.__table__.c,
+                       select(debit.c.name).scalar_subquery().label(
+                           'user_name'),
+                       select(debit.c.balance).scalar_subquery().label(
+                           'balance')).add_cte(stats)
+        row = (await self._session.execute(query)).one_or_none()
+        if row is None:
+            await self._session.rollback()
             return None
-        user.balance -= bet
-        self._session.add(new_game)
+        values = dict(row._mapping)
+        user_name, balance = values.pop('user_name'), values.pop('balance')
+        new_game = Game(**values)
+        open_game = OpenGame(new_game.id, new_game.user_id, new_game.bet,
+                             new_game.created_at)
+        created = GameCreated(new_game.id, bet, user_id, user_name,
+                              new_game.created_at)
+        balance_changed = BalanceChanged(user_id, balance)
+        change = Change()
+        change.game_opened(open_game)
+        change.user(user_id)
+        change.event([GAMES_TOPIC, user_topic(user_id)], created)
+        change.event([user_topic(user_id)], balance_changed)
+        await self._notify(change)
         await self._session.commit()
-        await self._session.refresh(new_game)
+        if self._open_games is not None:
+            self._open_games.add(open_game)
+        if self._cache is not None:
+            await self._cache.invalidate(
+                *user_keys([user_id], self._leaderboard))
+        if self._events is not None:
+            self._events.publish([GAMES_TOPIC, user_topic(user_id)], created)
+            self._events.publish([user_topic(user_id)], balance_changed)
         return new_game
 
-    async def delete_game_by_id(self, game_id: int):
-        game = await self._session.get(Game, game_id)
+    async def delete_game_by_id(self,
+                                game_id: int,
+                                created_at: Optional[datetime] = None):
+        game = (await self._session.scalars(
+            select(Game).where(*_game_key(game_id,
+                                          created_at)))).one_or_none()
         if game is not None:
-            query = delete(Game).where(Game.id == game_id)
-            await self._session.execute(query)
+            deleted = delete(Game).where(
+                *_game_key(game_id, game.created_at)).returning(
+                Game.user_id, Game.bet, Game.result).cte('deleted')
+            query = update(UserGameStats).where(
+                UserGameStats.user_id == deleted.c.user_id).values(
+                    games=UserGameStats.games - 1,
+                    wagered=UserGameStats.wagered - deleted.c.bet,
+                    **_outcome_values(deleted.c.result, deleted.c.bet, -1))
+            await self._session.execute(
+                query, execution_options={"synchronize_session": False})
+            deleted_event = GameDeleted(game.id, game.user_id)
+            change = Change()
+            change.game_closed(game_id)
+            change.event([GAMES_TOPIC, user_topic(game.user_id)],
+                         deleted_event)
+            await self._notify(change)
             await self._session.commit()
+            if self._events is not None:
+                self._events.publish(
+                    [GAMES_TOPIC, user_topic(game.user_id)], deleted_event)
+        if self._open_games is not None:
+            self._open_games.remove(game_id)
         return game
 
-    async def finish_game(self, game_id: int, enemy_id: int,
-                          enemy_symbol: str) -> str:
-        game = await self._session.get(Game, game_id)
-        if game is None:
-            return "Game not found"
-        if game.result:
-            return "Game already finished"
-
-        user_symbol = game.symbol
-        winner = _get_winner(user_symbol, enemy_symbol)
-        enemy = await self._session.get(User, enemy_id)
-        user = await self._session.get(User, game.user_id)
-
-        # Set game result based on winner
-        if winner == "draw":
-            game.result = "draw"
-            user.balance += game.bet
-
-        elif winner == "user":
-            game.result = "win"
-            if user:
-                user.balance += 2 * game.bet
-                enemy.balance -= game.bet
-                user.won_games += 1
-            else:
-                print("User not found for the game")
+    async def finish_game(
+            self,
+            game_id: int,
+            enemy_id: int,
+            enemy_symbol: str,
+            created_at: Optional[datetime] = None) -> Optional[str]:
+        query = _settle_query(game_id, enemy_id, enemy_symbol, created_at)
+        rows = (await self._session.execute(
+            query, execution_options={"synchronize_session": False})).all()
+        if not rows:
+            await self._session.rollback()
+            game = (await self._session.execute(
+                select(Game.result).where(
+                    *_game_key(game_id, created_at)))).one_or_none()
+            if game is not None and game.result is None:
+                # Still open, so another player holds a live claim on it
+                return "Game claimed by another player"
+            if self._open_games is not None:
+                self._open_games.remove(game_id)
+            return None if game is None else "Game already finished"
+        await self._notify(_settled_change([game_id], rows))
+        await self._session.commit()
+        await self._after_settle([game_id], rows)
+        return rows[0].result
+
+    async def finish_games(
+        self, settlements: Sequence[tuple[int, int, str, Optional[datetime]]]
+    ) -> list[dict]:
+        """Settle many games in one transaction.
 
-        elif winner == "enemy":
-            game.result = "lose"
-            if enemy:
-                enemy.balance += game.bet
-                enemy.won_games += 1
+        Each game runs in its own savepoint, so a failing item is reported
+        and rolled back without affecting the rest of the batch. Items are
+        ``(game_id, enemy_id, enemy_symbol, created_at)``; the creation time
+        may be None, at the cost of looking for the game in every partition.
+        """
+        results: list[Optional[dict]] = []
+        settled_rows = []
+        unsettled: dict[int, list[int]] = {}
+        keys = []
+        for index, (game_id, enemy_id, enemy_symbol,
+                    created_at) in enumerate(settlements):
+            query = _settle_query(game_id, enemy_id, enemy_symbol, created_at)
+            try:
+                async with self._session.begin_nested():
+                    rows = (await self._session.execute(
+                        query,
+                        execution_options={"synchronize_session": False
+                                           })).all()
+            except DBAPIError as error:
+                results.append(
+                    item_result(FAILED, str(error.orig), game_id=game_id))
+                continue
+            if rows:
+                results.append(
+                    item_result(OK, game_id=game_id, result=rows[0].result))
+                settled_rows.extend(rows)
             else:
-                print("Enemy user not found")
+                results.append(None)
+                unsettled.setdefault(game_id, []).append(index)
+                keys.append(and_(*_game_key(game_id, created_at)))
+
+        if unsettled:
+            existing = dict((await self._session.execute(
+                select(Game.id, Game.result).where(or_(*keys)))).all())
+            for game_id, indexes in unsettled.items():
+                if game_id not in existing:
+                    status = NOT_FOUND
+                elif existing[game_id] is None:
+                    status = CLAIMED
+                else:
+                    status = ALREADY_FINISHED
+                for index in indexes:
+                    results[index] = item_result(status, game_id=game_id)
+        # Failed and claimed games are still open
+        game_ids = list(dict.fromkeys(
+            result["game_id"] for result in results
+            if result["status"] in (OK, ALREADY_FINISHED, NOT_FOUND)))
+        await self._notify(_settled_change(game_ids, settled_rows))
+        await self._session.commit()
+
+        await self._after_settle(game_ids, settled_rows)
+        return results
+
+    async def rebuild_game_stats(self) -> None:
+        """Recompute user_game_stats from the games and archive in bulk.
+
+        Games created or settled while this runs may be miscounted, so run
+        it with game writes stopped.
+        """
+        games = select(Game.user_id, Game.bet, Game.result).union_all(
+            select(GameArchive.user_id, GameArchive.bet,
+                   GameArchive.result)).subquery('all_games')
+        count = func.count()
+        query = insert(UserGameStats).from_select(
+            ['user_id', 'games', 'wins', 'losses', 'draws', 'wagered',
+             'profit'],
+            select(games.c.user_id, count,
+                   count.filter(games.c.result == "win"),
+                   count.filter(games.c.result == "lose"),
+                   count.filter(games.c.result == "draw"),
+                   func.coalesce(func.sum(games.c.bet), 0),
+                   func.coalesce(
+                       func.sum(_profit(games.c.result, games.c.bet)),
+                       0)).where(games.c.user_id != None).group_by(
+                           games.c.user_id))
+        await self._session.execute(delete(UserGameStats))
+        await self._session.execute(query)
+        await self._session.commit()
+
+    async def create_partitions(self, first: datetime,
+                                last: datetime) -> list[str]:
+        """Create the monthly games partitions from ``first`` to ``last``."""
+        created = await create_partitions(self._session, Game.__tablename__,
+                                          'created_at', first, last)
+        await self._session.commit()
+        return created
+
+    async def archive_games(self,
+                            cutoff: datetime,
+                            after_id: Optional[int] = None,
+                            limit: int = 1000) -> list[int]:
+        """Move up to ``limit`` games settled and created before ``cutoff``.
 
+        Games are taken in id order after ``after_id`` and skipped while
+        another transaction holds them. Returns the moved ids in order.
+        """
+        batch = select(Game.id, Game.created_at).where(
+            Game.result != None, Game.created_at < cutoff)
+        if after_id is not None:
+            batch = batch.where(Game.id > after_id)
+        batch = batch.order_by(Game.id).limit(limit).with_for_update(
+            skip_locked=True).cte('batch')
+        moved = delete(Game).where(
+            Game.id == batch.c.id,
+            Game.created_at == batch.c.created_at).returning(
+                *Game.__table__.c).cte('moved')
+        columns = [column.key for column in GameArchive.__table__.c]
+        query = insert(GameArchive).from_select(
+            columns, select(*(moved.c[column] for column in columns))
+        ).returning(GameArchive.id)
+        ids = sorted((await self._session.scalars(query)).all())
         await self._session.commit()
+        return ids
+
+    async def drop_archived_partitions(self, cutoff: datetime) -> list[str]:
+        """Drop the games partitions emptied by archiving up to ``cutoff``."""
+        dropped = await drop_empty_partitions(self._session,
+                                              Game.__tablename__, cutoff)
+        await self._session.commit()
+        return dropped
+
+    async def _after_settle(self, game_ids: list[int], rows) -> None:
+        if self._open_games is not None:
+            for game_id in game_ids:
+                self._open_games.remove(game_id)
+        if not rows:
+            return
+        if self._leaderboard is not None:
+            for row in rows:
+                self._leaderboard.update(row.id, row.won_games)
+        if self._cache is not None:
+            await self._cache.invalidate(*user_keys(
+                [row.id for row in rows], self._leaderboard))
+        if self._events is not None:
+            for topics, event in _settled_events(rows):
+                self._events.publish(topics, event)
+
+    async def _notify(self, change: Change) -> None:
+        if self._changes is not None:
+            await self._changes.publish(self._session, change)
+
+
+def _settled_events(rows) -> Iterator[tuple[list[str], Any]]:
+    """Push events for the rows returned by settling games."""
+    games = {row.game_id: row for row in rows}
+    for row in games.values():
+        yield ([GAMES_TOPIC,
+                user_topic(row.creator_id),
+                user_topic(row.enemy_id)],
+               GameFinished(row.game_id, row.creator_id, row.enemy_id,
+                            row.result))
+    for row in rows:
+        yield [user_topic(row.id)], BalanceChanged(row.id, row.balance)
+
+
+def _settled_change(game_ids: list[int], rows) -> Change:
+    change = Change()
+    for game_id in game_ids:
+        change.game_closed(game_id)
+    for row in rows:
+        change.user(row.id, row.won_games)
+    for topics, event in _settled_events(rows):
+        change.event(topics, event)
+    return change
 
-        return game.result
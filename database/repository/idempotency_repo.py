@@ -0,0 +1,83 @@
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import Row, delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.tables import IdempotencyKey
+
+
+class IdempotencyRepository:
+    def __init__(self, session: AsyncSession) -> None:
+        self._session: AsyncSession = session
+
+    async def claim(self, key: str, fingerprint: bytes,
+                    lease: float) -> Optional[Row]:
+        """Claim ``key`` for ``lease`` seconds.
+
+        Returns None if this caller now holds the key, otherwise the
+        ``(fingerprint, status_code, headers, body)`` recorded under it; an
+        unset status means another request still holds it. An expired
+        record is reclaimed like a missing one.
+        """
+        stmt = insert(IdempotencyKey).values(
+            key=key,
+            fingerprint=fingerprint,
+            expires_at=func.localtimestamp() + timedelta(seconds=lease))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IdempotencyKey.key],
+            set_={
+                'fingerprint': stmt.excluded.fingerprint,
+                'status_code': None,
+                'headers': None,
+                'body': None,
+                'expires_at': stmt.excluded.expires_at,
+            },
+            where=IdempotencyKey.expires_at <= func.localtimestamp(),
+        ).returning(IdempotencyKey.key)
+        query = select(IdempotencyKey.fingerprint, IdempotencyKey.status_code,
+                       IdempotencyKey.headers, IdempotencyKey.body).where(
+                           IdempotencyKey.key == key)
+        # The record can be purged between the two statements
+        while True:
+            claimed = (await self._session.execute(stmt)).scalar()
+            await self._session.commit()
+            if claimed is not None:
+                return None
+            row = (await self._session.execute(query)).one_or_none()
+            if row is not None:
+                return row
+
+    async def complete(self, key: str, status_code: int, headers: list,
+                       body: bytes, ttl: float) -> None:
+        """Record the response of a claimed key, kept for ``ttl`` seconds."""
+        query = update(IdempotencyKey).where(
+            IdempotencyKey.key == key,
+            IdempotencyKey.status_code.is_(None)).values(
+                status_code=status_code,
+                headers=headers,
+                body=body,
+                expires_at=func.localtimestamp() + timedelta(seconds=ttl))
+        await self._session.execute(
+            query, execution_options={"synchronize_session": False})
+        await self._session.commit()
+
+    async def release(self, key: str) -> None:
+        """Give up a claim so the next request with the key runs again."""
+        query = delete(IdempotencyKey).where(
+            IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None))
+        await self._session.execute(
+            query, execution_options={"synchronize_session": False})
+        await self._session.commit()
+
+    async def purge_expired(self, limit: int = 1000) -> int:
+        """Delete up to ``limit`` expired records; returns how many."""
+        expired = select(IdempotencyKey.key).where(
+            IdempotencyKey.expires_at <= func.localtimestamp()).limit(limit)
+        query = delete(IdempotencyKey).where(
+            IdempotencyKey.key.in_(expired.scalar_subquery()))
+        result = await self._session.execute(
+            query, execution_options={"synchronize_session": False})
+        await self._session.commit()
+        return result.rowcount
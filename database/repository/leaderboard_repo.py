@@ -1,24 +1,145 @@
-from sqlalchemy import select, func
+from typing import Optional, Sequence
+
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from database.cache import TOP_10_KEY, ReadThroughCache, snapshot
+from database.ranking import Leaderboard
 from database.tables import User
 
 
 class LeaderboardRepository:
-    def __init__(self, session: AsyncSession) -> None:
+    def __init__(self,
+                 session: AsyncSession,
+                 leaderboard: Optional[Leaderboard] = None,
+                 cache: Optional[ReadThroughCache] = None) -> None:
         self._session: AsyncSession = session
+        self._leaderboard = leaderboard
+        self._cache = cache
+
+    @property
+    def _ranking(self) -> Optional[Leaderboard]:
+        if self._leaderboard is not None and self._leaderboard.loaded:
+            return self._leaderboard
+        return None
+
+    async def load_ranking(self) -> None:
+        result = await self._session.execute(select(User.id, User.won_games))
+        self._leaderboard.load(result.tuples())
 
     async def get_leaderboard_top_10(self):
+        if self._cache is None:
+            return await self._get_leaderboard_top_10()
+
+        async def load() -> list[dict]:
+            return [
+                snapshot(user)
+                for user in await self._get_leaderboard_top_10()
+            ]
+
+        rows = await self._cache.get_or_load(TOP_10_KEY, load)
+        return [User(**row) for row in rows]
+
+    async def _get_leaderboard_top_10(self):
+        if self._ranking is None:
+            return await self._get_leaderboard_top_sql(10)
+        ids = [user_id for user_id, _ in self._ranking.top(10)]
+        return await self._get_users_in_order(ids)
+
+    async def get_user_place(self, user_id: int):
+        if self._ranking is not None and user_id in self._ranking:
+            return self._ranking.place(user_id)
+        return await self._get_user_place_sql(user_id)
+
+    async def get_users_around(self, user_id: int, radius: int = 5):
+        if self._ranking is None or user_id not in self._ranking:
+            return await self._get_users_around_sql(user_id, radius)
+        window = self._ranking.around(user_id, radius)
+        result = await self._session.execute(
+            select(User.id, User.name).where(
+                User.id.in_([uid for _, uid, _ in window])))
+        names = dict(result.tuples().all())
+        return [{
+            "place": place,
+            "id": uid,
+            "name": names.get(uid),
+            "won_games": won_games,
+        } for place, uid, won_games in window]
+
+    async def get_user_percentile(self, user_id: int) -> Optional[float]:
+        if self._ranking is not None and user_id in self._ranking:
+            return self._ranking.percentile(user_id)
+        won_games = await self._session.scalar(
+            select(User.won_games).where(User.id == user_id))
+        if won_games is None:
+            return None
+        query = select(func.count(), func.count().filter(
+            User.won_games < won_games)).select_from(User)
+        total, below = (await self._session.execute(query)).one()
+        return 100 * below / total
+
+    async def cross_check(self, user_ids: Sequence[int]) -> list[int]:
+        """Ids whose in-memory place disagrees with the SQL place."""
+        if self._ranking is None:
+            return []
+        return [
+            user_id for user_id in user_ids
+            if self._ranking.place(user_id) != await self._get_user_place_sql(
+                user_id)
+        ]
+
+    async def _get_leaderboard_top_sql(self, limit: int):
         query = (select(User).
-                 order_by(User.won_games.desc()).limit(10))
+                 order_by(User.won_games.desc(), User.id).limit(limit))
         result = await self._session.execute(query)
         return result.scalars().all()
 
-    async def get_user_place(self, user_id: int):
+    async def _get_user_place_sql(self, user_id: int):
+        won_games = await self._session.scalar(
+            select(User.won_games).where(User.id == user_id))
+        if won_games is None:
+            return None
         # Get the count of users with more won games than the target user
-        query = select(func.count()).select_from(User).where(User.won_games >
-                                                             (select(User.won_games).where(
-                                                                 User.id == user_id).scalar_subquery()))
+        query = select(func.count()).select_from(User).where(
+            User.won_games > won_games)
         result = await self._session.execute(query)
-        place = result.scalar()
-        return place + 1 if place is not None else None
+        return result.scalar() + 1
+
+    async def _get_users_around_sql(self, user_id: int, radius: int):
+        won_games = await self._session.scalar(
+            select(User.won_games).where(User.id == user_id))
+        if won_games is None:
+            return None
+        # The user's position in the same order as the ranking's
+        index = await self._session.scalar(
+            select(func.count()).select_from(User).where(
+                or_(User.won_games > won_games,
+                    and_(User.won_games == won_games, User.id < user_id))))
+        start = max(index - radius, 0)
+        rows = (await self._session.execute(
+            select(User.id, User.name, User.won_games).order_by(
+                User.won_games.desc(),
+                User.id).offset(start).limit(index + radius + 1 -
+                                             start))).all()
+        place = await self._session.scalar(
+            select(func.count()).select_from(User).where(
+                User.won_games > rows[0].won_games)) + 1
+        window = []
+        for position, row in enumerate(rows):
+            # Everyone with more won games comes before the first row with
+            # fewer, so its place follows from its position
+            if position and row.won_games != rows[position - 1].won_games:
+                place = start + position + 1
+            window.append({
+                "place": place,
+                "id": row.id,
+                "name": row.name,
+                "won_games": row.won_games,
+            })
+        return window
+
+    async def _get_users_in_order(self, ids: list[int]) -> list[User]:
+        result = await self._session.execute(
+            select(User).where(User.id.in_(ids)))
+        users = {user.id: user for user in result.scalars()}
+        return [users[user_id] for user_id in ids if user_id in users]
@@ -0,0 +1,41 @@
+from typing import Any, AsyncIterator, Optional
+
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 1000
+
+
+def keyset_page(query: Select,
+                key: InstrumentedAttribute,
+                after: Optional[Any],
+                limit: int,
+                descending: bool = False) -> Select:
+    """Restrict ``query`` to the ``limit`` rows following ``after`` on ``key``.
+
+    With ``descending`` the rows run from the highest key down, so ``after``
+    is the lowest key of the previous page.
+    """
+    if descending:
+        if after is not None:
+            query = query.where(key < after)
+        return query.order_by(key.desc()).limit(limit)
+    if after is not None:
+        query = query.where(key > after)
+    return query.order_by(key).limit(limit)
+
+
+async def stream_partitions(session: AsyncSession, query: Select,
+                            chunk_size: int = STREAM_CHUNK_SIZE,
+                            scalars: bool = True) -> AsyncIterator[list]:
+    """Yield ``query`` rows in lists of ``chunk_size`` from a server-side cursor."""
+    query = query.execution_options(yield_per=chunk_size)
+    if scalars:
+        result = await session.stream_scalars(query)
+    else:
+        result = await session.stream(query)
+    async for partition in result.partitions():
+        yield partition
@@ -0,0 +1,41 @@
+from typing import Any, AsyncIterator, Iterable
+
+from sqlalchemy import Select, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.repository.pagination import STREAM_CHUNK_SIZE, stream_partitions
+from models.rows import field_names
+
+
+def project(row_type: type, entity, **expressions: Any) -> Select:
+    """SELECT of the columns behind ``row_type``, in field order.
+
+    Each field is read from the same-named attribute of ``entity`` unless
+    an expression for it is given.
+    """
+    return select(*(expressions[name].label(name) if name in
+                    expressions else getattr(entity, name)
+                    for name in field_names(row_type)))
+
+
+def to_rows(row_type: type, rows: Iterable) -> list:
+    return [row_type(*row) for row in rows]
+
+
+def to_row(row_type: type, instance: Any):
+    """``row_type`` built from the same-named attributes of ``instance``."""
+    return row_type(*(getattr(instance, name)
+                      for name in field_names(row_type)))
+
+
+async def stream_rows(session: AsyncSession,
+                      query: Select,
+                      row_type: type,
+                      chunk_size: int = STREAM_CHUNK_SIZE
+                      ) -> AsyncIterator[list]:
+    async for partition in stream_partitions(session,
+                                             query,
+                                             chunk_size,
+                                             scalars=False):
+        yield to_rows(row_type, partition)
+
@@ -1,28 +1,135 @@
+from dataclasses import asdict
 from datetime import datetime
-from typing import Optional, List
-from sqlalchemy import select, insert, delete
+from typing import Any, AsyncIterator, Optional, List, Sequence
+from sqlalchemy import insert, delete
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from database.cache import TASKS_KEY, ReadThroughCache
+from database.changes import Change, ChangeFeed
+from database.repository.batch import FAILED, OK, item_result
+from database.repository.pagination import (DEFAULT_PAGE_SIZE,
+                                            STREAM_CHUNK_SIZE, keyset_page)
+from database.repository.projection import (project, stream_rows, to_row,
+                                            to_rows)
 from database.tables import Task
+from database.task_board import TaskBoard
+from models.rows import TaskRow
 
 
 class TaskRepository:
-    def __init__(self, session: AsyncSession) -> None:
+    def __init__(self,
+                 session: AsyncSession,
+                 cache: Optional[ReadThroughCache] = None,
+                 task_board: Optional[TaskBoard] = None,
+                 changes: Optional[ChangeFeed] = None) -> None:
         self._session: AsyncSession = session
+        self._cache = cache
+        self._task_board = task_board
+        self._changes = changes
 
-    async def get_all_tasks(self) -> List[Task]:
-        query = select(Task)
+    async def get_all_tasks(self) -> List[TaskRow]:
+        if self._cache is None:
+            return await self._get_all_tasks()
+
+        async def load() -> list[dict]:
+            return [asdict(task) for task in await self._get_all_tasks()]
+
+        rows = await self._cache.get_or_load(TASKS_KEY, load)
+        return [TaskRow(**row) for row in rows]
+
+    async def _get_all_tasks(self) -> List[TaskRow]:
+        query = project(TaskRow, Task)
+        result = await self._session.execute(query)
+        return to_rows(TaskRow, result)
+
+    async def get_tasks_page(self,
+                             after_id: Optional[int] = None,
+                             limit: int = DEFAULT_PAGE_SIZE) -> List[TaskRow]:
+        query = keyset_page(project(TaskRow, Task), Task.id, after_id, limit)
+        result = await self._session.execute(query)
+        return to_rows(TaskRow, result)
+
+    def stream_tasks(
+        self,
+        chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> AsyncIterator[List[TaskRow]]:
+        query = project(TaskRow, Task).order_by(Task.id)
+        return stream_rows(self._session, query, TaskRow, chunk_size)
+
+    async def load_active_tasks(self) -> None:
+        query = project(TaskRow, Task).where(Task.repeat_count > 0,
+                                             Task.expired_at > datetime.now())
         result = await self._session.execute(query)
-        return result.scalars().all()
+        self._task_board.load(to_rows(TaskRow, result))
 
-    async def create_task(self, name: str, expired_at: datetime, reward: float, repeat_count: int = 1) -> Task:
+    async def create_task(self, name: str, expired_at: datetime, reward: int, repeat_count: int = 1) -> Task:
         new_task = Task(name=name, expired_at=expired_at, reward=reward, repeat_count=repeat_count)
         self._session.add(new_task)
-        await self._session.commit()
+        await self._session.flush()
         await self._session.refresh(new_task)
+        row = to_row(TaskRow, new_task)
+        change = Change()
+        change.task_saved(row)
+        await self._notify(change)
+        await self._session.commit()
+        if self._task_board is not None:
+            self._task_board.add(row)
+        if self._cache is not None:
+            await self._cache.invalidate(TASKS_KEY)
         return new_task
 
+    async def create_tasks(self,
+                           tasks: Sequence[dict[str, Any]]) -> list[dict]:
+        """Insert many tasks with one multi-row INSERT ... RETURNING.
+
+        If the database rejects the batch, the tasks are retried in a
+        savepoint each so only the offending items fail.
+        """
+        if not tasks:
+            return []
+        query = insert(Task).returning(Task, sort_by_parameter_order=True)
+        try:
+            async with self._session.begin_nested():
+                created = (await self._session.scalars(query,
+                                                       list(tasks))).all()
+            results = [item_result(OK, task=task) for task in created]
+        except DBAPIError:
+            results = []
+            for values in tasks:
+                try:
+                    async with self._session.begin_nested():
+                        task = await self._session.scalar(
+                            insert(Task).returning(Task), values)
+                    results.append(item_result(OK, task=task))
+                except DBAPIError as error:
+                    results.append(item_result(FAILED, str(error.orig)))
+        change = Change()
+        for result in results:
+            if result["status"] == OK:
+                change.task_saved(to_row(TaskRow, result["task"]))
+        await self._notify(change)
+        await self._session.commit()
+        if self._task_board is not None:
+            for result in results:
+                if result["status"] == OK:
+                    self._task_board.add(to_row(TaskRow, result["task"]))
+        if self._cache is not None:
+            await self._cache.invalidate(TASKS_KEY)
+        return results
+
     async def delete_task(self, task_id: int) -> None:
         query = delete(Task).where(Task.id == task_id)
         await self._session.execute(query)
+        change = Change()
+        change.task_removed(task_id)
+        await self._notify(change)
         await self._session.commit()
+        if self._task_board is not None:
+            self._task_board.remove(task_id)
+        if self._cache is not None:
+            await self._cache.invalidate(TASKS_KEY)
+
+    async def _notify(self, change: Change) -> None:
+        if self._changes is not None:
+            await self._changes.publish(self._session, change)
@@ -1,95 +1,532 @@
-from datetime import datetime
-from typing import Optional, List
-from sqlalchemy import select, update
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import AsyncIterator, NoReturn, Optional, List, Sequence
+from sqlalchemy import (BIGINT, case, delete, exists, func, literal,
+                        select, true, tuple_, update)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import aliased
 
-from database.tables import User, UserTask, Task
+from database.cache import (TASKS_KEY, ReadThroughCache, snapshot, user_key,
+                            user_keys, user_tasks_key)
+from database.changes import Change, ChangeFeed
+from database.events import EventHub, user_topic
+from database.ranking import Leaderboard
+from database.repository.batch import (NOT_FOUND, OK, item_result,
+                                       unnest_table)
+from database.repository.pagination import (DEFAULT_PAGE_SIZE,
+                                            STREAM_CHUNK_SIZE, keyset_page)
+from database.repository.projection import project, stream_rows, to_rows
+from database.tables import (ReferralStats, User, UserGameStats, UserTask,
+                             Task)
 from database.tables.game import Game
+from database.task_board import TaskBoard
+from database.write_behind import BalanceAccumulator
+from models.events import BalanceChanged
+from models.money import MINOR_UNITS
+from models.rows import GameRow, ReferralRow, TaskRow, UserRow
+
+REFERRER_BONUS = 10 * MINOR_UNITS
+REFERRAL_BONUS = 5 * MINOR_UNITS
+# Referral stats are kept for this many levels above each user
+MAX_REFERRAL_DEPTH = 32
+# A page of a user's game history is first looked for this far back, which
+# only reads the latest games partitions
+RECENT_GAMES = timedelta(days=30)
 
 
 class UserRepository:
 
-    def __init__(self, session: AsyncSession) -> None:
+    def __init__(self,
+                 session: AsyncSession,
+                 leaderboard: Optional[Leaderboard] = None,
+                 cache: Optional[ReadThroughCache] = None,
+                 balances: Optional[BalanceAccumulator] = None,
+                 task_board: Optional[TaskBoard] = None,
+                 events: Optional[EventHub] = None,
+                 changes: Optional[ChangeFeed] = None) -> None:
         self._session: AsyncSession = session
+        self._leaderboard = leaderboard
+        self._cache = cache
+        self._balances = balances
+        self._task_board = task_board
+        self._events = events
+        self._changes = changes
 
     async def create_user(self,
                           user_name: str,
                           telegram_id: int,
                           referrer_id: Optional[int] = None) -> User:
         new_user = User(id=telegram_id, name=user_name, balance=0)
+        referrer_balance = None
 
         if referrer_id:
-            referrer = await self.get_user_by_id(referrer_id)
-            if referrer:
+            # An increment in SQL, so concurrent balance changes of the
+            # referrer are not overwritten
+            referrer_balance = await self._session.scalar(
+                update(User).where(User.id == referrer_id).values(
+                    balance=User.balance +
+                    REFERRER_BONUS).returning(User.balance),
+                execution_options={"synchronize_session": False})
+            if referrer_balance is not None:
                 new_user.referrer_id = referrer_id
-                referrer.balance += 10
-                new_user.balance += 5
+                new_user.balance += REFERRAL_BONUS
 
         self._session.add(new_user)
+        if new_user.referrer_id is not None:
+            await self._session.execute(
+                _count_referral_query(new_user.referrer_id))
+        change = Change()
+        change.user(new_user.id, 0)
+        if referrer_balance is not None:
+            _record_balances(change,
+                             [(new_user.referrer_id, referrer_balance)])
+        await self._notify(change)
         await self._session.commit()
         await self._session.refresh(new_user)
+        if self._leaderboard is not None:
+            self._leaderboard.update(new_user.id, new_user.won_games)
+        await self._invalidate_users(new_user.id, new_user.referrer_id)
+        if referrer_balance is not None:
+            self._publish_balances([(new_user.referrer_id, referrer_balance)])
         return new_user
 
-    async def get_all_users(self) -> List[User]:
-        query = select(User)
+    async def get_all_users(self) -> List[UserRow]:
+        query = project(UserRow, User)
+        result = await self._session.execute(query)
+        return to_rows(UserRow, result)
+
+    async def get_users_page(self,
+                             after_id: Optional[int] = None,
+                             limit: int = DEFAULT_PAGE_SIZE) -> List[UserRow]:
+        query = keyset_page(project(UserRow, User), User.id, after_id, limit)
         result = await self._session.execute(query)
-        return result.scalars().all()
+        return to_rows(UserRow, result)
+
+    def stream_users(
+        self,
+        chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> AsyncIterator[List[UserRow]]:
+        query = project(UserRow, User).order_by(User.id)
+        return stream_rows(self._session, query, UserRow, chunk_size)
 
     async def get_user_by_id(self, telegram_id: int) -> Optional[User]:
+        if self._cache is None:
+            user = await self._get_user_by_id(telegram_id)
+        else:
+
+            async def load() -> Optional[dict]:
+                user = await self._get_user_by_id(telegram_id)
+                return None if user is None else snapshot(user)
+
+            row = await self._cache.get_or_load(user_key(telegram_id), load)
+            user = None if row is None else User(**row)
+
+        pending = 0 if self._balances is None else self._balances.pending(
+            telegram_id)
+        if user is not None and pending:
+            # Detach first so the merged balance is never written back
+            if user in self._session:
+                self._session.expunge(user)
+            user.balance += pending
+        return user
+
+    async def _get_user_by_id(self, telegram_id: int) -> Optional[User]:
         query = select(User).where(User.id == telegram_id)
         result = await self._session.execute(query)
         return result.scalar_one_or_none()
 
-    async def get_user_friends(self, user_id: int) -> List[User]:
-        result = await self._session.scalars(
-            select(User).where(User.referrer_id == user_id))
-        friends = result.all()
+    async def get_user_friends(self, user_id: int) -> List[UserRow]:
+        result = await self._session.execute(
+            project(UserRow, User).where(User.referrer_id == user_id))
+        friends = to_rows(UserRow, result)
         return friends
 
-    async def get_user_games(self, user_id: int) -> list:
-        query = select(Game).where(Game.user_id == user_id)
+    async def get_referral_tree(self,
+                                user_id: int,
+                                depth: int = 1,
+                                limit: int = DEFAULT_PAGE_SIZE
+                                ) -> List[ReferralRow]:
+        """Referrals up to ``depth`` levels below the user, level by level."""
+        # Walk no deeper than the per-level counts say fills the page
+        levels = await self._session.execute(
+            select(ReferralStats.depth, ReferralStats.referrals).where(
+                ReferralStats.user_id == user_id,
+                ReferralStats.depth <= depth).order_by(ReferralStats.depth))
+        found = 0
+        for level, referrals in levels:
+            found += referrals
+            if found >= limit:
+                depth = level
+                break
+
+        tree = select(User.id, User.name, User.referrer_id,
+                      literal(1).label('depth')).where(
+                          User.referrer_id == user_id).cte('tree',
+                                                           recursive=True)
+        # A lateral lookup per parent keeps each step on
+        # ix_users_referrer_id_id whatever the planner guesses about the size
+        # of the previous level; ordered, so a parent with more than a page
+        # of children always contributes its lowest ids
+        children = select(User.id, User.name, User.referrer_id).where(
+            User.referrer_id == tree.c.id).order_by(
+                User.id).limit(limit).lateral('children')
+        tree = tree.union_all(
+            select(children.c.id, children.c.name, children.c.referrer_id,
+                   tree.c.depth + 1).select_from(tree).join(
+                       children, true()).where(tree.c.depth < depth))
+        query = select(tree).order_by(tree.c.depth, tree.c.id).limit(limit)
+        result = await self._session.execute(query)
+        return to_rows(ReferralRow, result)
+
+    async def get_referral_stats(self, user_id: int) -> Optional[dict]:
+        """Referral counts and bonuses per level, from the aggregate table."""
+        query = select(ReferralStats.depth, ReferralStats.referrals,
+                       ReferralStats.earnings).where(
+                           ReferralStats.user_id == user_id).order_by(
+                               ReferralStats.depth)
+        levels = (await self._session.execute(query)).all()
+        if not levels and await self._session.scalar(
+                select(User.id).where(User.id == user_id)) is None:
+            return None
+        return {
+            "user_id": user_id,
+            "descendants": sum(level.referrals for level in levels),
+            "earnings": sum(level.earnings for level in levels),
+            "levels": [level._asdict() for level in levels],
+        }
+
+    async def rebuild_referral_stats(self) -> None:
+        """Recompute the referral aggregates from the users table."""
+        chain = select(User.referrer_id.label('ancestor'),
+                       literal(1).label('depth')).where(
+                           User.referrer_id != None).cte('chain',
+                                                         recursive=True)
+        chain = chain.union_all(
+            select(User.referrer_id, chain.c.depth + 1).join(
+                chain, User.id == chain.c.ancestor).where(
+                    User.referrer_id != None,
+                    chain.c.depth < MAX_REFERRAL_DEPTH))
+        count = func.count()
+        await self._session.execute(delete(ReferralStats))
+        await self._session.execute(
+            insert(ReferralStats).from_select(
+                ['user_id', 'depth', 'referrals', 'earnings'],
+                select(chain.c.ancestor, chain.c.depth, count,
+                       case((chain.c.depth == 1, REFERRER_BONUS * count),
+                            else_=0)).group_by(chain.c.ancestor,
+                                               chain.c.depth)))
+        await self._session.commit()
+
+    async def get_user_games(self, user_id: int) -> List[GameRow]:
+        query = _user_games_query(user_id)
         result = await self._session.execute(query)
-        return result.scalars().all()
+        return to_rows(GameRow, result)
+
+    async def get_user_games_page(
+            self,
+            user_id: int,
+            after_id: Optional[int] = None,
+            limit: int = DEFAULT_PAGE_SIZE,
+            after_created_at: Optional[datetime] = None) -> List[GameRow]:
+        """The user's games, oldest first, following the game ``after_id``.
+
+        Given that game's ``after_created_at`` too, the partitions before it
+        are not read.
+        """
+        after, _ = await self._games_after(user_id, after_id,
+                                           after_created_at)
+        query = _user_games_query(user_id).where(*after)
+        return await self._game_rows(
+            query.order_by(Game.created_at, Game.id).limit(limit))
+
+    async def get_user_game_history(
+            self,
+            user_id: int,
+            before_id: Optional[int] = None,
+            limit: int = DEFAULT_PAGE_SIZE,
+            before_created_at: Optional[datetime] = None) -> List[GameRow]:
+        """The user's games, newest first, preceding the game ``before_id``.
+
+        Given that game's ``before_created_at`` too, the partitions after it
+        are not read. Older partitions are read only if the ``RECENT_GAMES``
+        before it, or before now, do not fill the page.
+        """
+        before, before_created_at = await self._games_after(
+            user_id, before_id, before_created_at, descending=True)
+        query = _user_games_query(user_id).where(*before)
+        recent = (datetime.now() if before_created_at is None else
+                  before_created_at) - RECENT_GAMES
+        newest_first = (Game.created_at.desc(), Game.id.desc())
+        games = await self._game_rows(
+            query.where(Game.created_at >= recent).order_by(
+                *newest_first).limit(limit))
+        if len(games) < limit:
+            games += await self._game_rows(
+                query.where(Game.created_at < recent).order_by(
+                    *newest_first).limit(limit - len(games)))
+        return games
+
+    async def get_user_game_stats(self, user_id: int) -> Optional[dict]:
+        query = select(UserGameStats).where(UserGameStats.user_id == user_id)
+        stats = await self._session.scalar(query)
+        if stats is None:
+            if await self._session.get(User, user_id) is None:
+                return None
+            stats = UserGameStats(user_id=user_id, games=0, wins=0, losses=0,
+                                  draws=0, wagered=0, profit=0)
+        return {
+            **snapshot(stats),
+            "open": stats.games - stats.wins - stats.losses - stats.draws,
+        }
+
+    def stream_user_games(
+        self,
+        user_id: int,
+        chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> AsyncIterator[List[GameRow]]:
+        query = _user_games_query(user_id).order_by(Game.created_at, Game.id)
+        return stream_rows(self._session, query, GameRow, chunk_size)
+
+    async def get_user_tasks(self, user_id: int) -> List[TaskRow]:
+        if self._task_board is not None and self._task_board.loaded:
+            return self._task_board.available(
+                await self._finished_task_ids(user_id))
 
-    async def get_user_tasks(self, user_id: int) -> List[Task]:
         completed_task_alias = aliased(UserTask)
 
         # Select tasks not completed by the user
         query = (
-            select(Task).outerjoin(
+            project(TaskRow, Task).outerjoin(
                 completed_task_alias, (completed_task_alias.task_id == Task.id)
                 & (completed_task_alias.user_id == user_id)).where(
                     completed_task_alias.user_id == None, Task.expired_at
                     > datetime.now(), Task.repeat_count
                     > 0)  # Only tasks the user hasn't completed
-        )
+            .order_by(Task.expired_at, Task.id))
 
         result = await self._session.execute(query)
-        return result.scalars().all()
+        return to_rows(TaskRow, result)
+
+    async def _finished_task_ids(self, user_id: int) -> set[int]:
+
+        async def load() -> list[int]:
+            result = await self._session.scalars(
+                select(UserTask.task_id).where(UserTask.user_id == user_id))
+            return list(result)
+
+        if self._cache is None:
+            return set(await load())
+        return set(await self._cache.get_or_load(user_tasks_key(user_id),
+                                                 load))
 
     async def finish_task(self, user_id: int, task_id: int) -> None:
+        """Record a finished task and pay its reward.
+
+        Taking a repeat, recording the completion and crediting the user
+        happen in one statement, so concurrent calls can neither take more
+        repeats than the task has nor pay a user twice for one task.
+        """
+        now = datetime.now()
+        try:
+            claim = (await self._session.execute(
+                _claim_task_query(user_id, task_id, now))).one_or_none()
+        except IntegrityError:
+            # A concurrent finish by the same user, or an unknown user
+            claim = None
+        if claim is None:
+            await self._session.rollback()
+            await self._raise_claim_error(user_id, task_id, now)
+        repeat_count, balance = claim
+
+        change = Change()
+        change.task_taken(task_id, repeat_count)
+        change.user_tasks(user_id)
+        _record_balances(change, [(user_id, balance)])
+        await self._notify(change)
+        await self._session.commit()
+        if self._task_board is not None:
+            self._task_board.set_repeat_count(task_id, repeat_count)
+        if self._cache is not None:
+            await self._cache.invalidate(TASKS_KEY, user_tasks_key(user_id))
+        await self._invalidate_users(user_id)
+        self._publish_balances([(user_id, balance)])
+
+    async def _raise_claim_error(self, user_id: int, task_id: int,
+                                 now: datetime) -> NoReturn:
         task = await self._session.get(Task, task_id)
         if task is None:
             raise ValueError(f"Task with ID {task_id} not found")
 
-        if task.repeat_count <= 0:
-            raise ValueError(f"Task with ID {task_id} has no more repeats")
+        if task.repeat_count <= 0 or task.expired_at <= now:
+            if self._task_board is not None:
+                self._task_board.remove(task_id)
+            if task.repeat_count <= 0:
+                raise ValueError(f"Task with ID {task_id} has no more repeats")
+            raise ValueError(f"Task with ID {task_id} has expired")
 
         user = await self._session.get(User, user_id)
         if user is None:
             raise ValueError(f"User with ID {user_id} not found")
 
-        user_task = UserTask(user_id=user_id, task_id=task_id)
-        self._session.add(user_task)
-
-        user.balance += task.reward
-        task.repeat_count -= 1
+        raise ValueError(
+            f"Task with ID {task_id} is already finished by user {user_id}")
 
+    async def update_user_balance(self, user_id: int, reward: int) -> None:
+        if self._balances is not None:
+            self._balances.add(user_id, reward)
+            return
+        query = update(User).where(User.id == user_id).values(
+            balance=User.balance + reward).returning(User.balance)
+        balance = await self._session.scalar(
+            query, execution_options={"synchronize_session": False})
+        if balance is not None:
+            change = Change()
+            _record_balances(change, [(user_id, balance)])
+            await self._notify(change)
         await self._session.commit()
+        await self._invalidate_users(user_id)
+        if balance is not None:
+            self._publish_balances([(user_id, balance)])
 
-    async def update_user_balance(self, user_id: int, reward: float) -> None:
-        query = update(User).where(User.id == user_id).values(
-            balance=User.balance + reward)
-        await self._session.execute(query)
+    async def update_user_balances(
+            self, adjustments: Sequence[tuple[int, int]]) -> list[dict]:
+        """Apply many balance changes in one statement and one commit.
+
+        Changes for the same user are summed first, as UPDATE ... FROM
+        applies only one joined row to each target row.
+        """
+        if not adjustments:
+            return []
+        totals: dict[int, int] = defaultdict(int)
+        for user_id, reward in adjustments:
+            totals[user_id] += reward
+        # A stable order keeps concurrent batches from deadlocking
+        user_ids = sorted(totals)
+        changes = unnest_table('changes',
+                               id=(BIGINT(), user_ids),
+                               delta=(BIGINT(),
+                                      [totals[user_id] for user_id in user_ids]))
+        query = update(User).where(User.id == changes.c.id).values(
+            balance=User.balance + changes.c.delta).returning(
+                User.id, User.balance)
+        balances = (await self._session.execute(
+            query, execution_options={"synchronize_session": False})).all()
+        updated = {user_id for user_id, _ in balances}
+        change = Change()
+        _record_balances(change, balances)
+        await self._notify(change)
         await self._session.commit()
+        await self._invalidate_users(*updated)
+        self._publish_balances(balances)
+        return [
+            item_result(OK if user_id in updated else NOT_FOUND,
+                        telegram_id=user_id) for user_id, _ in adjustments
+        ]
+
+    async def _invalidate_users(self, *user_ids: Optional[int]) -> None:
+        if self._cache is not None:
+            await self._cache.invalidate(*user_keys(
+                filter(None, user_ids), self._leaderboard))
+
+    def _publish_balances(self, balances: Sequence[tuple[int, int]]) -> None:
+        if self._events is not None:
+            for user_id, balance in balances:
+                self._events.publish([user_topic(user_id)],
+                                     BalanceChanged(user_id, balance))
+
+    async def _games_after(self,
+                           user_id: int,
+                           game_id: Optional[int],
+                           created_at: Optional[datetime],
+                           descending: bool = False
+                           ) -> tuple[list, Optional[datetime]]:
+        """Conditions for the user's games after ``game_id`` in order of
+        creation, or before it if ``descending``, and its creation time."""
+        if game_id is None:
+            return [], None
+        if created_at is None:
+            created_at = await self._session.scalar(
+                select(Game.created_at).where(Game.user_id == user_id,
+                                              Game.id == game_id))
+            if created_at is None:
+                # Deleted since; ids follow creation closely enough
+                return [Game.id < game_id if descending else
+                        Game.id > game_id], None
+        key = tuple_(Game.created_at, Game.id)
+        if descending:
+            return [Game.created_at <= created_at,
+                    key < (created_at, game_id)], created_at
+        return [Game.created_at >= created_at,
+                key > (created_at, game_id)], created_at
+
+    async def _game_rows(self, query) -> List[GameRow]:
+        result = await self._session.execute(query)
+        return to_rows(GameRow, result)
+
+    async def _notify(self, change: Change) -> None:
+        if self._changes is not None:
+            await self._changes.publish(self._session, change)
+
+
+def _record_balances(change: Change,
+                     balances: Sequence[tuple[int, int]]) -> None:
+    for user_id, balance in balances:
+        change.user(user_id)
+        change.event([user_topic(user_id)], BalanceChanged(user_id, balance))
+
+
+def _user_games_query(user_id: int):
+    return project(GameRow, Game).where(
+        Game.user_id == user_id)
+
+
+def _claim_task_query(user_id: int, task_id: int, now: datetime):
+    """Take one repeat of a task for a user and pay its reward.
+
+    Selects the task's remaining repeats and the user's new balance, or
+    nothing if the task is missing, used up, expired or already finished
+    by the user. A finish racing with this one fails on the user_tasks
+    unique constraint.
+    """
+    claimed = update(Task).where(
+        Task.id == task_id, Task.repeat_count > 0, Task.expired_at > now,
+        ~exists().where(UserTask.user_id == user_id,
+                        UserTask.task_id == task_id)).values(
+                            repeat_count=Task.repeat_count - 1).returning(
+                                Task.id, Task.reward, Task.repeat_count,
+                                literal(user_id, BIGINT).label('user_id')
+                            ).cte('claimed')
+    recorded = insert(UserTask).from_select(
+        ['user_id', 'task_id'],
+        select(claimed.c.user_id, claimed.c.id)).cte('recorded')
+    credited = update(User).where(User.id == claimed.c.user_id).values(
+        balance=User.balance + claimed.c.reward).returning(
+            User.id, User.balance).cte('credited')
+    # Postgres runs every data-modifying CTE, referenced or not
+    return select(claimed.c.repeat_count, credited.c.balance).join_from(
+        claimed, credited,
+        credited.c.id == claimed.c.user_id).add_cte(recorded)
+
+
+def _count_referral_query(referrer_id: int):
+    """Add one referral to the referrer and each ancestor above it."""
+    ancestors = select(literal(referrer_id, BIGINT).label('id'),
+                       literal(1).label('depth')).cte('ancestors',
+                                                      recursive=True)
+    ancestors = ancestors.union_all(
+        select(User.referrer_id, ancestors.c.depth + 1).join(
+            ancestors, User.id == ancestors.c.id).where(
+                User.referrer_id != None,
+                ancestors.c.depth < MAX_REFERRAL_DEPTH))
+    query = insert(ReferralStats).from_select(
+        ['user_id', 'depth', 'referrals', 'earnings'],
+        select(ancestors.c.id, ancestors.c.depth, literal(1),
+               case((ancestors.c.depth == 1, REFERRER_BONUS), else_=0)))
+    return query.on_conflict_do_update(
+        index_elements=[ReferralStats.user_id, ReferralStats.depth],
+        set_={
+            "referrals": ReferralStats.referrals + 1,
+            "earnings": ReferralStats.earnings + query.excluded.earnings,
+        })
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from database.repository.batch import (ALREADY_FINISHED, CLAIMED, NOT_FOUND,
+                                       OK)
+
+logger = logging.getLogger(__name__)
+
+# (game_id, enemy_id, enemy_symbol, created_at), as finish_games takes them
+Settlement = tuple[int, int, str, Optional[datetime]]
+Settle = Callable[[list[Settlement]], Awaitable[list[dict]]]
+
+
+class SettlementFailed(Exception):
+    """The database rejected one settlement of a batch."""
+
+
+class SettlementQueue:
+    """Group commit for game settlements.
+
+    ``finish`` queues a settlement and waits for its own result. One
+    background worker takes what is queued, up to ``max_batch`` at a time,
+    waits at most ``max_linger`` seconds for more while the batch is not
+    full, and settles the batch in one transaction through ``settle``
+    (``GameRepository.finish_games``). Under load the next batch fills
+    while the current one commits, so thousands of finishes a second cost
+    a few commits.
+
+    Settlements run one batch at a time in the order they were queued, so
+    of several finishes of one game the first wins and the rest get
+    "Game already finished", as with a transaction per request. A batch
+    that fails as a whole fails every finish in it.
+    """
+
+    def __init__(self,
+                 settle: Settle,
+                 max_batch: int = 500,
+                 max_linger: float = 0.002,
+                 max_pending: int = 100_000) -> None:
+        self._settle = settle
+        self._max_batch = max_batch
+        self._max_linger = max_linger
+        self._queue: asyncio.Queue[tuple[Settlement,
+                                         asyncio.Future]] = asyncio.Queue(
+                                             max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.settled = 0
+        self.failures = 0
+        self.largest_batch = 0
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Settle what is queued, then stop the worker."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def finish(
+            self,
+            game_id: int,
+            enemy_id: int,
+            enemy_symbol: str,
+            created_at: Optional[datetime] = None) -> Optional[str]:
+        """Settle a game; returns what ``GameRepository.finish_game`` would.
+
+        Raises ``SettlementFailed`` if the database rejected this game's
+        settlement.
+        """
+        future = asyncio.get_running_loop().create_future()
+        # Waits for room rather than queueing without bound
+        await self._queue.put(
+            ((game_id, enemy_id, enemy_symbol, created_at), future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize(),
+            "batches": self.batches,
+            "settled": self.settled,
+            "failures": self.failures,
+            "largest_batch": self.largest_batch,
+            "average_batch": self.settled / self.batches
+                             if self.batches else 0.0,
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_linger
+            while len(batch) < self._max_batch:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(
+                            self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait())
+            try:
+                await self._settle_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _settle_batch(self, batch) -> None:
+        try:
+            results = await self._settle([item for item, _ in batch])
+        except Exception as error:
+            self.failures += 1
+            logger.exception('Failed to settle %d games', len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self.batches += 1
+        self.settled += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            # The request may have gone away meanwhile
+            if future.done():
+                continue
+            if result["status"] == OK:
+                future.set_result(result["result"])
+            elif result["status"] == ALREADY_FINISHED:
+                future.set_result("Game already finished")
+            elif result["status"] == CLAIMED:
+                future.set_result("Game claimed by another player")
+            elif result["status"] == NOT_FOUND:
+                future.set_result(None)
+            else:
+                future.set_exception(
+                    SettlementFailed(result.get("detail", result["status"])))
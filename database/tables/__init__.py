@@ -2,5 +2,9 @@ from .base import Base
 from .task import Task
 from .user import User
 from .game import Game
+from .game_archive import GameArchive
 from .user_task import UserTask
+from .referral_stats import ReferralStats
+from .user_game_stats import UserGameStats
+from .idempotency_key import IdempotencyKey
 # from .user_friend import UserFriend
@@ -1,17 +1,36 @@
+from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import INTEGER, REAL, BOOLEAN, BIGINT, ForeignKey, String
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import INTEGER, BOOLEAN, BIGINT, TIMESTAMP, ForeignKey, String, Index, PrimaryKeyConstraint, text
+from sqlalchemy.orm import Mapped, declared_attr, mapped_column, relationship
 
 from . import Base
 from ..mixin import TimeStampMixin, TableNameMixin
 
 
 class Game(Base, TimeStampMixin, TableNameMixin):
-    id: Mapped[int] = mapped_column(INTEGER, primary_key=True, autoincrement=True)
-    bet: Mapped[float] = mapped_column(REAL, nullable=False)
+    # Range partitioned by month of creation; see database.partitions.
+    # The table key must include the partition column, but rows are still
+    # identified by id alone.
+    __table_args__ = (
+        PrimaryKeyConstraint('id', 'created_at'),
+        Index('ix_games_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+        Index('ix_games_open_id', 'id', postgresql_where=text('result IS NULL')),
+        Index('ix_games_open_bet_id', 'bet', 'id', postgresql_where=text('result IS NULL')),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+
+    @declared_attr.directive
+    def __mapper_args__(cls) -> dict:
+        return {'primary_key': [cls.__table__.c.id]}
+
+    id: Mapped[int] = mapped_column(INTEGER, autoincrement=True)
+    bet: Mapped[int] = mapped_column(BIGINT, nullable=False)
     symbol: Mapped[str] = mapped_column(String(255), nullable=False)
     result: Mapped[str] = mapped_column(String(255), nullable=True)
+    # Set by POST /game/match; a claim older than the claim TTL is void
+    claimed_by: Mapped[Optional[int]] = mapped_column(BIGINT, nullable=True)
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP, nullable=True)
 
     user_id: Mapped[int] = mapped_column(BIGINT, ForeignKey('users.id', ondelete='CASCADE'))
     user: Mapped['User'] = relationship(back_populates='games')
@@ -0,0 +1,24 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import BIGINT, INTEGER, TIMESTAMP, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from . import Base
+
+
+class GameArchive(Base):
+    """Settled games moved out of the partitioned games table.
+
+    Rows keep their game ids; only the primary key is indexed, to keep the
+    archive compact.
+    """
+    __tablename__ = "games_archive"
+
+    id: Mapped[int] = mapped_column(INTEGER, primary_key=True,
+                                    autoincrement=False)
+    bet: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    symbol: Mapped[str] = mapped_column(String(255), nullable=False)
+    result: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    user_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False)
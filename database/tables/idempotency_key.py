@@ -0,0 +1,26 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import SMALLINT, TIMESTAMP, Index, LargeBinary, String
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+
+from . import Base
+
+
+class IdempotencyKey(Base):
+    """Response recorded for an Idempotency-Key, see database.idempotency."""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (Index('ix_idempotency_keys_expires_at', 'expires_at'),)
+
+    # Method, path and the client's key
+    key: Mapped[str] = mapped_column(String(300), primary_key=True)
+    # Digest of the request body the key was first used with
+    fingerprint: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # Unset while the first request is still being handled
+    status_code: Mapped[Optional[int]] = mapped_column(SMALLINT)
+    # [[name, value], ...] as latin-1 strings
+    headers: Mapped[Optional[list]] = mapped_column(JSONB)
+    body: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+    # A claim that is never completed lapses here too
+    expires_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False)
@@ -0,0 +1,16 @@
+from sqlalchemy import BIGINT, INTEGER, ForeignKey
+from sqlalchemy.orm import Mapped, mapped_column
+
+from . import Base
+
+
+class ReferralStats(Base):
+    """Referrals ``depth`` levels below a user, kept up to date at registration."""
+    __tablename__ = "referral_stats"
+
+    user_id: Mapped[int] = mapped_column(
+        BIGINT, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    depth: Mapped[int] = mapped_column(INTEGER, primary_key=True)
+    referrals: Mapped[int] = mapped_column(INTEGER, nullable=False, default=0)
+    # Bonuses the user was paid for the referrals at this depth
+    earnings: Mapped[int] = mapped_column(BIGINT, nullable=False, default=0)
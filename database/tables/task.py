@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import INTEGER, String, TIMESTAMP, REAL, ForeignKey
+from sqlalchemy import BIGINT, INTEGER, String, TIMESTAMP, ForeignKey, Index, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from database.mixin import TimeStampMixin, TableNameMixin
@@ -8,10 +8,14 @@ from database.tables import Base
 
 
 class Task(Base, TableNameMixin, TimeStampMixin):
+    __table_args__ = (
+        Index('ix_tasks_open_expired_at', 'expired_at', postgresql_where=text('repeat_count > 0')),
+    )
+
     id: Mapped[int] = mapped_column(INTEGER, primary_key=True)
     name: Mapped[str] = mapped_column(String(255), nullable=False)
     expired_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False)
-    reward: Mapped[float] = mapped_column(REAL, nullable=False)
+    reward: Mapped[int] = mapped_column(BIGINT, nullable=False)
     repeat_count: Mapped[int] = mapped_column(INTEGER, default=1, nullable=False)
 
     users: Mapped[list["User"]] = relationship(
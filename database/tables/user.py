@@ -1,6 +1,6 @@
 from typing import Optional
 
-from sqlalchemy import INTEGER, String, REAL, BIGINT, ForeignKey
+from sqlalchemy import INTEGER, String, BIGINT, ForeignKey, Index, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from . import Base
@@ -8,11 +8,17 @@ from ..mixin import TimeStampMixin, TableNameMixin
 
 
 class User(Base, TimeStampMixin, TableNameMixin):
+    __table_args__ = (
+        Index('ix_users_referrer_id_id', 'referrer_id', 'id'),
+        Index('ix_users_won_games_id', text('won_games DESC'), 'id'),
+    )
+
     id: Mapped[int] = mapped_column(BIGINT, primary_key=True)
     name: Mapped[str] = mapped_column(String(255), nullable=False)
-    balance: Mapped[float] = mapped_column(REAL, nullable=False)
+    # Minor units, see models.money
+    balance: Mapped[int] = mapped_column(BIGINT, nullable=False)
 
-    referrer_id: Mapped[Optional[int]] = mapped_column(INTEGER, ForeignKey('users.id'))
+    referrer_id: Mapped[Optional[int]] = mapped_column(BIGINT, ForeignKey('users.id'))
     referrer: Mapped[Optional['User']] = relationship(
         'User',
         back_populates='referrals',
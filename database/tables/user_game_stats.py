@@ -0,0 +1,20 @@
+from sqlalchemy import BIGINT, INTEGER, ForeignKey
+from sqlalchemy.orm import Mapped, mapped_column
+
+from . import Base
+
+
+class UserGameStats(Base):
+    """Totals over the games a user created, kept up to date with them."""
+    __tablename__ = "user_game_stats"
+
+    user_id: Mapped[int] = mapped_column(
+        BIGINT, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    # Includes open games; they are the games not yet won, lost or drawn
+    games: Mapped[int] = mapped_column(INTEGER, nullable=False, default=0)
+    wins: Mapped[int] = mapped_column(INTEGER, nullable=False, default=0)
+    losses: Mapped[int] = mapped_column(INTEGER, nullable=False, default=0)
+    draws: Mapped[int] = mapped_column(INTEGER, nullable=False, default=0)
+    wagered: Mapped[int] = mapped_column(BIGINT, nullable=False, default=0)
+    # Net winnings over settled games; open bets are not counted
+    profit: Mapped[int] = mapped_column(BIGINT, nullable=False, default=0)
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import INTEGER, ForeignKey, TIMESTAMP, BOOLEAN
+from sqlalchemy import INTEGER, ForeignKey, TIMESTAMP, BOOLEAN, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from database.mixin import TableNameMixin
@@ -9,6 +9,9 @@ from database.tables import Base
 
 class UserTask(Base):
     __tablename__ = "user_tasks"
+    __table_args__ = (
+        UniqueConstraint('user_id', 'task_id', name='uq_user_tasks_user_id_task_id'),
+    )
     id: Mapped[int] = mapped_column(INTEGER, primary_key=True, autoincrement=True)
 
     user_id: Mapped[int] = mapped_column(
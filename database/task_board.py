@@ -0,0 +1,72 @@
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Container, Iterable, Optional
+
+from models.rows import TaskRow
+
+
+class TaskBoard:
+    """Tasks that can still be finished, in expiry order.
+
+    Only tasks with repeats left are kept, and expired ones are dropped from
+    the front as they are met, so listing a user's available tasks is one
+    pass over the live tasks. Repeat counts here trail the database; a
+    claim is always decided by the database.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: dict[int, TaskRow] = {}
+        self._order: list[tuple[datetime, int]] = []
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self._tasks
+
+    def load(self, tasks: Iterable[TaskRow]) -> None:
+        self._tasks.clear()
+        self._order.clear()
+        for task in tasks:
+            self.add(task)
+        self.loaded = True
+
+    def add(self, task: TaskRow) -> None:
+        self.remove(task.id)
+        if task.repeat_count <= 0:
+            return
+        self._tasks[task.id] = task
+        insort(self._order, (task.expired_at, task.id))
+
+    def remove(self, task_id: int) -> Optional[TaskRow]:
+        task = self._tasks.pop(task_id, None)
+        if task is not None:
+            del self._order[bisect_left(self._order,
+                                        (task.expired_at, task.id))]
+        return task
+
+    def set_repeat_count(self, task_id: int, repeat_count: int) -> None:
+        task = self._tasks.get(task_id)
+        if task is None:
+            return
+        if repeat_count <= 0:
+            self.remove(task_id)
+        else:
+            task.repeat_count = repeat_count
+
+    def available(self,
+                  completed: Container[int],
+                  now: Optional[datetime] = None) -> list[TaskRow]:
+        """Unexpired tasks whose ids are not in ``completed``."""
+        self._drop_expired(datetime.now() if now is None else now)
+        return [
+            self._tasks[task_id] for _, task_id in self._order
+            if task_id not in completed
+        ]
+
+    def _drop_expired(self, now: datetime) -> None:
+        expired = bisect_left(self._order, (now, float('inf')))
+        for _, task_id in self._order[:expired]:
+            del self._tasks[task_id]
+        del self._order[:expired]
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from database.repository.batch import OK
+
+logger = logging.getLogger(__name__)
+
+Flush = Callable[[list[tuple[int, int]]], Awaitable[list[dict]]]
+
+
+class BalanceAccumulator:
+    """Write-behind buffer for balance increments.
+
+    Increments are summed per user in memory and written with one batch
+    UPDATE when ``max_pending`` users have pending changes or every
+    ``flush_interval`` seconds, whichever comes first.
+
+    Pending increments live only in this process. If it dies without a
+    clean shutdown, up to ``flush_interval`` seconds of increments (at most
+    ``max_pending`` users' worth) are lost; a clean shutdown flushes them.
+    With several worker processes, reads only see the pending increments
+    of the process serving them until those are flushed.
+    """
+
+    def __init__(self,
+                 flush: Flush,
+                 flush_interval: float = 1.0,
+                 max_pending: int = 10_000) -> None:
+        self._flush = flush
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending: dict[int, int] = {}
+        # Increments being written, still visible to reads until committed
+        self._flushing: dict[int, int] = {}
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.flushes = 0
+        self.flushed_users = 0
+        self.failures = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, user_id: int, amount: int) -> None:
+        self._pending[user_id] = self._pending.get(user_id, 0) + amount
+        if len(self._pending) >= self._max_pending:
+            self._wakeup.set()
+
+    def pending(self, user_id: int) -> int:
+        """Increments for the user not yet committed to the database."""
+        return self._pending.get(user_id, 0) + self._flushing.get(user_id, 0)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the background flusher and write everything still pending."""
+        # Let an in-flight flush finish rather than cancel it mid-commit
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._pending:
+            logger.error('Balance increments lost on shutdown: %s',
+                         self._pending)
+
+    async def flush(self) -> bool:
+        """Write pending increments; False if the write failed."""
+        async with self._lock:
+            if not self._pending:
+                return True
+            self._flushing, self._pending = self._pending, {}
+            try:
+                results = await self._flush(list(self._flushing.items()))
+            except Exception:
+                self.failures += 1
+                logger.exception('Failed to flush %d balance increments',
+                                  len(self._flushing))
+                # Keep them for the next attempt
+                for user_id, amount in self._flushing.items():
+                    self.add(user_id, amount)
+                return False
+            finally:
+                flushed, self._flushing = self._flushing, {}
+            self.flushes += 1
+            self.flushed_users += len(flushed)
+            missing = [
+                result["telegram_id"] for result in results
+                if result["status"] != OK
+            ]
+            if missing:
+                logger.warning('Dropped balance increments for unknown users '
+                               '%s', missing)
+            return True
+
+    def stats(self) -> dict:
+        return {
+            "pending_users": len(self._pending),
+            "flushes": self.flushes,
+            "flushed_users": self.flushed_users,
+            "failures": self.failures,
+        }
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not await self.flush():
+                # Back off instead of retrying on every new increment
+                await asyncio.sleep(self._flush_interval)
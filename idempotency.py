@@ -0,0 +1,121 @@
+import hashlib
+from typing import Iterable
+
+from database.idempotency import (Idempotency, KeyInProgress, KeyReused,
+                                  StoredResponse)
+
+HEADER = b'idempotency-key'
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware honouring the Idempotency-Key header on some routes.
+
+    The first request with a key runs as usual and its response is
+    recorded; repeats with the same body get that response back, marked
+    with ``Idempotent-Replayed: true``, without reaching the endpoint.
+    Keys are scoped to the method and path. Requests without the header
+    are untouched.
+    """
+
+    def __init__(self, app, idempotency: Idempotency,
+                 routes: Iterable[tuple[str, str]]) -> None:
+        self.app = app
+        self.idempotency = idempotency
+        self.routes = frozenset(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or (scope['method'],
+                                       scope['path']) not in self.routes:
+            await self.app(scope, receive, send)
+            return
+        key = dict(scope['headers']).get(HEADER)
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await _send(send, _error(400, 'Invalid Idempotency-Key'), False)
+            return
+
+        body = await _read_body(receive)
+
+        async def execute() -> StoredResponse:
+            return await _capture(self.app, scope, receive, body)
+
+        try:
+            response, replayed = await self.idempotency.run(
+                f"{scope['method']} {scope['path']}:{key.decode('latin-1')}",
+                hashlib.sha256(body).digest(), execute)
+        except KeyReused:
+            response = _error(
+                422, 'Idempotency-Key was used with a different request')
+            replayed = False
+        except KeyInProgress:
+            response = _error(
+                409, 'A request with this Idempotency-Key is in progress')
+            replayed = False
+        await _send(send, response, replayed)
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+async def _capture(app, scope, receive, body: bytes) -> StoredResponse:
+    """Run ``app`` on a request whose body was already read, and buffer the
+    response it sends."""
+    sent_body = False
+
+    async def replay_receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+
+    start = {}
+    chunks = []
+
+    async def capture_send(message):
+        if message['type'] == 'http.response.start':
+            start.update(message)
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    await app(scope, replay_receive, capture_send)
+    return StoredResponse(fingerprint=b'',
+                          status_code=start['status'],
+                          headers=tuple((bytes(name), bytes(value))
+                                        for name, value in start.get(
+                                            'headers', ())),
+                          body=b''.join(chunks))
+
+
+def _error(status_code: int, detail: str) -> StoredResponse:
+    body = b'{"detail":"' + detail.encode() + b'"}'
+    return StoredResponse(fingerprint=b'',
+                          status_code=status_code,
+                          headers=((b'content-type', b'application/json'),
+                                   (b'content-length',
+                                    str(len(body)).encode())),
+                          body=body)
+
+
+async def _send(send, response: StoredResponse, replayed: bool) -> None:
+    headers = list(response.headers)
+    if replayed:
+        headers.append((b'idempotent-replayed', b'true'))
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': response.body})
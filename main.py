@@ -1,45 +1,187 @@
+import asyncio
+import math
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi.middleware.cors import CORSMiddleware
+from typing import List, Optional
 
-from database import Database
+from fastapi import (APIRouter, Depends, FastAPI, HTTPException, Query,
+                     Request, WebSocket)
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
+from starlette.requests import HTTPConnection
 
+from admission import AdmissionMiddleware
+from database import Database
+from database.events import GAMES_TOPIC, Subscription, user_topic
+from database.repository.batch import MAX_BATCH_SIZE
+from database.repository.game_repo import GameRepository
 from database.repository.leaderboard_repo import LeaderboardRepository
+from database.repository.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from database.repository.projection import to_row
 from database.repository.task_repo import TaskRepository
-from database.repository.user_repo import UserRepository
-from database.repository.game_repo import GameRepository
-from database.tables import User, Task, Game
-from pydantic import BaseModel
-from typing import List, Optional
+from database.repository.user_repo import MAX_REFERRAL_DEPTH, UserRepository
+from idempotency import IdempotencyMiddleware
+from metrics import MetricsMiddleware
+from models.money import Money, MoneyAmount, from_minor
+from models.rows import (GAME_JSON, OPEN_GAME_JSON, REFERRAL_JSON, TASK_JSON,
+                         USER_JSON, GameRow, Page, RowJson, TaskRow, UserRow)
+from payments import PaymentsNotConfigured
+from services import IDEMPOTENT_ROUTES, Services
+
+router = APIRouter()
+
+
+def create_app(services: Optional[Services] = None) -> FastAPI:
+    """Build the application around ``services``, by default configured
+    from the environment.
+
+    Serve it with ``uvicorn main:create_app --factory``. Importing this
+    module sets nothing up; resources are created here and opened and
+    closed by the app's lifespan.
+    """
+    if services is None:
+        services = Services()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await services.start()
+        yield
+        await services.close()
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.services = services
+
+    # Innermost first: shed requests still get CORS headers and are
+    # measured, and replays are shed too when the table store would be queried
+    app.add_middleware(IdempotencyMiddleware,
+                       idempotency=services.idempotency,
+                       routes=IDEMPOTENT_ROUTES)
+    app.add_middleware(AdmissionMiddleware, shedder=services.shedder)
+    # Set up CORS middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=[
+            "*"
+        ],  # Allow all origins. Change this to specific origins if needed.
+        allow_credentials=True,
+        allow_methods=["*"],  # Allow all HTTP methods.
+        allow_headers=["*"],  # Allow all headers.
+    )
+    app.add_middleware(MetricsMiddleware, metrics=services.metrics)
+    app.include_router(router)
+    return app
+
 
-from aiogram import Bot
-from aiogram.types import LabeledPrice
+_app: Optional[FastAPI] = None
 
-app = FastAPI()
 
-# Set up CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
-        "*"
-    ],  # Allow all origins. Change this to specific origins if needed.
-    allow_credentials=True,
-    allow_methods=["*"],  # Allow all HTTP methods.
-    allow_headers=["*"],  # Allow all headers.
-)
+def __getattr__(name: str):
+    # Keeps "uvicorn main:app" working, building the app on first access
+    global _app
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _app is None:
+        _app = create_app()
+    return _app
 
-# Initialize the database
-database = Database()
+
+def get_services(connection: HTTPConnection) -> Services:
+    return connection.app.state.services
 
 
 # Dependency to get a database session
-async def get_db() -> AsyncSession:
-    async with database.get_session() as session:
+async def get_db(
+        services: Services = Depends(get_services)) -> AsyncSession:
+    async with services.database.get_session() as session:
+        yield session
+
+
+# Dependency to get a session for read-only queries
+async def get_read_db(
+        services: Services = Depends(get_services)) -> AsyncSession:
+    async with services.database.get_read_session() as session:
         yield session
 
 
+def rate_limit(route: str, field: Optional[str] = None):
+    """Charge a request to ``route``'s budget for the user in its body.
+
+    The user is the integer ``field`` of the JSON body, or the client
+    address if there is none or no ``field`` is given. Used as a route
+    dependency, so it runs before ``get_db`` and a rejected request never
+    opens a session.
+    """
+
+    async def check(request: Request,
+                    services: Services = Depends(get_services)) -> None:
+        key = None
+        body = None
+        if field is not None:
+            try:
+                body = await request.json()
+            except ValueError:
+                pass
+        if isinstance(body, dict):
+            try:
+                key = int(body.get(field))
+            except (TypeError, ValueError):
+                key = None
+        if key is None and request.client is not None:
+            key = request.client.host
+        retry_after = services.limiter.acquire(route, key)
+        if retry_after > 0:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail='Too many requests',
+                headers={'Retry-After': str(math.ceil(retry_after))})
+
+    return Depends(check)
+
+
+def _next_cursor(items: list, limit: int) -> Optional[int]:
+    if len(items) < limit:
+        return None
+    return items[-1].id
+
+
+def _json_response(content: bytes,
+                   status_code: int = status.HTTP_200_OK) -> Response:
+    return Response(content,
+                    status_code=status_code,
+                    media_type='application/json')
+
+
+def _row_response(encoder: RowJson,
+                  row_type: type,
+                  instance,
+                  status_code: int = status.HTTP_200_OK) -> Response:
+    return _json_response(encoder.dump_row(to_row(row_type, instance)),
+                          status_code)
+
+
+def _list_response(encoder: RowJson, items: list) -> Response:
+    return _json_response(encoder.dump_list(items))
+
+
+def _page_response(encoder: RowJson, items: list, limit: int) -> Response:
+    return _json_response(
+        encoder.dump_page(Page(items, _next_cursor(items, limit))))
+
+
+def _ndjson_response(database: Database, open_stream,
+                     encoder: RowJson) -> StreamingResponse:
+    # The stream outlives the request dependencies, so it owns its session
+    async def body():
+        async with database.get_session() as session:
+            async for chunk in open_stream(session):
+                yield encoder.dump_ndjson(chunk)
+
+    return StreamingResponse(body(), media_type='application/x-ndjson')
+
+
 # Request Models
 
 
@@ -54,7 +196,7 @@ class UserRequest(BaseModel):
 
 class UserBalanceRequest(BaseModel):
     telegram_id: int
-    reward: int
+    reward: MoneyAmount
 
     class Config:
         from_attributes = True
@@ -63,7 +205,7 @@ class UserBalanceRequest(BaseModel):
 class TaskRequest(BaseModel):
     name: str
     expired_at: datetime
-    reward: float
+    reward: MoneyAmount
     repeat_count: int = 1
 
     class Config:
@@ -72,7 +214,7 @@ class TaskRequest(BaseModel):
 
 class GameRequest(BaseModel):
     user_id: int
-    bet: float
+    bet: MoneyAmount
     symbol: str
 
     class Config:
@@ -83,11 +225,36 @@ class GameFinishRequest(BaseModel):
     game_id: int
     enemy_id: int
     enemy_symbol: str
+    # As returned when the game was created; finds it in one partition
+    created_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class GameMatchRequest(BaseModel):
+    user_id: int
+    bet: MoneyAmount
+    tolerance: MoneyAmount = 0
 
     class Config:
         from_attributes = True
 
 
+class UserBalanceBatchRequest(BaseModel):
+    items: List[UserBalanceRequest] = Field(min_length=1,
+                                            max_length=MAX_BATCH_SIZE)
+
+
+class GameFinishBatchRequest(BaseModel):
+    items: List[GameFinishRequest] = Field(min_length=1,
+                                           max_length=MAX_BATCH_SIZE)
+
+
+class TaskBatchRequest(BaseModel):
+    items: List[TaskRequest] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
 class TaskFinishRequest(BaseModel):
     user_id: int
     task_id: int
@@ -97,179 +264,613 @@ class TaskFinishRequest(BaseModel):
 
 
 # User Endpoints
-@app.get('/users/', response_model=None)
-async def get_users(db: AsyncSession = Depends(get_db)):
+@router.get('/users/', response_model=None)
+async def get_users(after: Optional[int] = None,
+                    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                    stream: bool = False,
+                    db: AsyncSession = Depends(get_db),
+                    services: Services = Depends(get_services)):
+    if stream:
+        return _ndjson_response(
+            services.database,
+            lambda session: UserRepository(session).stream_users(), USER_JSON)
     user_repo = UserRepository(db)
-    users = await user_repo.get_all_users()
-    return users
-
-
-@app.get('/user/{user_id}', response_model=None)
-async def get_user(user_id: int, db: AsyncSession = Depends(get_db)):
-    user_repo = UserRepository(db)
-    user = await user_repo.get_user_by_id(user_id)
-    user.balance = round(user.balance, 2)
+    if after is None and limit is None:
+        users = await user_repo.get_all_users()
+        return _list_response(USER_JSON, users)
+    limit = limit or DEFAULT_PAGE_SIZE
+    return _page_response(USER_JSON, await user_repo.get_users_page(
+        after, limit), limit)
+
+
+@router.get('/user/{user_id}', response_model=None)
+async def get_user(user_id: int, services: Services = Depends(get_services)):
+    fast_reads = services.fast_path('user_get')
+    if fast_reads is not None:
+        user = await fast_reads.get_user(user_id)
+    else:
+        async with services.database.get_session() as db:
+            user_repo = UserRepository(db, services.leaderboard,
+                                       services.cache, services.balances)
+            user = await user_repo.get_user_by_id(user_id)
     if user is None:
         raise HTTPException(status_code=404, detail='User not found')
-    return user
-
-
-@app.delete('/user/game/{game_id}', response_model=None)
-async def delete_game(game_id: int, db: AsyncSession = Depends(get_db)):
-    game_repo = GameRepository(db)
-    game = await game_repo.delete_game_by_id(game_id)
+    return _row_response(USER_JSON, UserRow, user)
+
+
+@router.delete('/user/game/{game_id}', response_model=None)
+async def delete_game(game_id: int,
+                      created_at: Optional[datetime] = None,
+                      db: AsyncSession = Depends(get_db),
+                      services: Services = Depends(get_services)):
+    game_repo = GameRepository(db, services.leaderboard, services.open_games,
+                               services.cache, services.events,
+                               changes=services.changes)
+    game = await game_repo.delete_game_by_id(game_id, created_at)
     if game is None:
         raise HTTPException(status_code=404, detail='Game not found')
-    return game
+    return _row_response(GAME_JSON, GameRow, game)
 
 
 class UserResponse(BaseModel):
     id: int
     name: str
-    balance: float
+    balance: Money
     referrer_id: Optional[int]
 
     class Config:
         from_attributes = True
 
 
-@app.get('/user/{user_id}/games', response_model=None)
-async def get_user_games(user_id: int, db: AsyncSession = Depends(get_db)):
+@router.get('/user/{user_id}/games', response_model=None)
+async def get_user_games(user_id: int,
+                         after: Optional[int] = None,
+                         limit: Optional[int] = Query(None,
+                                                      ge=1,
+                                                      le=MAX_PAGE_SIZE),
+                         # The created_at of game ``after``, which keeps the
+                         # older partitions from being read
+                         after_created_at: Optional[datetime] = None,
+                         stream: bool = False,
+                         db: AsyncSession = Depends(get_db),
+                         services: Services = Depends(get_services)):
+    if stream:
+        return _ndjson_response(
+            services.database,
+            lambda session: UserRepository(session).stream_user_games(user_id),
+            GAME_JSON)
     user_repo = UserRepository(db)
+    if after is not None or limit is not None:
+        limit = limit or DEFAULT_PAGE_SIZE
+        games = await user_repo.get_user_games_page(user_id, after, limit,
+                                                    after_created_at)
+        return _page_response(GAME_JSON, games, limit)
     games = await user_repo.get_user_games(user_id)
     if not games:
         raise HTTPException(status_code=404,
                             detail='No games found for the user')
-    return [{
-        "id": game.id,
-        "bet": round(game.bet, 2),
-        "symbol": game.symbol,
-        "result": game.result,
-        "user_id": game.user_id,
-        "created_at": game.created_at,
-    } for game in games]
-    # return games
-
-
-@app.get('/user/{user_id}/friends', response_model=None)
+    return _list_response(GAME_JSON, games)
+
+
+@router.get('/user/{user_id}/games/history', response_model=None)
+async def get_user_game_history(user_id: int,
+                                before: Optional[int] = None,
+                                limit: int = Query(DEFAULT_PAGE_SIZE,
+                                                   ge=1,
+                                                   le=MAX_PAGE_SIZE),
+                                before_created_at: Optional[datetime] = None,
+                                db: AsyncSession = Depends(get_db)):
+    user_repo = UserRepository(db)
+    games = await user_repo.get_user_game_history(user_id, before, limit,
+                                                  before_created_at)
+    return _page_response(GAME_JSON, games, limit)
+
+
+@router.get('/user/{user_id}/games/stats')
+async def get_user_game_stats(user_id: int,
+                              db: AsyncSession = Depends(get_db)):
+    user_repo = UserRepository(db)
+    stats = await user_repo.get_user_game_stats(user_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail='User not found')
+    return {
+        **stats,
+        "wagered": from_minor(stats["wagered"]),
+        "profit": from_minor(stats["profit"]),
+    }
+
+
+@router.get('/user/{user_id}/friends', response_model=None)
 async def get_user_friends(user_id: int, db: AsyncSession = Depends(get_db)):
     user_repo = UserRepository(db)
     friends = await user_repo.get_user_friends(user_id)
-    print(friends)
-    return friends
+    return _list_response(USER_JSON, friends)
 
 
-@app.get('/user/{user_id}/tasks', response_model=None)
-async def get_user_tasks(user_id: int, db: AsyncSession = Depends(get_db)):
+@router.get('/user/{user_id}/referrals', response_model=None)
+async def get_user_referrals(user_id: int,
+                             depth: int = Query(1,
+                                                ge=1,
+                                                le=MAX_REFERRAL_DEPTH),
+                             limit: int = Query(DEFAULT_PAGE_SIZE,
+                                                ge=1,
+                                                le=MAX_PAGE_SIZE),
+                             db: AsyncSession = Depends(get_db)):
     user_repo = UserRepository(db)
-    tasks = await user_repo.get_user_tasks(user_id)
-    return tasks
+    referrals = await user_repo.get_referral_tree(user_id, depth, limit)
+    return _list_response(REFERRAL_JSON, referrals)
 
 
-@app.get('/user/{user_id}/top_place')
-async def get_user_top_place(user_id: int, db: AsyncSession = Depends(get_db)):
-    leaderboard_repo = LeaderboardRepository(db)
-    place = await leaderboard_repo.get_user_place(user_id)
+@router.get('/user/{user_id}/referrals/stats')
+async def get_user_referral_stats(user_id: int,
+                                  db: AsyncSession = Depends(get_db)):
+    user_repo = UserRepository(db)
+    stats = await user_repo.get_referral_stats(user_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail='User not found')
+    return {
+        **stats,
+        "earnings": from_minor(stats["earnings"]),
+        "levels": [{
+            **level, "earnings": from_minor(level["earnings"])
+        } for level in stats["levels"]],
+    }
+
+
+@router.get('/user/{user_id}/tasks', response_model=None)
+async def get_user_tasks(user_id: int,
+                         db: AsyncSession = Depends(get_db),
+                         services: Services = Depends(get_services)):
+    user_repo = UserRepository(db,
+                               cache=services.cache,
+                               task_board=services.task_board)
+    tasks = await user_repo.get_user_tasks(user_id)
+    return _list_response(TASK_JSON, tasks)
+
+
+@router.get('/user/{user_id}/top_place')
+async def get_user_top_place(user_id: int,
+                             services: Services = Depends(get_services)):
+    fast_reads = services.fast_path('user_top_place')
+    if fast_reads is not None:
+        place = await fast_reads.get_user_place(user_id)
+    else:
+        async with services.database.get_read_session() as db:
+            leaderboard_repo = LeaderboardRepository(db, services.leaderboard)
+            place = await leaderboard_repo.get_user_place(user_id)
     if place is None:
         raise HTTPException(status_code=404, detail='User not found')
     return place
 
 
-@app.post('/user/register',
-          response_model=None,
-          status_code=status.HTTP_201_CREATED)
+@router.get('/user/{user_id}/top_around', response_model=None)
+async def get_user_top_around(user_id: int,
+                              radius: int = Query(5, ge=0, le=50),
+                              db: AsyncSession = Depends(get_read_db),
+                              services: Services = Depends(get_services)):
+    leaderboard_repo = LeaderboardRepository(db, services.leaderboard)
+    users = await leaderboard_repo.get_users_around(user_id, radius)
+    if users is None:
+        raise HTTPException(status_code=404, detail='User not found')
+    return users
+
+
+@router.get('/user/{user_id}/top_percentile')
+async def get_user_top_percentile(user_id: int,
+                                  db: AsyncSession = Depends(get_read_db),
+                                  services: Services = Depends(get_services)):
+    leaderboard_repo = LeaderboardRepository(db, services.leaderboard)
+    percentile = await leaderboard_repo.get_user_percentile(user_id)
+    if percentile is None:
+        raise HTTPException(status_code=404, detail='User not found')
+    return {"percentile": round(percentile, 2)}
+
+
+@router.post('/user/register',
+             response_model=None,
+             status_code=status.HTTP_201_CREATED,
+             dependencies=[rate_limit('user_register', 'telegram_id')])
 async def post_register_user(user_data: UserRequest,
-                             db: AsyncSession = Depends(get_db)):
-    user_repo = UserRepository(db)
+                             db: AsyncSession = Depends(get_db),
+                             services: Services = Depends(get_services)):
+    user_repo = UserRepository(db,
+                               services.leaderboard,
+                               services.cache,
+                               events=services.events,
+                               changes=services.changes)
     new_user = await user_repo.create_user(user_data.user_name,
                                            user_data.telegram_id,
                                            user_data.referrer_id)
-    return new_user
+    return _row_response(USER_JSON, UserRow, new_user,
+                         status.HTTP_201_CREATED)
 
 
-@app.post('/user/finish_task', status_code=status.HTTP_204_NO_CONTENT)
+@router.post('/user/finish_task',
+             status_code=status.HTTP_204_NO_CONTENT,
+             dependencies=[rate_limit('user_task', 'user_id')])
 async def post_finish_task(request: TaskFinishRequest,
-                           db: AsyncSession = Depends(get_db)):
-    user_repo = UserRepository(db)
+                           db: AsyncSession = Depends(get_db),
+                           services: Services = Depends(get_services)):
+    user_repo = UserRepository(db,
+                               services.leaderboard,
+                               services.cache,
+                               task_board=services.task_board,
+                               events=services.events,
+                               changes=services.changes)
     await user_repo.finish_task(request.user_id, request.task_id)
 
 
-@app.put('/user/balance', status_code=status.HTTP_204_NO_CONTENT)
+@router.put('/user/balance',
+            status_code=status.HTTP_204_NO_CONTENT,
+            dependencies=[rate_limit('user_balance', 'telegram_id')])
 async def put_user_balance(data: UserBalanceRequest,
-                           db: AsyncSession = Depends(get_db)):
-    user_repo = UserRepository(db)
+                           db: AsyncSession = Depends(get_db),
+                           services: Services = Depends(get_services)):
+    user_repo = UserRepository(db,
+                               services.leaderboard,
+                               services.cache,
+                               services.balances,
+                               events=services.events,
+                               changes=services.changes)
     await user_repo.update_user_balance(data.telegram_id, data.reward)
 
 
-# Task Endpoints
-@app.get('/tasks/', response_model=None)
-async def get_tasks(db: AsyncSession = Depends(get_db)):
-    task_repo = TaskRepository(db)
-    tasks = await task_repo.get_all_tasks()
-    return tasks
+@router.put('/user/balance/batch',
+            response_model=None,
+            dependencies=[rate_limit('user_balance_batch')])
+async def put_user_balance_batch(data: UserBalanceBatchRequest,
+                                 db: AsyncSession = Depends(get_db),
+                                 services: Services = Depends(get_services)):
+    user_repo = UserRepository(db,
+                               services.leaderboard,
+                               services.cache,
+                               events=services.events,
+                               changes=services.changes)
+    results = await user_repo.update_user_balances(
+        [(item.telegram_id, item.reward) for item in data.items])
+    return {"results": results}
 
 
-@app.post('/tasks/', response_model=None, status_code=status.HTTP_201_CREATED)
+# Task Endpoints
+@router.get('/tasks/', response_model=None)
+async def get_tasks(after: Optional[int] = None,
+                    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                    stream: bool = False,
+                    db: AsyncSession = Depends(get_read_db),
+                    services: Services = Depends(get_services)):
+    if stream:
+        return _ndjson_response(
+            services.database,
+            lambda session: TaskRepository(session).stream_tasks(), TASK_JSON)
+    task_repo = TaskRepository(db, services.cache, services.task_board)
+    if after is None and limit is None:
+        tasks = await task_repo.get_all_tasks()
+        return _list_response(TASK_JSON, tasks)
+    limit = limit or DEFAULT_PAGE_SIZE
+    return _page_response(TASK_JSON, await task_repo.get_tasks_page(
+        after, limit), limit)
+
+
+@router.post('/tasks/',
+             response_model=None,
+             status_code=status.HTTP_201_CREATED)
 async def create_task(task_data: TaskRequest,
-                      db: AsyncSession = Depends(get_db)):
-    task_repo = TaskRepository(db)
+                      db: AsyncSession = Depends(get_db),
+                      services: Services = Depends(get_services)):
+    task_repo = TaskRepository(db,
+                               services.cache,
+                               services.task_board,
+                               changes=services.changes)
     new_task = await task_repo.create_task(task_data.name,
                                            task_data.expired_at,
                                            task_data.reward,
                                            task_data.repeat_count)
-    return new_task
-
-
-@app.delete('/tasks/{task_id}', status_code=status.HTTP_204_NO_CONTENT)
-async def delete_task(task_id: int, db: AsyncSession = Depends(get_db)):
-    task_repo = TaskRepository(db)
+    return _row_response(TASK_JSON, TaskRow, new_task,
+                         status.HTTP_201_CREATED)
+
+
+@router.post('/tasks/batch',
+             response_model=None,
+             dependencies=[rate_limit('task_batch')])
+async def create_tasks(data: TaskBatchRequest,
+                       db: AsyncSession = Depends(get_db),
+                       services: Services = Depends(get_services)):
+    task_repo = TaskRepository(db,
+                               services.cache,
+                               services.task_board,
+                               changes=services.changes)
+    results = await task_repo.create_tasks(
+        [item.model_dump() for item in data.items])
+    for result in results:
+        if "task" in result:
+            result["task"] = TASK_JSON.to_python(to_row(TaskRow,
+                                                        result["task"]))
+    return {"results": results}
+
+
+@router.delete('/tasks/{task_id}', status_code=status.HTTP_204_NO_CONTENT)
+async def delete_task(task_id: int,
+                      db: AsyncSession = Depends(get_db),
+                      services: Services = Depends(get_services)):
+    task_repo = TaskRepository(db,
+                               services.cache,
+                               services.task_board,
+                               changes=services.changes)
     await task_repo.delete_task(task_id)
 
 
 # Game Endpoints
-@app.get('/game/', response_model=None)
-async def get_games(db: AsyncSession = Depends(get_db)):
+@router.get('/game/', response_model=None)
+async def get_games(after: Optional[int] = None,
+                    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                    stream: bool = False,
+                    db: AsyncSession = Depends(get_read_db),
+                    services: Services = Depends(get_services)):
+    if stream:
+        return _ndjson_response(
+            services.database,
+            lambda session: GameRepository(session).stream_games(),
+            OPEN_GAME_JSON)
     game_repo = GameRepository(db)
-    games = await game_repo.get_all_games()
-    return games
-
-
-@app.post('/game/create',
-          response_model=None,
-          status_code=status.HTTP_201_CREATED)
+    if after is None and limit is None:
+        games = await game_repo.get_all_games()
+        return _list_response(OPEN_GAME_JSON, games)
+    limit = limit or DEFAULT_PAGE_SIZE
+    return _page_response(OPEN_GAME_JSON, await game_repo.get_games_page(
+        after, limit), limit)
+
+
+@router.post('/game/create',
+             response_model=None,
+             status_code=status.HTTP_201_CREATED,
+             dependencies=[rate_limit('game_create', 'user_id')])
 async def create_game(game_data: GameRequest,
-                      db: AsyncSession = Depends(get_db)):
-    game_repo = GameRepository(db)
-    round_bet = round(game_data.bet, 2)
-    print(round_bet)
-    new_game = await game_repo.create_game(game_data.user_id, round_bet,
+                      db: AsyncSession = Depends(get_db),
+                      services: Services = Depends(get_services)):
+    game_repo = GameRepository(db, services.leaderboard, services.open_games,
+                               services.cache, services.events,
+                               changes=services.changes)
+    # The balance check runs in SQL, so it must see buffered increments
+    balances = services.balances
+    if balances is not None and balances.pending(game_data.user_id):
+        await balances.flush()
+    new_game = await game_repo.create_game(game_data.user_id, game_data.bet,
                                            game_data.symbol)
     if new_game is None:
         raise HTTPException(status_code=400, detail='Not enough balance')
-    return new_game
-
-
-@app.put('/game/finish/{game_id}',
-         status_code=status.HTTP_200_OK,
-         response_model=Optional[dict])
+    return _row_response(GAME_JSON, GameRow, new_game,
+                         status.HTTP_201_CREATED)
+
+
+@router.post('/game/match',
+             response_model=None,
+             dependencies=[rate_limit('game_match', 'user_id')])
+async def match_game(request: GameMatchRequest,
+                     db: AsyncSession = Depends(get_db),
+                     services: Services = Depends(get_services)):
+    game_repo = GameRepository(db, open_games=services.open_games)
+    game = await game_repo.match_game(request.user_id, request.bet,
+                                      request.tolerance)
+    if game is None:
+        raise HTTPException(status_code=404, detail='No matching game')
+    return {**game, "bet": from_minor(game["bet"])}
+
+
+# Registered before /game/finish/{game_id} so "batch" is not read as an id
+@router.put('/game/finish/batch',
+            response_model=None,
+            dependencies=[rate_limit('game_finish_batch')])
+async def finish_games(data: GameFinishBatchRequest,
+                       db: AsyncSession = Depends(get_db),
+                       services: Services = Depends(get_services)):
+    game_repo = GameRepository(db, services.leaderboard, services.open_games,
+                               services.cache, services.events,
+                               changes=services.changes)
+    results = await game_repo.finish_games([
+        (item.game_id, item.enemy_id, item.enemy_symbol, item.created_at)
+        for item in data.items
+    ])
+    return {"results": results}
+
+
+@router.put('/game/finish/{game_id}',
+            status_code=status.HTTP_200_OK,
+            response_model=Optional[dict],
+            dependencies=[rate_limit('game_finish', 'enemy_id')])
 async def finish_game(game_data: GameFinishRequest,
-                      db: AsyncSession = Depends(get_db)):
-    game_repo = GameRepository(db)
-    result = await game_repo.finish_game(game_data.game_id, game_data.enemy_id,
-                                         game_data.enemy_symbol)
+                      db: AsyncSession = Depends(get_db),
+                      services: Services = Depends(get_services)):
+    if services.settlements is not None:
+        result = await services.settlements.finish(game_data.game_id,
+                                                   game_data.enemy_id,
+                                                   game_data.enemy_symbol,
+                                                   game_data.created_at)
+    else:
+        game_repo = GameRepository(db, services.leaderboard,
+                                   services.open_games, services.cache,
+                                   services.events,
+                                   changes=services.changes)
+        result = await game_repo.finish_game(game_data.game_id,
+                                             game_data.enemy_id,
+                                             game_data.enemy_symbol,
+                                             game_data.created_at)
     if result is None:
         raise HTTPException(status_code=404, detail='Game not found')
     elif result == 'Game already finished':
         raise HTTPException(status_code=400, detail='Game already finished')
+    elif result == 'Game claimed by another player':
+        raise HTTPException(status_code=409,
+                            detail='Game claimed by another player')
     return {"result": result}
 
 
 # Leaderboard Endpoint
-@app.get('/leaderboard/top_10', response_model=None)
-async def get_top_10_leaderboard(db: AsyncSession = Depends(get_db)):
-    leaderboard_repo = LeaderboardRepository(db)
+@router.get('/leaderboard/top_10', response_model=None)
+async def get_top_10_leaderboard(db: AsyncSession = Depends(get_read_db),
+                                 services: Services = Depends(get_services)):
+    leaderboard_repo = LeaderboardRepository(db, services.leaderboard,
+                                             services.cache)
     top_10 = await leaderboard_repo.get_leaderboard_top_10()
-    return top_10
+    return _list_response(USER_JSON,
+                          [to_row(UserRow, user) for user in top_10])
+
+
+# Event Endpoints
+def _event_topics(user_id: Optional[int]) -> list[str]:
+    # Everyone sees open games come and go; balances only reach their user
+    if user_id is None:
+        return [GAMES_TOPIC]
+    return [GAMES_TOPIC, user_topic(user_id)]
+
+
+async def _send_events(websocket: WebSocket,
+                       subscription: Subscription) -> None:
+    while (message := await subscription.get()) is not None:
+        await websocket.send_text(message.text)
+
+
+async def _receive_until_disconnect(websocket: WebSocket) -> None:
+    # Client messages are ignored; reading is how a disconnect is noticed
+    while (await websocket.receive())['type'] != 'websocket.disconnect':
+        pass
+
+
+@router.websocket('/ws/events')
+async def events_socket(websocket: WebSocket,
+                        user_id: Optional[int] = None,
+                        services: Services = Depends(get_services)):
+    subscription = services.events.subscribe(*_event_topics(user_id))
+    if subscription is None:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    await websocket.accept()
+    tasks = [
+        asyncio.create_task(_send_events(websocket, subscription)),
+        asyncio.create_task(_receive_until_disconnect(websocket)),
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        # Closed by the hub: the client fell behind or the app is stopping
+        dropped = subscription.closed
+    finally:
+        subscription.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if dropped:
+        # Either way the client should reconnect and refetch what it missed
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER
+                              if subscription.lagging else
+                              status.WS_1001_GOING_AWAY)
+
+
+@router.get('/events', response_model=None)
+async def get_events(user_id: Optional[int] = None,
+                     services: Services = Depends(get_services)):
+    """Server-sent events fallback for clients without WebSockets."""
+    if not services.events.accepting:
+        raise HTTPException(status_code=503, detail='Too many subscribers')
+
+    # Subscribed inside the stream so the subscription ends with it
+    async def body():
+        subscription = services.events.subscribe(*_event_topics(user_id))
+        if subscription is None:
+            return
+        try:
+            while True:
+                try:
+                    message = await subscription.get(services.events_heartbeat)
+                except TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                if message is None:
+                    return
+                yield message.sse
+        finally:
+            subscription.close()
+
+    return StreamingResponse(body(),
+                             media_type='text/event-stream',
+                             headers={
+                                 'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'
+                             })
+
+
+@router.get('/health/db', response_model=None)
+async def get_db_health(services: Services = Depends(get_services)):
+    return services.database.pool_stats()
+
+
+@router.get('/health/cache', response_model=None)
+async def get_cache_health(services: Services = Depends(get_services)):
+    return services.cache.stats()
+
+
+@router.get('/health/events', response_model=None)
+async def get_events_health(services: Services = Depends(get_services)):
+    return services.events.stats()
+
+
+@router.get('/health/changes', response_model=None)
+async def get_changes_health(services: Services = Depends(get_services)):
+    if services.changes is None:
+        return {"enabled": False}
+    return {"enabled": True, **services.changes.stats()}
+
+
+@router.get('/health/admission', response_model=None)
+async def get_admission_health(services: Services = Depends(get_services)):
+    return {
+        "rate_limits": services.limiter.stats(),
+        "load_shedding": services.shedder.stats(),
+    }
+
+
+@router.get('/health/idempotency', response_model=None)
+async def get_idempotency_health(services: Services = Depends(get_services)):
+    return services.idempotency.stats()
+
+
+@router.get('/health/archive', response_model=None)
+async def get_archive_health(services: Services = Depends(get_services)):
+    return services.archiver.stats()
+
+
+@router.get('/health/balances', response_model=None)
+async def get_balances_health(services: Services = Depends(get_services)):
+    if services.balances is None:
+        return {"enabled": False}
+    return {"enabled": True, **services.balances.stats()}
+
+
+@router.get('/health/settlements', response_model=None)
+async def get_settlements_health(services: Services = Depends(get_services)):
+    if services.settlements is None:
+        return {"enabled": False}
+    return {"enabled": True, **services.settlements.stats()}
+
+
+@router.get('/health/fast_path', response_model=None)
+async def get_fast_path_health(services: Services = Depends(get_services)):
+    if services.fast_reads is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "routes": sorted(services.fast_routes),
+        **services.fast_reads.stats()
+    }
+
+
+@router.get('/health/invoices', response_model=None)
+async def get_invoices_health(services: Services = Depends(get_services)):
+    return services.invoices.stats()
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics(services: Services = Depends(get_services)):
+    return PlainTextResponse(services.metrics.render(),
+                             media_type='text/plain; version=0.0.4')
 
 
 class PaymentRequest(BaseModel):
@@ -279,15 +880,12 @@ class PaymentRequest(BaseModel):
         from_attributes = True
 
 
-@app.post('/payment', response_model=None)
-async def payment(request: PaymentRequest, db: AsyncSession = Depends(get_db)):
-    bot = Bot(token="7890394661:AAGWGeUWx8xM7GaHRixezTEabM217Aq7a_0")
-    payment_link = await bot.create_invoice_link(
-        title='Пополнение баланса',
-        description='Пополнение игрового баланса',
-        payload='game_payload',
-        provider_token='',
-        currency='XTR',
-        prices=[LabeledPrice(label='XTR', amount=request.price)],
-    )
+@router.post('/payment', response_model=None)
+async def payment(request: PaymentRequest,
+                  services: Services = Depends(get_services)):
+    try:
+        payment_link = await services.invoices.get_link(request.price)
+    except PaymentsNotConfigured:
+        raise HTTPException(status_code=503,
+                            detail='Payments are not configured')
     return {"paymentLink": payment_link}
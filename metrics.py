@@ -0,0 +1,264 @@
+import logging
+import random
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Statements kept per sampled request for the slow-request log
+MAX_CAPTURED_STATEMENTS = 50
+
+
+@dataclass(slots=True)
+class RequestStats:
+    """What one request spent its time on, filled in by the engine hooks."""
+    statements: int = 0
+    db_time: float = 0.0
+    pool_wait: float = 0.0
+    captured: Optional[list] = None
+
+
+@dataclass(slots=True)
+class _Series:
+    buckets: list[int]
+    count: int = 0
+    total: float = 0.0
+
+
+@dataclass
+class Histogram:
+    name: str
+    help: str
+    bounds: tuple
+    series: dict[tuple, _Series] = field(default_factory=dict)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = _Series([0] * len(self.bounds))
+        index = bisect_left(self.bounds, value)
+        if index < len(self.bounds):
+            series.buckets[index] += 1
+        series.count += 1
+        series.total += value
+
+    def render(self, label_names: tuple) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        for labels, series in self.series.items():
+            base = _labels(label_names, labels)
+            cumulative = 0
+            for bound, hits in zip(self.bounds, series.buckets):
+                cumulative += hits
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} '
+                         f'{series.count}')
+            lines.append(f'{self.name}_sum{{{base}}} {series.total}')
+            lines.append(f'{self.name}_count{{{base}}} {series.count}')
+        return lines
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    return ','.join(f'{name}="{_escape(value)}"'
+                    for name, value in zip(names, values))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar('request_stats',
+                                                          default=None)
+
+
+class Metrics:
+    """Per-route request metrics in Prometheus text format.
+
+    Requests are labelled by route template, so ``/user/1`` and ``/user/2``
+    share a series. Slow requests are logged with their SQL when they were
+    picked for statement capture, which happens for a ``sample_rate`` share
+    of requests.
+    """
+
+    LABELS = ('method', 'route')
+
+    def __init__(self,
+                 slow_request_seconds: float = 0.5,
+                 sample_rate: float = 0.1) -> None:
+        self.slow_request_seconds = slow_request_seconds
+        self.sample_rate = sample_rate
+        self.requests: dict[tuple, int] = {}
+        self.duration = Histogram('http_request_duration_seconds',
+                                  'Request latency.', LATENCY_BUCKETS)
+        self.db_time = Histogram('http_request_db_seconds',
+                                 'Time spent executing SQL per request.',
+                                 LATENCY_BUCKETS)
+        self.python_time = Histogram(
+            'http_request_python_seconds',
+            'Request time not spent in SQL or waiting for the pool.',
+            LATENCY_BUCKETS)
+        self.pool_wait = Histogram('http_request_pool_wait_seconds',
+                                   'Time spent waiting for a connection.',
+                                   LATENCY_BUCKETS)
+        self.statements = Histogram('http_request_sql_statements',
+                                    'SQL statements executed per request.',
+                                    STATEMENT_BUCKETS)
+        self._gauges: list[Callable[[], dict[str, float]]] = []
+
+    def instrument_engine(self, engine: AsyncEngine) -> None:
+        """Attribute the engine's statements and pool waits to requests."""
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.listen(sync_engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+        event.listen(sync_engine, 'handle_error', self._on_error)
+
+        pool = sync_engine.pool
+        previous = getattr(pool, 'on_wait', None)
+
+        def on_wait(seconds: float) -> None:
+            if previous is not None:
+                previous(seconds)
+            stats = _current.get()
+            if stats is not None:
+                stats.pool_wait += seconds
+
+        pool.on_wait = on_wait
+
+    def add_gauges(self, collect: Callable[[], dict[str, float]]) -> None:
+        """Register a callable returning ``{'name{labels}': value}`` samples.
+
+        It is called on every scrape.
+        """
+        self._gauges.append(collect)
+
+    def start_request(self) -> RequestStats:
+        stats = RequestStats()
+        if random.random() < self.sample_rate:
+            stats.captured = []
+        return stats
+
+    def finish_request(self, method: str, route: str, status: int,
+                       stats: RequestStats, elapsed: float) -> None:
+        labels = (method, route)
+        self.requests[(method, route, status)] = self.requests.get(
+            (method, route, status), 0) + 1
+        self.duration.observe(labels, elapsed)
+        self.db_time.observe(labels, stats.db_time)
+        self.pool_wait.observe(labels, stats.pool_wait)
+        self.python_time.observe(
+            labels, max(0.0, elapsed - stats.db_time - stats.pool_wait))
+        self.statements.observe(labels, stats.statements)
+
+        if elapsed >= self.slow_request_seconds and stats.captured is not None:
+            logger.warning(
+                'Slow request %s %s -> %s: %.1fms total, %.1fms SQL in %d '
+                'statements, %.1fms pool wait%s', method, route, status,
+                elapsed * 1000, stats.db_time * 1000, stats.statements,
+                stats.pool_wait * 1000, ''.join(
+                    f'\n  {duration * 1000:8.1f}ms  {statement}'
+                    for statement, duration in stats.captured))
+
+    def render(self) -> str:
+        lines = ['# HELP http_requests_total Requests handled.',
+                 '# TYPE http_requests_total counter']
+        for labels, count in self.requests.items():
+            lines.append('http_requests_total{%s} %d' % (_labels(
+                ('method', 'route', 'status'), labels), count))
+        for histogram in (self.duration, self.db_time, self.python_time,
+                          self.pool_wait, self.statements):
+            lines.extend(histogram.render(self.LABELS))
+        gauges: dict[str, list[str]] = {}
+        for collect in self._gauges:
+            try:
+                values = collect()
+            except Exception:
+                logger.exception('Failed to collect gauges')
+                continue
+            for sample, value in values.items():
+                gauges.setdefault(sample.split('{')[0],
+                                  []).append(f'{sample} {value}')
+        for name, samples in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                               executemany) -> None:
+        if _current.get() is not None:
+            conn.info.setdefault('query_started', []).append(
+                time.perf_counter())
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany) -> None:
+        stats = _current.get()
+        if stats is None:
+            return
+        _record(conn, stats, statement)
+
+    @staticmethod
+    def _on_error(context) -> None:
+        stats = _current.get()
+        if stats is not None and context.connection is not None:
+            _record(context.connection, stats, context.statement)
+
+
+def _record(conn, stats: RequestStats, statement: Optional[str]) -> None:
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    duration = time.perf_counter() - started.pop()
+    stats.statements += 1
+    stats.db_time += duration
+    if (stats.captured is not None
+            and len(stats.captured) < MAX_CAPTURED_STATEMENTS):
+        stats.captured.append((' '.join((statement or '').split()), duration))
+
+
+class MetricsMiddleware:
+    """ASGI middleware feeding every HTTP request into ``Metrics``."""
+
+    def __init__(self, app, metrics: Metrics) -> None:
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = self.metrics.start_request()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            route = scope.get('route')
+            # Unmatched paths share one series to keep the label set bounded
+            self.metrics.finish_request(scope['method'],
+                                        getattr(route, 'path', 'unmatched'),
+                                        status, stats, elapsed)
@@ -0,0 +1,56 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from pydantic import TypeAdapter
+
+from models.money import Money
+
+# Payloads pushed to /ws/events and /events subscribers. Game symbols are
+# never included, so the feed cannot leak a creator's move.
+
+
+@dataclass(slots=True)
+class GameCreated:
+    id: int
+    bet: Money
+    user_id: int
+    user_name: str
+    created_at: Optional[datetime]
+
+
+@dataclass(slots=True)
+class GameFinished:
+    id: int
+    user_id: int
+    enemy_id: int
+    # From the creator's point of view
+    result: str
+
+
+@dataclass(slots=True)
+class GameDeleted:
+    id: int
+    user_id: int
+
+
+@dataclass(slots=True)
+class BalanceChanged:
+    user_id: int
+    balance: Money
+
+
+EVENT_NAMES = {
+    GameCreated: 'game_created',
+    GameFinished: 'game_finished',
+    GameDeleted: 'game_deleted',
+    BalanceChanged: 'balance_changed',
+}
+
+_ENCODERS = {event_type: TypeAdapter(event_type) for event_type in EVENT_NAMES}
+
+
+def encode_event(event) -> tuple[str, bytes]:
+    """The event's name and its payload as JSON."""
+    event_type = type(event)
+    return EVENT_NAMES[event_type], _ENCODERS[event_type].dump_json(event)
@@ -0,0 +1,32 @@
+from typing import Annotated, Any
+
+from pydantic import BeforeValidator, PlainSerializer, WithJsonSchema
+
+# Money is stored and computed as integer minor units (cents). The API
+# keeps exchanging decimal amounts; conversion happens only at the edge.
+MINOR_UNITS = 100
+
+
+def to_minor(amount: float) -> int:
+    return round(amount * MINOR_UNITS)
+
+
+def from_minor(amount: int) -> float:
+    return amount / MINOR_UNITS
+
+
+def _parse_amount(value: Any) -> Any:
+    if isinstance(value, str):
+        value = float(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return to_minor(value)
+    return value
+
+
+_AMOUNT_SCHEMA = WithJsonSchema({'type': 'number'})
+
+# Minor units in the app, a decimal amount in JSON responses
+Money = Annotated[int, PlainSerializer(from_minor, return_type=float),
+                  _AMOUNT_SCHEMA]
+# A decimal amount in JSON requests, minor units once parsed
+MoneyAmount = Annotated[int, BeforeValidator(_parse_amount), _AMOUNT_SCHEMA]
@@ -0,0 +1,108 @@
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Generic, Iterable, Optional, TypeVar
+
+from pydantic import TypeAdapter
+
+from models.money import Money
+
+T = TypeVar('T')
+
+
+# Read-only projections of table rows. Repositories select exactly these
+# columns, in field order, so rows skip ORM hydration and the identity map.
+
+
+@dataclass(slots=True)
+class UserRow:
+    id: int
+    name: str
+    balance: Money
+    referrer_id: Optional[int]
+    won_games: int
+    created_at: Optional[datetime]
+
+
+@dataclass(slots=True)
+class TaskRow:
+    id: int
+    name: str
+    expired_at: datetime
+    reward: Money
+    repeat_count: int
+    created_at: Optional[datetime]
+
+
+@dataclass(slots=True)
+class GameRow:
+    id: int
+    bet: Money
+    symbol: str
+    result: Optional[str]
+    user_id: int
+    created_at: Optional[datetime]
+
+
+@dataclass(slots=True)
+class OpenGameRow:
+    id: int
+    bet: Money
+    symbol: str
+    result: Optional[str]
+    user_id: int
+    user_name: str
+
+
+@dataclass(slots=True)
+class ReferralRow:
+    id: int
+    name: str
+    referrer_id: int
+    # 1 for direct referrals, 2 for their referrals and so on
+    depth: int
+
+
+@dataclass(slots=True)
+class Page(Generic[T]):
+    items: list[T]
+    next_cursor: Optional[int]
+
+
+def field_names(row_type: type) -> list[str]:
+    return [field.name for field in fields(row_type)]
+
+
+class RowJson(Generic[T]):
+    """JSON encoders for one row type, built once at import.
+
+    Serialization runs in pydantic-core, which is much cheaper than walking
+    objects with ``jsonable_encoder`` and ``json.dumps``.
+    """
+
+    def __init__(self, row_type: type[T]) -> None:
+        self._row = TypeAdapter(row_type)
+        self._list = TypeAdapter(list[row_type])
+        self._page = TypeAdapter(Page[row_type])
+
+    def dump_row(self, row: T) -> bytes:
+        return self._row.dump_json(row)
+
+    def to_python(self, row: T) -> dict:
+        """``row`` as JSON-ready values, for embedding in other responses."""
+        return self._row.dump_python(row, mode='json')
+
+    def dump_list(self, rows: list[T]) -> bytes:
+        return self._list.dump_json(rows)
+
+    def dump_page(self, page: Page[T]) -> bytes:
+        return self._page.dump_json(page)
+
+    def dump_ndjson(self, rows: Iterable[T]) -> bytes:
+        return b''.join(self._row.dump_json(row) + b'\n' for row in rows)
+
+
+USER_JSON = RowJson(UserRow)
+TASK_JSON = RowJson(TaskRow)
+GAME_JSON = RowJson(GameRow)
+OPEN_GAME_JSON = RowJson(OpenGameRow)
+REFERRAL_JSON = RowJson(ReferralRow)
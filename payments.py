@@ -0,0 +1,86 @@
+import asyncio
+from typing import Optional
+
+from database.cache import MemoryCache, ReadThroughCache
+
+
+def _import_aiogram() -> None:
+    # Loads aiogram.types along with it
+    import aiogram.client.session.aiohttp  # noqa: F401
+
+
+class PaymentsNotConfigured(RuntimeError):
+    """No Bot API token was configured."""
+
+
+class InvoiceLinks:
+    """Telegram Stars invoice links created through one long-lived Bot.
+
+    The Bot keeps a single HTTP session, so connections to the Bot API are
+    reused, and at most ``max_concurrency`` calls are in flight at once.
+    A link can be paid any number of times, so links are cached per price
+    and payload for ``ttl`` seconds; concurrent misses share one call.
+
+    aiogram takes seconds to import, so it is only loaded, off the event
+    loop, and the Bot created when the first link is requested.
+    """
+
+    def __init__(self,
+                 token: Optional[str],
+                 api_url: Optional[str] = None,
+                 max_concurrency: int = 10,
+                 ttl: float = 3600,
+                 maxsize: int = 1000) -> None:
+        self._token = token
+        self._api_url = api_url
+        self._max_concurrency = max_concurrency
+        self._bot = None
+        self._labeled_price = None
+        self._setup = asyncio.Lock()
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._links = ReadThroughCache(MemoryCache(maxsize), ttl=ttl)
+
+    async def get_link(self, price: int, payload: str = 'game_payload') -> str:
+        return await self._links.get_or_load(
+            f'invoice:{payload}:{price}',
+            lambda: self._create_link(price, payload))
+
+    async def _create_link(self, price: int, payload: str) -> str:
+        bot = await self._get_bot()
+        async with self._limit:
+            return await bot.create_invoice_link(
+                title='Пополнение баланса',
+                description='Пополнение игрового баланса',
+                payload=payload,
+                provider_token='',
+                currency='XTR',
+                prices=[self._labeled_price(label='XTR', amount=price)],
+            )
+
+    def stats(self) -> dict:
+        return self._links.stats()
+
+    async def close(self) -> None:
+        if self._bot is not None:
+            await self._bot.session.close()
+
+    async def _get_bot(self):
+        async with self._setup:
+            if self._bot is not None:
+                return self._bot
+            if not self._token:
+                raise PaymentsNotConfigured('TELEGRAM_BOT_TOKEN is not set')
+            # In a thread, so the import does not stall other requests
+            await asyncio.to_thread(_import_aiogram)
+            from aiogram import Bot
+            from aiogram.client.session.aiohttp import AiohttpSession
+            from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+            from aiogram.types import LabeledPrice
+
+            server = (PRODUCTION if self._api_url is None else
+                      TelegramAPIServer.from_base(self._api_url))
+            self._bot = Bot(token=self._token,
+                            session=AiohttpSession(
+                                api=server, limit=self._max_concurrency))
+            self._labeled_price = LabeledPrice
+            return self._bot
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from environs import Env
+
+from admission import Budget, LoadShedder, RateLimiter, parse_budgets
+from database import Database
+from database.archival import GameArchiver
+from database.cache import MemoryCache, ReadThroughCache
+from database.changes import ChangeFeed
+from database.events import EventHub
+from database.fast_path import FastReads
+from database.idempotency import (Idempotency, MemoryIdempotencyStore,
+                                  TableIdempotencyStore)
+from database.matchmaking import OpenGameBook
+from database.ranking import Leaderboard
+from database.repository.game_repo import GameRepository
+from database.repository.leaderboard_repo import LeaderboardRepository
+from database.repository.task_repo import TaskRepository
+from database.repository.user_repo import UserRepository
+from database.settlement import Settlement, SettlementQueue
+from database.task_board import TaskBoard
+from database.write_behind import BalanceAccumulator
+from metrics import Metrics
+from payments import InvoiceLinks
+
+logger = logging.getLogger(__name__)
+
+# Per-user budgets in requests per second and burst. RATE_LIMITS overrides
+# them as "route=rate:burst,..."; a rate of 0 lifts a route's limit.
+RATE_LIMITS = {
+    'user_register': Budget(rate=1, burst=3),
+    'user_task': Budget(rate=2, burst=10),
+    'user_balance': Budget(rate=10, burst=20),
+    'game_create': Budget(rate=2, burst=10),
+    'game_match': Budget(rate=5, burst=20),
+    'game_finish': Budget(rate=5, burst=20),
+    # Batches mix users, so these are per client address, and each request
+    # may carry up to MAX_BATCH_SIZE items
+    'user_balance_batch': Budget(rate=1, burst=5),
+    'task_batch': Budget(rate=1, burst=5),
+    'game_finish_batch': Budget(rate=2, burst=10),
+}
+
+# Repeats of these requests with the same Idempotency-Key get the first
+# response back. IDEMPOTENCY_STORE=table records keys in the database, shared
+# by every worker; the default keeps the most recent ones in memory, per
+# worker, so with several workers a repeat that reaches another worker runs
+# again.
+IDEMPOTENT_ROUTES = [
+    ('POST', '/user/register'),
+    ('POST', '/user/finish_task'),
+    ('PUT', '/user/balance'),
+    ('POST', '/game/create'),
+]
+
+# Reads that FAST_PATH_ROUTES="user_get,..." moves from a session onto
+# prepared asyncpg statements, see database.fast_path
+FAST_PATH_ROUTES = ('user_get', 'user_top_place')
+
+
+class Services:
+    """What the endpoints share, configured from the environment.
+
+    Building it connects to nothing: ``start`` warms the pool up and loads
+    the in-memory indexes, and ``close`` releases everything again. The Bot
+    API client behind /payment is only set up once a payment is made.
+    """
+
+    def __init__(self,
+                 env: Optional[Env] = None,
+                 database: Optional[Database] = None) -> None:
+        if env is None:
+            env = Env()
+            env.read_env('.env')
+        self.database = database or Database()
+        self.leaderboard = Leaderboard()
+        self.open_games = OpenGameBook()
+        self.task_board = TaskBoard()
+        self.cache = ReadThroughCache(
+            MemoryCache(env.int('CACHE_MAX_ENTRIES', 100_000)),
+            ttl=env.float('CACHE_TTL', 30))
+        self.events = EventHub(
+            max_subscribers=env.int('EVENTS_MAX_SUBSCRIBERS', 50_000),
+            max_queue=env.int('EVENTS_MAX_QUEUE', 100))
+        # Idle SSE connections get a comment this often to keep proxies from
+        # closing them and to notice clients that went away
+        self.events_heartbeat = env.float('EVENTS_HEARTBEAT', 15)
+        # Set CHANGE_FEED when running several workers: each one's writes
+        # then reach the others' caches, indexes and push subscribers
+        self.changes: Optional[ChangeFeed] = None
+        if env.bool('CHANGE_FEED', False):
+            self.changes = ChangeFeed(
+                self.database.dsn,
+                self._resync,
+                leaderboard=self.leaderboard,
+                open_games=self.open_games,
+                task_board=self.task_board,
+                cache=self.cache,
+                events=self.events,
+                connect_timeout=self.database.settings.connect_timeout,
+                reconnect_delay=env.float('CHANGE_FEED_RECONNECT_DELAY', 1),
+                ping_interval=env.float('CHANGE_FEED_PING_INTERVAL', 10))
+
+        self.metrics = Metrics(
+            slow_request_seconds=env.float('METRICS_SLOW_REQUEST_MS', 500) /
+            1000,
+            sample_rate=env.float('METRICS_SLOW_SAMPLE_RATE', 0.1))
+        for engine in self.database.engines:
+            self.metrics.instrument_engine(engine)
+        self.metrics.add_gauges(self._pool_gauges)
+
+        self.limiter = RateLimiter(
+            {**RATE_LIMITS, **parse_budgets(env.dict('RATE_LIMITS', {}))},
+            max_buckets=env.int('RATE_LIMIT_MAX_BUCKETS', 1_000_000))
+        # Requests are turned away with 503 past MAX_IN_FLIGHT, or while a
+        # database checkout has been waiting longer than MAX_POOL_WAIT_MS
+        self.shedder = LoadShedder(
+            max_in_flight=env.int('MAX_IN_FLIGHT', 1000),
+            pool_wait=self.database.pool_wait,
+            max_pool_wait=env.float('MAX_POOL_WAIT_MS', 500) / 1000)
+
+        if env.str('IDEMPOTENCY_STORE', 'memory') == 'table':
+            store = TableIdempotencyStore(self.database.get_session)
+        else:
+            store = MemoryIdempotencyStore(
+                env.int('IDEMPOTENCY_MAX_KEYS', 100_000))
+        self.idempotency = Idempotency(store,
+                                       ttl=env.float('IDEMPOTENCY_TTL', 86400),
+                                       lease=env.float('IDEMPOTENCY_LEASE', 60))
+
+        self.invoices = InvoiceLinks(
+            # Only needed once /payment is used, which fails until it is set
+            token=env.str('TELEGRAM_BOT_TOKEN', None),
+            # Point at a local Bot API server or a fake one in development
+            api_url=env.str('TELEGRAM_API_URL', None),
+            max_concurrency=env.int('TELEGRAM_MAX_CONCURRENCY', 10),
+            ttl=env.float('INVOICE_LINK_TTL', 3600))
+
+        # Settled games older than GAME_RETENTION_DAYS move to games_archive,
+        # leaving users' game lists though not their stats, and their emptied
+        # partitions are dropped. Unset keeps every game in place; lookups by
+        # game id alone (the open games pages, finishes and deletes sent
+        # without created_at) then read more partitions every month. Future
+        # partitions are created either way.
+        retention_days = env.float('GAME_RETENTION_DAYS', None)
+        self.archiver = GameArchiver(
+            self.database.get_session,
+            retention=timedelta(
+                days=retention_days) if retention_days else None,
+            interval=env.float('GAME_ARCHIVE_INTERVAL', 3600),
+            batch_size=env.int('GAME_ARCHIVE_BATCH_SIZE', 1000))
+
+        # Opt-in: PUT /user/balance is acknowledged before it is written, and
+        # a crash loses up to BALANCE_FLUSH_INTERVAL seconds of increments
+        self.balances: Optional[BalanceAccumulator] = None
+        if env.bool('BALANCE_WRITE_BEHIND', False):
+            self.balances = BalanceAccumulator(
+                self._flush_balances,
+                flush_interval=env.float('BALANCE_FLUSH_INTERVAL', 1.0),
+                max_pending=env.int('BALANCE_FLUSH_MAX_PENDING', 10_000))
+
+        self.fast_routes = set(env.list('FAST_PATH_ROUTES', []))
+        unknown = self.fast_routes.difference(FAST_PATH_ROUTES)
+        if unknown:
+            raise ValueError(
+                f'No fast path for {", ".join(sorted(unknown))}; '
+                f'choose from {", ".join(FAST_PATH_ROUTES)}')
+        self.fast_reads: Optional[FastReads] = None
+        if self.fast_routes:
+            self.fast_reads = FastReads(
+                self.database.dsn,
+                leaderboard=self.leaderboard,
+                cache=self.cache,
+                balances=self.balances,
+                pool_size=env.int('FAST_PATH_POOL_SIZE', 10),
+                connect_timeout=self.database.settings.connect_timeout,
+                command_timeout=self.database.settings.command_timeout,
+                recycle=self.database.settings.pool_recycle)
+
+        # Opt-in: PUT /game/finish/{game_id} waits in a queue and is settled
+        # together with the others queued meanwhile, in one transaction
+        self.settlements: Optional[SettlementQueue] = None
+        if env.bool('SETTLEMENT_BATCHING', False):
+            self.settlements = SettlementQueue(
+                self._settle_games,
+                max_batch=env.int('SETTLEMENT_MAX_BATCH', 500),
+                max_linger=env.float('SETTLEMENT_MAX_LINGER_MS', 2) / 1000,
+                max_pending=env.int('SETTLEMENT_MAX_PENDING', 100_000))
+
+    async def start(self) -> None:
+        # Independent of each other, so they share the startup time; each
+        # index falls back to SQL until it is loaded
+        if self.changes is None:
+            await asyncio.gather(self._warmup(), self._load_indexes())
+        else:
+            # The feed loads the indexes once it listens, so that no change
+            # made in between is missed
+            await asyncio.gather(self._warmup(), self.changes.start())
+        if self.balances is not None:
+            self.balances.start()
+        if self.settlements is not None:
+            self.settlements.start()
+        self.archiver.start()
+
+    async def close(self) -> None:
+        if self.settlements is not None:
+            await self.settlements.close()
+        if self.changes is not None:
+            await self.changes.close()
+        self.events.close()
+        await self.archiver.close()
+        if self.balances is not None:
+            await self.balances.close()
+        await self.invoices.close()
+        if self.fast_reads is not None:
+            await self.fast_reads.close()
+        await self.database.dispose()
+
+    def fast_path(self, route: str) -> Optional[FastReads]:
+        """The fast path if FAST_PATH_ROUTES selects ``route``, else None."""
+        return self.fast_reads if route in self.fast_routes else None
+
+    async def _warmup(self) -> None:
+        if self.fast_reads is not None:
+            # Its own pool, opened alongside the engine's
+            await asyncio.gather(self._warmup_engine(),
+                                 self.fast_reads.start())
+        else:
+            await self._warmup_engine()
+
+    async def _warmup_engine(self) -> None:
+        try:
+            await self.database.warmup()
+        except Exception:
+            logger.exception('Failed to warm up database connections')
+
+    async def _load_indexes(self) -> None:
+        await asyncio.gather(self._load_ranking(), self._load_open_games(),
+                             self._load_active_tasks())
+
+    async def _resync(self) -> None:
+        await self.cache.clear()
+        await self._load_indexes()
+
+    async def _load_ranking(self) -> None:
+        try:
+            async with self.database.get_session() as session:
+                await LeaderboardRepository(
+                    session, self.leaderboard).load_ranking()
+        except Exception:
+            logger.exception('Failed to load leaderboard ranking')
+
+    async def _load_open_games(self) -> None:
+        try:
+            async with self.database.get_session() as session:
+                await GameRepository(
+                    session, open_games=self.open_games).load_open_games()
+        except Exception:
+            logger.exception('Failed to load open games')
+
+    async def _load_active_tasks(self) -> None:
+        try:
+            async with self.database.get_session() as session:
+                await TaskRepository(
+                    session, task_board=self.task_board).load_active_tasks()
+        except Exception:
+            logger.exception('Failed to load active tasks')
+
+    async def _flush_balances(
+            self, adjustments: list[tuple[int, int]]) -> list[dict]:
+        async with self.database.get_session() as session:
+            user_repo = UserRepository(session,
+                                       self.leaderboard,
+                                       self.cache,
+                                       events=self.events,
+                                       changes=self.changes)
+            return await user_repo.update_user_balances(adjustments)
+
+    async def _settle_games(self,
+                            settlements: list[Settlement]) -> list[dict]:
+        async with self.database.get_session() as session:
+            game_repo = GameRepository(session,
+                                       self.leaderboard,
+                                       self.open_games,
+                                       self.cache,
+                                       self.events,
+                                       changes=self.changes)
+            return await game_repo.finish_games(settlements)
+
+    def _pool_gauges(self) -> dict[str, float]:
+        return {
+            f'db_pool_{key}{{pool="{name}"}}': value
+            for name, stats in self.database.pool_stats().items()
+            for key, value in stats.items()
+        }